@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Compares gaepagseguro.checkout_params.encode_checkout_params with the previous checkout body encoding: a params
+dict, its values encoded to ISO-8859-1 and then urlencoded by UrlFetchCommand.
+It does not need App Engine SDK. Run from project root:
+
+    python benchmarks/checkout_params_benchmark.py
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+from decimal import Decimal
+import os
+import sys
+import timeit
+import urllib
+from urlparse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gaepagseguro.checkout_params import encode_checkout_params
+
+
+class _Reference(object):
+    def __init__(self, id):
+        self._id = id
+
+    def id(self):
+        return self._id
+
+
+class _Item(object):
+    def __init__(self, index):
+        self.reference = _Reference(index) if index % 2 else None
+        self.description = 'Produto número %s com descrição longa' % index
+        self.price = Decimal('%s.50' % index)
+        self.quantity = index % 5 + 1
+
+
+class _Address(object):
+    street = 'Av. Brig. Faria Lima'
+    number = '1384'
+    complement = '5o andar'
+    quarter = 'Jardim Paulistano'
+    postalcode = '01452002'
+    town = 'São Paulo'
+    state = 'SP'
+
+
+def _args(items_number):
+    return ('foo@bar.com', 'abc123', 'https://store.com/pagseguro', 'José Comprador', 'comprador@uol.com.br', 1234,
+            [_Item(i) for i in xrange(items_number)], _Address(), 'BRL')
+
+
+def _previous_params(email, token, redirect_url, client_name, client_email, payment_reference, items, address,
+                     currency):
+    d = {"email": email,
+         "token": token,
+         "currency": currency,
+         "reference": unicode(payment_reference),
+         "senderName": client_name,
+         "senderEmail": client_email,
+         "shippingType": "3",
+         "redirectURL": redirect_url}
+    for index, item in enumerate(items, 1):
+        d["itemId%s" % index] = unicode(item.reference.id() if item.reference else '9999')
+        d["itemDescription%s" % index] = item.description
+        d["itemAmount%s" % index] = '%.2f' % item.price
+        d["itemQuantity%s" % index] = unicode(item.quantity)
+    if address:
+        d.update({"shippingAddressStreet": address.street,
+                  "shippingAddressNumber": unicode(address.number),
+                  "shippingAddressComplement": address.complement,
+                  "shippingAddressDistrict": address.quarter,
+                  "shippingAddressPostalCode": address.postalcode,
+                  "shippingAddressCity": address.town,
+                  "shippingAddressState": address.state,
+                  "shippingAddressCountry": "BRA"})
+    return d
+
+
+def _previous_encoding(*args):
+    params = _previous_params(*args)
+    params = {k: unicode(v).encode('iso-8859-1') for k, v in params.iteritems() if v is not None}
+    return urllib.urlencode(params)
+
+
+def main():
+    print('%6s %14s %14s %8s' % ('items', 'previous(ms)', 'encoder(ms)', 'speedup'))
+    for items_number in (1, 10, 100, 500):
+        args = _args(items_number)
+        assert parse_qs(_previous_encoding(*args)) == parse_qs(encode_checkout_params(*args))
+        number = max(20, 2000 // items_number)
+        previous_time = min(timeit.repeat(lambda: _previous_encoding(*args), number=number, repeat=3)) / number
+        encoder_time = min(timeit.repeat(lambda: encode_checkout_params(*args), number=number, repeat=3)) / number
+        print('%6d %14.3f %14.3f %7.1fx' % (items_number, previous_time * 1000, encoder_time * 1000,
+                                           previous_time / encoder_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Compares gaepagseguro.transaction_parser.parse_transaction with xmltodict on transactions with several items.
+It does not need App Engine SDK. Run from project root:
+
+    python benchmarks/transaction_parser_benchmark.py
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xmltodict
+from gaepagseguro.transaction_parser import parse_transaction
+
+_ITEM = '''
+        <item>
+            <id>%(index)s</id>
+            <description>Produto número %(index)s com descrição longa</description>
+            <quantity>%(quantity)s</quantity>
+            <amount>%(index)s.50</amount>
+            <weight>1000</weight>
+            <shippingCost>1.00</shippingCost>
+        </item>'''
+
+_TRANSACTION = '''<?xml version="1.0" encoding="ISO-8859-1" standalone="yes"?>
+<transaction>
+    <date>2011-02-05T15:46:12.000-02:00</date>
+    <lastEventDate>2011-02-15T17:39:14.000-03:00</lastEventDate>
+    <code>9E884542-81B3-4419-9A75-BCC6FB495EF1</code>
+    <reference>1234</reference>
+    <type>1</type>
+    <status>3</status>
+    <paymentMethod>
+        <type>1</type>
+        <code>101</code>
+    </paymentMethod>
+    <grossAmount>49900.00</grossAmount>
+    <discountAmount>0.00</discountAmount>
+    <creditorFees>
+        <intermediationRateAmount>0.40</intermediationRateAmount>
+        <intermediationFeeAmount>1644.80</intermediationFeeAmount>
+    </creditorFees>
+    <netAmount>49900.50</netAmount>
+    <extraAmount>0.00</extraAmount>
+    <installmentCount>1</installmentCount>
+    <itemCount>%(items_number)s</itemCount>
+    <items>%(items)s
+    </items>
+    <sender>
+        <name>José Comprador</name>
+        <email>comprador@uol.com.br</email>
+        <phone>
+            <areaCode>11</areaCode>
+            <number>56273440</number>
+        </phone>
+    </sender>
+    <shipping>
+        <address>
+            <street>Av. Brig. Faria Lima</street>
+            <number>1384</number>
+            <complement>5o andar</complement>
+            <district>Jardim Paulistano</district>
+            <postalCode>01452002</postalCode>
+            <city>Sao Paulo</city>
+            <state>SP</state>
+            <country>BRA</country>
+        </address>
+        <type>1</type>
+        <cost>21.50</cost>
+    </shipping>
+</transaction>'''
+
+
+def build_transaction_xml(items_number):
+    items = ''.join(_ITEM % {'index': i, 'quantity': i % 5 + 1} for i in xrange(items_number))
+    return (_TRANSACTION % {'items_number': items_number, 'items': items}).encode('ISO-8859-1')
+
+
+def _xmltodict_fields(xml):
+    # same fields read by the app before parse_transaction
+    transaction = xmltodict.parse(xml, 'ISO-8859-1')['transaction']
+    items = transaction['items']['item']
+    if isinstance(items, dict):
+        items = [items]
+    return (transaction['code'], transaction['status'], transaction['netAmount'], transaction['grossAmount'],
+            transaction['reference'], [(i['description'], i['amount'], i['quantity']) for i in items])
+
+
+def _parser_fields(xml):
+    transaction = parse_transaction(xml)
+    return (transaction.code, transaction.status, transaction.net_amount, transaction.gross_amount,
+            transaction.reference, [(i.description, i.amount, i.quantity) for i in transaction.items])
+
+
+def main():
+    print('%6s %14s %14s %8s' % ('items', 'xmltodict(ms)', 'parser(ms)', 'speedup'))
+    for items_number in (1, 10, 50, 200):
+        xml = build_transaction_xml(items_number)
+        assert _xmltodict_fields(xml) == _parser_fields(xml)
+        number = max(20, 2000 // items_number)
+        xmltodict_time = min(timeit.repeat(lambda: _xmltodict_fields(xml), number=number, repeat=3)) / number
+        parser_time = min(timeit.repeat(lambda: _parser_fields(xml), number=number, repeat=3)) / number
+        print('%6d %14.3f %14.3f %7.1fx' % (items_number, xmltodict_time * 1000, parser_time * 1000,
+                                           xmltodict_time / parser_time))
+
+
+if __name__ == '__main__':
+    main()
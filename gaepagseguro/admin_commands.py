@@ -1,20 +1,74 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+from itertools import izip
+import time
 from gaebusiness.gaeutil import ModelSearchCommand
 from google.appengine.api import memcache
-from gaepagseguro.model import PagSegAccessData
+from google.appengine.ext import ndb
+from gaepagseguro.model import PagSegAccessData, PagSegPayment, PagSegPaymentToLog, PagSegStatusEntry, \
+    ToPagSegPayment
+from gaepagseguro.search_commands import clear_payment_cache
+
+_ACCESS_DATA_CACHE_KEY = 'gaepagseguro_access_data'
+
+# Seconds an instance keeps access data in memory. Other instances only see CreateOrUpdateAccessData changes after
+# this period, since only the memcache tier can be invalidated globally
+ACCESS_DATA_LOCAL_TTL = 60
+
+# instance local cache tier: key -> (access_data, expiration timestamp)
+_local_cache = {}
+
+
+def clear_access_data_cache():
+    """
+    Invalidates both instance local and memcache tiers of access data cache
+    """
+    _local_cache.clear()
+    memcache.delete(_ACCESS_DATA_CACHE_KEY)
+
+
+def _get_cached_access_data():
+    cached = _local_cache.get(_ACCESS_DATA_CACHE_KEY)
+    if cached and cached[1] > time.time():
+        return cached[0]
+    access_data = memcache.get(_ACCESS_DATA_CACHE_KEY)
+    if access_data is not None:
+        _local_cache[_ACCESS_DATA_CACHE_KEY] = (access_data, time.time() + ACCESS_DATA_LOCAL_TTL)
+    return access_data
+
+
+def _cache_access_data(access_data):
+    _local_cache[_ACCESS_DATA_CACHE_KEY] = (access_data, time.time() + ACCESS_DATA_LOCAL_TTL)
+    memcache.set(_ACCESS_DATA_CACHE_KEY, access_data)
 
 
 class FindAccessDataCmd(ModelSearchCommand):
+    _use_access_data_cache = True
+
     def __init__(self):
         super(FindAccessDataCmd, self).__init__(PagSegAccessData.query(), 1)
+        self._cached_access_data = None
+
+    def set_up(self):
+        if self._use_access_data_cache:
+            self._cached_access_data = _get_cached_access_data()
+        if self._cached_access_data is None:
+            super(FindAccessDataCmd, self).set_up()
 
     def do_business(self, stop_on_error=True):
+        if self._cached_access_data is not None:
+            self.result = self._cached_access_data
+            return
         super(FindAccessDataCmd, self).do_business(stop_on_error)
         self.result = self.result[0] if self.result else None
+        if self.result is not None and self._use_access_data_cache:
+            _cache_access_data(self.result)
 
 
 class CreateOrUpdateAccessData(FindAccessDataCmd):
+    # Always reads from datastore so the cached entity is never changed in place
+    _use_access_data_cache = False
+
     def __init__(self, email, token):
         super(CreateOrUpdateAccessData, self).__init__()
         self.token = token
@@ -29,4 +83,74 @@ class CreateOrUpdateAccessData(FindAccessDataCmd):
             self.result = PagSegAccessData(email=self.email, token=self.token)
 
     def commit(self):
-        return self.result
\ No newline at end of file
+        clear_access_data_cache()
+        return self.result
+
+    def execute(self):
+        super(CreateOrUpdateAccessData, self).execute()
+        # Clearing again after put, so a concurrent read can not cache the old data
+        clear_access_data_cache()
+        return self
+
+
+class MigrateLogsToStatusHistory(ModelSearchCommand):
+    """
+    Folds PagSegLog nodes of a page of payments into their embedded status history. Execute it again with cursor
+    attribute while more attribute is True. Logs already on history are not duplicated, so pages can be retried.
+    Logs and arcs are kept untouched. Payment's update property is changed, since it is an auto_now property
+    """
+
+    def __init__(self, page_size=100, start_cursor=None):
+        super(MigrateLogsToStatusHistory, self).__init__(PagSegPayment.query(), page_size, start_cursor,
+                                                         use_cache=False)
+
+    def do_business(self, stop_on_error=True):
+        super(MigrateLogsToStatusHistory, self).do_business(stop_on_error)
+        payments = [p for p in self.result if p]
+        arcs_futures = [PagSegPaymentToLog.find_destinations(p).fetch_async() for p in payments]
+        arcs_by_payment = [f.get_result() for f in arcs_futures]
+        logs = ndb.get_multi([arc.destination for arcs in arcs_by_payment for arc in arcs])
+        logs_dct = {log.key: log for log in logs if log}
+        for payment, arcs in izip(payments, arcs_by_payment):
+            entries = set((e.status, e.creation) for e in payment.status_history)
+            # arc creation is used because it defines logs order on SearchLogs
+            entries.update((logs_dct[arc.destination].status, arc.creation) for arc in arcs
+                           if arc.destination in logs_dct)
+            payment.status_history = [PagSegStatusEntry(status=status, creation=creation)
+                                      for status, creation in sorted(entries, key=lambda e: e[1])]
+            payment.status_history_complete = True
+        self.result = payments
+        self._to_commit = payments
+
+    def execute(self):
+        super(MigrateLogsToStatusHistory, self).execute()
+        clear_payment_cache(self.result)
+        return self
+
+
+class MigratePaymentOwners(ModelSearchCommand):
+    """
+    Copies origin of a page of ToPagSegPayment arcs to their payments' owner_key, so they are found by owner's
+    payments search. Execute it again with cursor attribute while more attribute is True. Pages can be retried.
+    Payment's update property is changed, since it is an auto_now property
+    """
+
+    def __init__(self, page_size=100, start_cursor=None):
+        super(MigratePaymentOwners, self).__init__(ToPagSegPayment.query(), page_size, start_cursor, use_cache=False)
+
+    def do_business(self, stop_on_error=True):
+        super(MigratePaymentOwners, self).do_business(stop_on_error)
+        arcs = [arc for arc in self.result if arc]
+        payments = ndb.get_multi([arc.destination for arc in arcs])
+        changed = []
+        for arc, payment in izip(arcs, payments):
+            if payment is not None and payment.owner_key != arc.origin:
+                payment.owner_key = arc.origin
+                changed.append(payment)
+        self.result = changed
+        self._to_commit = changed
+
+    def execute(self):
+        super(MigratePaymentOwners, self).execute()
+        clear_payment_cache(self.result)
+        return self
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from itertools import izip
+from urllib import quote_plus
+
+_ENCODING = 'ISO-8859-1'
+
+# id sent for items without reference
+_NO_REFERENCE_ID = b'9999'
+
+_SHIPPING_TYPE = b'3'
+_COUNTRY = b'BRA'
+
+_ITEM_KEYS = ('itemId', 'itemDescription', 'itemAmount', 'itemQuantity')
+
+
+def _build_item_prefixes(items_number):
+    return tuple(tuple(str('&%s%s=' % (key, index)) for key in _ITEM_KEYS) for index in xrange(1, items_number + 1))
+
+
+# Keys of each item field, with separators, precomputed by item index. Extended when a bigger cart is encoded
+_item_prefixes = _build_item_prefixes(100)
+
+
+def _get_item_prefixes(items_number):
+    global _item_prefixes
+    prefixes = _item_prefixes
+    if len(prefixes) < items_number:
+        # a new tuple is assigned, so concurrent requests never see a partially built one
+        prefixes = _item_prefixes = _build_item_prefixes(max(items_number, 2 * len(prefixes)))
+    return prefixes
+
+
+def _quote(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return quote_plus(value.encode(_ENCODING))
+
+
+def format_amount(price):
+    """
+    @return: price with 2 decimal places, rounded on cents, the format of PagSeguro's amounts
+    """
+    text = str(price)
+    dot = text.find('.')
+    if dot > 0 and len(text) - dot == 3 and 'E' not in text:
+        # already on cents, like currency properties values
+        return text
+    # Decimal arithmetic is slow. Prices are below 10 million, so their cents are exact on a float
+    cents = int(round(float(price) * 100))
+    return b'%d.%02d' % divmod(cents, 100)
+
+
+def encode_checkout_params(email, token, redirect_url, client_name, client_email, payment_reference, items, address,
+                           currency):
+    """
+    Encodes the parameters sent to PagSeguro on checkout as an ISO-8859-1 form body in a single pass. None values are
+    not sent
+    @return: str to be posted with application/x-www-form-urlencoded content type
+    """
+    parts = [b'&email=', _quote(email), b'&token=', _quote(token), b'&currency=', _quote(currency),
+             b'&reference=', _quote(payment_reference), b'&shippingType=', _SHIPPING_TYPE]
+    append = parts.append
+    for prefix, value in ((b'&senderName=', client_name), (b'&senderEmail=', client_email),
+                          (b'&redirectURL=', redirect_url)):
+        if value is not None:
+            append(prefix)
+            append(_quote(value))
+
+    for (id_prefix, description_prefix, amount_prefix, quantity_prefix), item in izip(
+            _get_item_prefixes(len(items)), items):
+        reference = item.reference
+        parts.extend((id_prefix, _quote(reference.id()) if reference else _NO_REFERENCE_ID,
+                      description_prefix, _quote(item.description),
+                      amount_prefix, format_amount(item.price),
+                      quantity_prefix, _quote(item.quantity)))
+
+    if address:
+        for prefix, value in ((b'&shippingAddressStreet=', address.street),
+                              (b'&shippingAddressNumber=', address.number),
+                              (b'&shippingAddressComplement=', address.complement),
+                              (b'&shippingAddressDistrict=', address.quarter),
+                              (b'&shippingAddressPostalCode=', address.postalcode),
+                              (b'&shippingAddressCity=', address.town),
+                              (b'&shippingAddressState=', address.state)):
+            if value is not None:
+                append(prefix)
+                append(_quote(value))
+        append(b'&shippingAddressCountry=')
+        append(_COUNTRY)
+    # skipping first separator
+    return b''.join(parts)[1:]
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import logging
+import random
+import time
+from gaebusiness.business import Command
+from google.appengine.api import urlfetch, memcache
+from gaepagseguro.rate_limiter import acquire_call, rate_limit_error
+
+# Consecutive failed calls which open an endpoint's circuit, and seconds it is kept open before a probe call
+FAILURE_THRESHOLD = 5
+OPEN_SECONDS = 30
+
+# Attempts of idempotent calls, with exponential backoff from RETRY_BASE_DELAY seconds, capped on RETRY_MAX_DELAY
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 1
+
+# Circuit events counted on memcache
+METRIC_OPENED = 'opened'
+METRIC_HALF_OPENED = 'half_opened'
+METRIC_CLOSED = 'closed'
+METRIC_REJECTED = 'rejected'
+METRICS = [METRIC_OPENED, METRIC_HALF_OPENED, METRIC_CLOSED, METRIC_REJECTED]
+
+# PagSeguro unavailable or overloaded. Client errors mean it answered, so they are not failures
+_SERVER_ERROR_STATUSES = frozenset(xrange(500, 600))
+_CLIENT_ERROR_STATUSES = frozenset(xrange(400, 500))
+
+
+def is_server_failure(fetch_result):
+    return getattr(fetch_result, 'status_code', None) in _SERVER_ERROR_STATUSES
+
+
+def backoff_delay(retry):
+    """
+    @return: seconds to wait before a retry, with full jitter, so instances retrying together are spread
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** retry))
+
+
+def _metric_cache_key(endpoint, metric):
+    return 'gaepagseguro_circuit_%s_%s' % (endpoint, metric)
+
+
+def circuit_metrics(endpoint):
+    """
+    @return: dict of metric to the number of times it happened on endpoint's circuit, since memcache kept them
+    """
+    values = memcache.get_multi([_metric_cache_key(endpoint, m) for m in METRICS])
+    return {m: values.get(_metric_cache_key(endpoint, m), 0) for m in METRICS}
+
+
+class CircuitBreaker(object):
+    """
+    Circuit of an endpoint, shared by all instances on memcache. It opens after FAILURE_THRESHOLD consecutive failed
+    calls, so calls are rejected at once for OPEN_SECONDS instead of waiting fetch deadlines. Then it is half open:
+    a single call, from any instance, probes PagSeguro, closing the circuit if it succeeds or opening it again.
+    Create one for each call, calling allow before it and record_success or record_failure after it.
+    If memcache fails, calls are allowed
+    """
+
+    def __init__(self, endpoint, clock=None):
+        self.endpoint = endpoint
+        self._clock = clock or time.time
+        self._open_key = 'gaepagseguro_circuit_%s_open_until' % endpoint
+        self._failures_key = 'gaepagseguro_circuit_%s_failures' % endpoint
+        self._probe_key = 'gaepagseguro_circuit_%s_probe' % endpoint
+        self._failures = 0
+        self._probing = False
+
+    def _count(self, metric):
+        memcache.incr(_metric_cache_key(self.endpoint, metric), initial_value=0)
+
+    def allow(self):
+        """
+        @return: False if circuit is open, True if call can be made
+        """
+        # memcache returns no values when it fails, so calls are allowed
+        state = memcache.get_multi([self._open_key, self._failures_key])
+        self._failures = state.get(self._failures_key, 0)
+        open_until = state.get(self._open_key)
+        if open_until is None:
+            return True
+        if self._clock() >= open_until and memcache.add(self._probe_key, 1, time=OPEN_SECONDS):
+            self._probing = True
+            self._count(METRIC_HALF_OPENED)
+            return True
+        self._count(METRIC_REJECTED)
+        return False
+
+    def record_success(self):
+        if not (self._failures or self._probing):
+            return
+        memcache.delete_multi([self._open_key, self._failures_key, self._probe_key])
+        if self._probing:
+            self._probing = False
+            self._count(METRIC_CLOSED)
+
+    def record_failure(self):
+        # incr returns None if memcache fails
+        failures = memcache.incr(self._failures_key, initial_value=0) or 0
+        if self._probing or failures >= FAILURE_THRESHOLD:
+            memcache.set(self._open_key, self._clock() + OPEN_SECONDS)
+            memcache.delete(self._probe_key)
+            self._probing = False
+            self._count(METRIC_OPENED)
+            logging.warning('PagSeguro %s circuit opened after %s failures', self.endpoint, failures)
+
+
+def circuit_open_error(endpoint):
+    return 'PagSeguro %s calls circuit is open' % endpoint
+
+
+class ResilientFetch(Command):
+    """
+    Fetches with commands built by fetch_factory, at most attempts times, until PagSeguro answers without a server
+    error, waiting a jittered exponential backoff between attempts. So only idempotent calls must use more than one
+    attempt. set_up starts the first fetch, so several ones can run concurrently. Each attempt goes through
+    endpoint's rate limiter and calls are rejected at once while endpoint's circuit is open, with rate_limit and
+    circuit_open errors. Result is last fetch's result, with an http error for client errors like UrlFetchCommand.
+    The last urlfetch.Error is raised if all attempts fail
+    """
+
+    def __init__(self, endpoint, fetch_factory, attempts=RETRY_ATTEMPTS, sleep=None):
+        super(ResilientFetch, self).__init__()
+        self.endpoint = endpoint
+        self.fetch_factory = fetch_factory
+        self.attempts = attempts
+        self.fetch_cmd = None
+        self._breaker = CircuitBreaker(endpoint)
+        self._sleep = sleep or time.sleep
+
+    def _start_fetch(self):
+        if not acquire_call(self.endpoint):
+            self.add_error('rate_limit', rate_limit_error(self.endpoint))
+            return False
+        self.fetch_cmd = self.fetch_factory()
+        self.fetch_cmd.set_up()
+        return True
+
+    def set_up(self):
+        if self._breaker.allow():
+            self._start_fetch()
+        else:
+            self.add_error('circuit_open', circuit_open_error(self.endpoint))
+
+    def do_business(self):
+        if self.errors:
+            return
+        error = None
+        for attempt in xrange(self.attempts):
+            if attempt:
+                self._sleep(backoff_delay(attempt - 1))
+                if not self._start_fetch():
+                    return
+            try:
+                self.fetch_cmd.do_business()
+            except urlfetch.Error, e:
+                error = e
+                continue
+            error = None
+            self.result = self.fetch_cmd.result
+            if not is_server_failure(self.result):
+                status_code = getattr(self.result, 'status_code', None)
+                if status_code in _CLIENT_ERROR_STATUSES:
+                    self.add_error('http', status_code)
+                self._breaker.record_success()
+                return
+        self._breaker.record_failure()
+        if error is not None:
+            raise error
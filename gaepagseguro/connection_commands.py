@@ -1,15 +1,47 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+import hashlib
+from itertools import izip
+import time
 from xml.etree import ElementTree
-from gaebusiness.business import CommandParallel, CommandSequential
+from gaebusiness.business import CommandParallel, CommandSequential, Command, CommandExecutionException
 from gaebusiness.gaeutil import UrlFetchCommand
-from google.appengine.api import urlfetch
-from gaepagseguro.model import STATUS_SENT_TO_PAGSEGURO
-from gaepagseguro.save_commands import SavePagseguroDataCmd, SavePaymentArcsCmd, UpdatePaymentAndSaveLog
+from google.appengine.api import urlfetch, memcache
+from google.appengine.ext import ndb
+from gaegraph.model import to_node_key
+from gaepagseguro.admin_commands import FindAccessDataCmd
+from gaepagseguro.checkout_params import encode_checkout_params
+from gaepagseguro.model import STATUS_SENT_TO_PAGSEGURO, PagSegPayment, STATUS_CREATED
+from gaepagseguro.circuit_breaker import ResilientFetch
+from gaepagseguro.rate_limiter import ENDPOINT_CHECKOUT
+from gaepagseguro.save_commands import UpdatePaymentAndSaveLog, PlanPaymentWritesCmd, PaymentWritePlan
+from gaepagseguro.search_commands import SearchItems, clear_payment_cache
 from gaepagseguro.validation_commands import ValidatePagseguroDataCmd
 
 
 _PAYMENT_URL = "https://ws.pagseguro.uol.com.br/v2/checkout"
+_CHECKOUT_PAGE_URL = "https://pagseguro.uol.com.br/v2/checkout/payment.html?code=%s"
+
+# Seconds a generated payment is returned again for the same checkout key, and seconds a generation in progress
+# holds its key, so an instance failing while generating does not block the key for long
+CHECKOUT_DEDUP_SECONDS = 60
+_CHECKOUT_PENDING_SECONDS = 30
+
+# Seconds a repeated checkout waits for the generation in progress, checking it each _CHECKOUT_POLL_SECONDS
+CHECKOUT_DEDUP_WAIT = 5
+_CHECKOUT_POLL_SECONDS = 0.2
+_CHECKOUT_PENDING = 'pending'
+
+
+def checkout_page_url(checkout_code):
+    return str(_CHECKOUT_PAGE_URL % checkout_code)
+
+
+def _checkout_fetch(body, headers):
+    # body is already encoded, so it is set as fetch payload instead of being urlencoded from a dict
+    fetch_cmd = UrlFetchCommand(_PAYMENT_URL, method=urlfetch.POST, headers=headers)
+    fetch_cmd.params = body
+    return fetch_cmd
 
 
 class ContactPagseguro(CommandParallel):
@@ -29,24 +61,51 @@ class ContactPagseguro(CommandParallel):
         client_form = command.client_form
         address_form = command.address_form
         self.payment = command.result
-        params = _make_params(access_data.email, access_data.token,
-                              self.redirect_url, client_form.name,
-                              client_form.email, self.payment.key.id(),
-                              items, address_form,
-                              self.currency)
-        params = {k: unicode(v).encode('iso-8859-1') for k, v in params.iteritems()}
-        self.fetch_cmd = UrlFetchCommand(_PAYMENT_URL, params, urlfetch.POST, self.headers)
+        # client is unknown when an expired checkout is renewed
+        client_name, client_email = (client_form.name, client_form.email) if client_form else (None, None)
+        body = encode_checkout_params(access_data.email, access_data.token,
+                                      self.redirect_url, client_name,
+                                      client_email, self.payment.key.id(),
+                                      items, address_form,
+                                      self.currency)
+        # checkout is not idempotent, so it is not retried
+        self.fetch_cmd = ResilientFetch(ENDPOINT_CHECKOUT, lambda: _checkout_fetch(body, self.headers), attempts=1)
         self.append(self.fetch_cmd)
 
+    def start_async(self, command):
+        """
+        Starts the checkout fetch as a RPC, without waiting for PagSeguro's answer.
+        @param command: command exposing the same data used on handle_previous
+        @return: this command, whose get_result method waits for the answer like a future
+        """
+        self.handle_previous(command)
+        self.set_up()
+        return self
+
+    def get_result(self):
+        """
+        Waits for the checkout fetch started with start_async
+        @return: the payment sent to PagSeguro. Raises CommandExecutionException if PagSeguro was not contacted
+        """
+        self.do_business()
+        self.raise_exception_if_errors()
+        return self.result
 
     def do_business(self):
-        super(ContactPagseguro, self).do_business()
+        try:
+            super(ContactPagseguro, self).do_business()
+        except urlfetch.Error, e:
+            # PagSeguro may have registered the checkout anyway, so callers must still save the payment
+            self.add_error('pagseguro', unicode(e) or e.__class__.__name__)
+            return
         if self.result:
             content = self.result.content
             if self.result.status_code == 200 and content != 'Unauthorized':
                 root = ElementTree.XML(content)
                 if root.tag != "errors":
                     self.checkout_code = root.findtext("code").decode('ISO-8859-1')
+                    self.payment.set_checkout_code(self.checkout_code)
+                    self.payment.track_counters()
                     self.payment.status = STATUS_SENT_TO_PAGSEGURO
                     self.result = self.payment
                     return
@@ -55,17 +114,44 @@ class ContactPagseguro(CommandParallel):
             self.add_error('pagseguro', 'Not Contacted%s')
 
 
+class ContactPagseguroAndCommit(ContactPagseguro):
+    """
+    Contacts PagSeguro and then commits previous command's write plan, adding a log for payment's new status.
+    The plan is committed even if PagSeguro fails, so the payment is kept with its initial status
+    """
+
+    def __init__(self, redirect_url):
+        super(ContactPagseguroAndCommit, self).__init__(redirect_url)
+        self.write_plan = None
+
+    def handle_previous(self, command):
+        super(ContactPagseguroAndCommit, self).handle_previous(command)
+        self.write_plan = command.write_plan
+
+    def do_business(self):
+        try:
+            super(ContactPagseguroAndCommit, self).do_business()
+        except CommandExecutionException:
+            pass
+        if not self.errors:
+            self.write_plan.add_status_log(self.payment)
+        self.write_plan.commit()
+
+
 class GeneratePayment(CommandSequential):
+    """
+    Validates data, contacts PagSeguro and saves payment with its counters on a transaction, and then items, logs and
+    arcs with a single put_multi.
+    Ids are allocated before contacting PagSeguro, because payment's id is sent as checkout reference
+    """
+
     def __init__(self, redirect_url, client_name, client_email, payment_owner, validate_address_cmd,
                  *validate_item_cmds):
         validate_data_cmd = ValidatePagseguroDataCmd(client_name, client_email, validate_address_cmd,
                                                      *validate_item_cmds)
-        save_data_cmd = SavePagseguroDataCmd()
-        save_arcs_cmd = SavePaymentArcsCmd(payment_owner)
-        self.__contact_pagseguro_cmd = ContactPagseguro(redirect_url)
-        super(GeneratePayment, self).__init__(validate_data_cmd, save_data_cmd, save_arcs_cmd,
-                                              self.__contact_pagseguro_cmd,
-                                              UpdatePaymentAndSaveLog())
+        self.__contact_pagseguro_cmd = ContactPagseguroAndCommit(redirect_url)
+        super(GeneratePayment, self).__init__(validate_data_cmd, PlanPaymentWritesCmd(payment_owner),
+                                              self.__contact_pagseguro_cmd)
         self.checkout_code = None
 
     def do_business(self):
@@ -73,34 +159,231 @@ class GeneratePayment(CommandSequential):
         self.checkout_code = self.__contact_pagseguro_cmd.checkout_code
 
 
-def _make_params(email, token, redirect_url, client_name, client_email, payment_reference, items, address,
-                 currency):
-    d = {"email": email,
-         "token": token,
-         "currency": currency,
-         "reference": unicode(payment_reference),
-         "senderName": client_name,
-         "senderEmail": client_email,
-         "shippingType": "3",
-         "redirectURL": redirect_url
-    }
-
-    for index, item in enumerate(items, 1):
-        d["itemId%s" % index] = unicode(
-            item.reference.id() if item.reference else '9999')  # if ref is None return fake id 9999
-        d["itemDescription%s" % index] = item.description
-        d["itemAmount%s" % index] = '%.2f' % item.price
-        d["itemQuantity%s" % index] = unicode(item.quantity)
-
-    if address:
-        d.update({
-            "shippingAddressStreet": address.street,
-            "shippingAddressNumber": unicode(address.number),
-            "shippingAddressComplement": address.complement,
-            "shippingAddressDistrict": address.quarter,
-            "shippingAddressPostalCode": address.postalcode,
-            "shippingAddressCity": address.town,
-            "shippingAddressState": address.state,
-            "shippingAddressCountry": "BRA"
-        })
-    return d
\ No newline at end of file
+class GeneratePaymentAsync(GeneratePayment):
+    """
+    Kept for compatibility, it is the same as GeneratePayment. Payment is written with GeneratePayment's write plan
+    only after PagSeguro's answer, so there are no writes left to overlap with the checkout fetch
+    """
+
+
+class GeneratePayments(Command):
+    """
+    Generates payments for several carts at once. Carts are validated together, PagSeguro checkouts are fetched
+    concurrently and the data of all carts is saved with a PaymentWritePlan.
+    Errors are reported per cart on cart_errors, so a invalid cart does not prevent the others payments generation
+    """
+
+    def __init__(self, redirect_url, *carts):
+        super(GeneratePayments, self).__init__()
+        self.redirect_url = redirect_url
+        self.carts = carts
+        self.result = [None] * len(carts)
+        self.checkout_codes = [None] * len(carts)
+        self.cart_errors = [{} for _ in carts]
+
+    def set_up(self):
+        for cart in self.carts:
+            cart.set_up()
+
+    def do_business(self):
+        valid_indexes = self._validate_carts()
+        if not valid_indexes:
+            return
+        write_plan = PaymentWritePlan()
+        plan_cmds = []
+        for index in valid_indexes:
+            cart = self.carts[index]
+            plan_cmd = PlanPaymentWritesCmd(cart.payment_owner, write_plan)
+            plan_cmd.handle_previous(cart)
+            plan_cmd.do_business()
+            plan_cmds.append(plan_cmd)
+        write_plan.allocate_ids()
+
+        contact_cmds = []
+        for index, plan_cmd in izip(valid_indexes, plan_cmds):
+            contact_cmd = ContactPagseguro(self.redirect_url)
+            contact_cmd.handle_previous(plan_cmd)
+            contact_cmds.append((index, contact_cmd))
+        for payment in self._contact_pagseguro(contact_cmds):
+            write_plan.add_status_log(payment)
+        write_plan.commit()
+
+    def _validate_carts(self):
+        valid_indexes = []
+        for index, cart in enumerate(self.carts):
+            try:
+                cart.do_business()
+            except CommandExecutionException:
+                pass
+            if cart.errors:
+                self.cart_errors[index] = cart.errors
+            else:
+                valid_indexes.append(index)
+        return valid_indexes
+
+    def _contact_pagseguro(self, contact_cmds):
+        # Starting all fetches before waiting any of them, so they run concurrently
+        for _, contact_cmd in contact_cmds:
+            contact_cmd.set_up()
+        sent_payments = []
+        for index, contact_cmd in contact_cmds:
+            try:
+                contact_cmd.do_business()
+            except CommandExecutionException:
+                pass
+            if contact_cmd.errors:
+                self.cart_errors[index] = contact_cmd.errors
+            else:
+                self.result[index] = contact_cmd.result
+                self.checkout_codes[index] = contact_cmd.checkout_code
+                sent_payments.append(contact_cmd.result)
+        return sent_payments
+
+
+class _CheckoutData(object):
+    """
+    Data of an existing payment, with the attributes ContactPagseguro reads from previous command
+    """
+
+    def __init__(self, access_data, payment, items):
+        self.access_data = access_data
+        self.result = payment
+        self.items = items
+        self.client_form = None
+        self.address_form = None
+
+
+class CheckoutUrl(Command):
+    """
+    Result is the url of PagSeguro's checkout page for a payment. Payment's checkout code is reused while it is valid,
+    so PagSeguro is contacted, and payment is saved, only if code has expired or payment has none, e.g. because
+    PagSeguro failed on payment generation. Client and address are not sent on renewed checkouts.
+    reused attribute is True if payment's code was reused
+    """
+
+    def __init__(self, payment, redirect_url):
+        super(CheckoutUrl, self).__init__()
+        self.redirect_url = redirect_url
+        self.reused = False
+        self._payment = payment if isinstance(payment, PagSegPayment) else None
+        self._payment_key = to_node_key(payment)
+        self._payment_future = None
+
+    def set_up(self):
+        if self._payment is None:
+            self._payment_future = self._payment_key.get_async()
+
+    def do_business(self):
+        payment = self._payment or self._payment_future.get_result()
+        if not isinstance(payment, PagSegPayment):
+            self.add_error('payment', 'Payment not found for %s' % self._payment_key)
+            return
+        if payment.status not in (STATUS_CREATED, STATUS_SENT_TO_PAGSEGURO):
+            self.add_error('payment', 'Payment already processed by PagSeguro')
+            return
+        checkout_code = payment.valid_checkout_code()
+        if checkout_code:
+            self.reused = True
+            self.result = checkout_page_url(checkout_code)
+            return
+        access_data = FindAccessDataCmd()()
+        if access_data is None:
+            self.add_error('access_data', 'PagSeguro access data not found')
+            return
+        previous_status = payment.status
+        contact_cmd = ContactPagseguro(self.redirect_url)
+        contact_cmd.start_async(_CheckoutData(access_data, payment, SearchItems(payment)()))
+        try:
+            contact_cmd.get_result()
+        except CommandExecutionException:
+            self.update_errors(**contact_cmd.errors)
+            return
+        if payment.status != previous_status:
+            UpdatePaymentAndSaveLog(payment)()
+        else:
+            payment.put()
+            clear_payment_cache([payment])
+        self.result = checkout_page_url(contact_cmd.checkout_code)
+
+
+def _fingerprint_value(value):
+    if isinstance(value, ndb.Model):
+        value = value.key
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    return '' if value is None else unicode(value)
+
+
+def _form_fingerprint(form):
+    return '\x1e'.join(_fingerprint_value(getattr(form, k, None)) for k in sorted(form._fields))
+
+
+def checkout_key(payment_owner, client_email, validate_address_cmd, validate_item_cmds):
+    """
+    @return: key identifying a checkout by its owner, client's email, address and items, in any order. So identical
+    carts have the same key
+    """
+    parts = [_fingerprint_value(to_node_key(payment_owner)), _fingerprint_value(client_email),
+             _form_fingerprint(validate_address_cmd.form)]
+    parts.extend(sorted(_form_fingerprint(cmd.form) for cmd in validate_item_cmds))
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+class DeduplicatedCheckout(Command):
+    """
+    Executes generate_cmd, a GeneratePayment or GeneratePaymentAsync, once for a checkout key within
+    CHECKOUT_DEDUP_SECONDS. Repeated executions, e.g. from double clicks or client retries, get the payment and
+    checkout code generated by the first one, without writes or PagSeguro calls. While the first one is running they
+    wait for it, at most CHECKOUT_DEDUP_WAIT seconds, failing with a checkout error after that.
+    Keys are kept on memcache, so payments are generated again if a key is evicted or memcache fails. A failed
+    generation releases its key, so it can be retried.
+    deduplicated attribute is True if payment was generated by a previous execution
+    """
+
+    def __init__(self, key, generate_cmd, sleep=None):
+        super(DeduplicatedCheckout, self).__init__()
+        self.generate_cmd = generate_cmd
+        self.checkout_code = None
+        self.deduplicated = False
+        self._cache_key = 'gaepagseguro_checkout_%s' % key
+        self._sleep = sleep or time.sleep
+
+    def do_business(self):
+        waited = 0
+        add_failed = False
+        while True:
+            generated = memcache.get(self._cache_key)
+            if generated is None:
+                # key can be neither read nor added when memcache fails, so payment is generated without dedup
+                if add_failed or memcache.add(self._cache_key, _CHECKOUT_PENDING, time=_CHECKOUT_PENDING_SECONDS):
+                    break
+                add_failed = True
+                continue
+            add_failed = False
+            if generated != _CHECKOUT_PENDING:
+                payment_key, self.checkout_code = generated
+                self.result = payment_key.get()
+                self.deduplicated = True
+                return
+            # another execution is generating the payment
+            if waited >= CHECKOUT_DEDUP_WAIT:
+                self.add_error('checkout', 'Checkout already in progress')
+                return
+            self._sleep(_CHECKOUT_POLL_SECONDS)
+            waited += _CHECKOUT_POLL_SECONDS
+        self._generate()
+
+    def _generate(self):
+        generated = False
+        try:
+            try:
+                self.result = self.generate_cmd()
+                self.checkout_code = self.generate_cmd.checkout_code
+                generated = True
+            except CommandExecutionException:
+                self.update_errors(**self.generate_cmd.errors)
+        finally:
+            if generated:
+                memcache.set(self._cache_key, (self.result.key, self.checkout_code), time=CHECKOUT_DEDUP_SECONDS)
+            else:
+                memcache.delete(self._cache_key)
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from datetime import timedelta, datetime
+from decimal import Decimal
+from itertools import izip
+import random
+from gaebusiness.business import Command
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from gaepagseguro.model import STATUSES, PagSegStatusCounterShard, PagSegPayment, PagSegRevenueRollup
+
+# Number of shards of each status counter. More shards support more concurrent updates, but reading counters
+# gets STATUS_COUNTER_SHARDS entities per status
+STATUS_COUNTER_SHARDS = 10
+
+# Number of shards of each status on a revenue rollup period. All payments of a day are saved on the same period, so
+# rollups support as many concurrent updates as counters. Reports get REVENUE_ROLLUP_SHARDS entities per period and
+# status
+REVENUE_ROLLUP_SHARDS = STATUS_COUNTER_SHARDS
+
+_SHARDS_NUMBER = {PagSegStatusCounterShard: STATUS_COUNTER_SHARDS, PagSegRevenueRollup: REVENUE_ROLLUP_SHARDS}
+
+# Max number of entity groups on a cross group transaction
+_XG_MAX_ENTITY_GROUPS = 25
+
+# New payments saved on each transaction with their counters. It leaves room for counter and rollups shards of
+# their 2 possible statuses, and of 2 days and months when they are created around midnight
+XG_NEW_PAYMENTS_PER_TRANSACTION = 15
+
+
+def _all_shards_keys():
+    """
+    @return: list of tuples (status, shard key) for all shards
+    """
+    return [(status, PagSegStatusCounterShard.key_for_shard(status, index))
+            for status in STATUSES for index in xrange(STATUS_COUNTER_SHARDS)]
+
+
+def _day_period(day):
+    return day.strftime('%Y-%m-%d')
+
+
+def _month_period(day):
+    return day.strftime('%Y-%m')
+
+
+def _rollup_shards_keys(period):
+    """
+    @return: list of tuples (status, rollup shard key) for all shards of period
+    """
+    return [(status, PagSegRevenueRollup.key_for_shard(period, status, index))
+            for status in STATUSES for index in xrange(REVENUE_ROLLUP_SHARDS)]
+
+
+def _new_values():
+    return [0, Decimal(0), Decimal(0)]
+
+
+def _add_to_values(values, sign, total, net_amount):
+    values[0] += sign
+    values[1] += sign * (total or 0)
+    values[2] += sign * (net_amount or 0)
+
+
+def _counters_of(status, creation):
+    """
+    @return: list of tuples (model class, key_for_shard args without shard index) of counters affected by a payment
+    """
+    counters = [(PagSegStatusCounterShard, (status,))]
+    if creation is not None:
+        day = creation.date()
+        counters.append((PagSegRevenueRollup, (_day_period(day), status)))
+        counters.append((PagSegRevenueRollup, (_month_period(day), status)))
+    return counters
+
+
+class _Deltas(object):
+    """
+    Sums of changes on counters and rollups. A random shard is chosen once for each counter, so all changes of a
+    batch on the same counter are summed on the same entity
+    """
+
+    def __init__(self):
+        self._by_key = {}
+        self._shard_keys = {}
+
+    def add(self, sign, status, total, net_amount, creation):
+        if status is None:
+            return
+        for model_class, counter in _counters_of(status, creation):
+            key = self._shard_keys.get((model_class, counter))
+            if key is None:
+                shard_index = random.randrange(_SHARDS_NUMBER[model_class])
+                key = model_class.key_for_shard(*(counter + (shard_index,)))
+                self._shard_keys[(model_class, counter)] = key
+            _add_to_values(self._by_key.setdefault(key, _new_values()), sign, total, net_amount)
+
+    def changed_items(self):
+        return [(key, values) for key, values in self._by_key.iteritems() if any(values)]
+
+
+def _put_deltas(deltas, entities=()):
+    """
+    Puts counters shards changed by deltas, and entities, on a single put_multi
+    """
+    keys = [key for key, _ in deltas]
+    shards = [shard or ndb.Model._lookup_model(key.kind())(key=key)
+              for key, shard in zip(keys, ndb.get_multi(keys))] if keys else []
+    for entity, (_, (count, total, net_amount)) in zip(shards, deltas):
+        entity.count += count
+        entity.total += total
+        entity.net_amount += net_amount
+    ndb.put_multi(list(entities) + shards)
+
+
+@ndb.transactional(xg=True)
+def _apply_deltas(deltas):
+    _put_deltas(deltas)
+
+
+@ndb.transactional(xg=True)
+def _save_counted(payments, save, new):
+    saved_payments = [None] * len(payments) if new else ndb.get_multi([p.key for p in payments])
+    # values are kept before save is called, since it may change saved payments
+    saved_values = [saved and saved.counted_values() + (saved.creation,) for saved in saved_payments]
+    result = None
+    if save is None:
+        # payments are put with shards, so creation is set here for their rollups
+        for payment in payments:
+            payment.creation = payment.creation or datetime.now()
+    else:
+        result = save(saved_payments)
+    deltas = _Deltas()
+    for payment, saved in izip(payments, saved_values):
+        if saved is not None:
+            deltas.add(-1, *saved)
+        deltas.add(1, *(payment.counted_values() + (payment.creation,)))
+    _put_deltas(deltas.changed_items(), payments if save is None else ())
+    return result
+
+
+def save_counted_payments(payments, save=None, new=False):
+    """
+    Saves payments on a cross group transaction which also updates status counters and revenue rollups, so counters
+    never drift from saved payments. Payments are read again on the transaction, unless they are new, and counters
+    change by the difference between saved and current values. So concurrent changes of the same payment are not
+    counted twice.
+    The transaction can touch 25 entity groups, and a status change touches 6 shards, so at most 19 entity groups can
+    be saved, or XG_NEW_PAYMENTS_PER_TRANSACTION new payments
+    @param payments: list of PagSegPayment
+    @param save: function which gets the list of saved payments, with None for the ones not found, and must put
+    payments and entities written with them, like their logs. It may change and put saved payments instead of the
+    given ones, which must have the same counted values. It may be called again if the transaction is retried.
+    If it is None, payments are put with shards. It may raise ndb.Rollback, so nothing is saved and None is returned
+    @param new: True if payments were never saved, so they are not read
+    @return: save's return
+    """
+    for payment in payments:
+        # tracked values may be stale, counters are updated from saved ones
+        payment.pop_counters_change()
+    return _save_counted(payments, save, new)
+
+
+def update_status_counters(payments):
+    """
+    Updates status counters and revenue rollups with changes of payments tracked by PagSegPayment.track_counters.
+    It must be called after payments are saved. Changes of all payments are summed and applied on a single
+    transaction, or on one per 25 changed entities for large batches
+    @param payments: list of PagSegPayment. Not tracked payments are ignored
+    """
+    deltas = _Deltas()
+    for payment in payments:
+        change = payment.pop_counters_change()
+        if change is None:
+            continue
+        previous, current = change
+        if previous is not None:
+            deltas.add(-1, *(previous + (payment.creation,)))
+        deltas.add(1, *(current + (payment.creation,)))
+    _apply_changed_deltas(deltas)
+
+
+def _apply_changed_deltas(deltas):
+    """
+    Applies deltas on one transaction per 25 changed entities
+    """
+    changed = deltas.changed_items()
+    for i in xrange(0, len(changed), _XG_MAX_ENTITY_GROUPS):
+        _apply_deltas(changed[i:i + _XG_MAX_ENTITY_GROUPS])
+
+
+def _sum_shards(status_keys, futures, model_class):
+    """
+    @return: dict of status to a not saved model_class instance with the sum of status' shards
+    """
+    result = {status: model_class() for status in STATUSES}
+    for (status, _), future in zip(status_keys, futures):
+        shard = future.get_result()
+        if shard is not None:
+            counter = result[status]
+            counter.count += shard.count
+            counter.total += shard.total
+            counter.net_amount += shard.net_amount
+    return result
+
+
+class GetStatusCounters(Command):
+    """
+    Reads all counters shards with a single get_multi. Result is a dict of status to a PagSegStatusCounterShard,
+    not saved, with the sum of status' shards
+    """
+
+    def __init__(self):
+        super(GetStatusCounters, self).__init__()
+        self._futures = None
+
+    def set_up(self):
+        self._futures = ndb.get_multi_async([key for _, key in _all_shards_keys()])
+
+    def do_business(self):
+        self.result = _sum_shards(_all_shards_keys(), self._futures, PagSegStatusCounterShard)
+
+
+class RevenueReport(Command):
+    """
+    Reads revenue rollups of payments created from start to end date, inclusive, with a single get_multi. Days are
+    UTC ones, like payment's creation. Result is a list of tuples (period, totals) for each day, or for each month if
+    monthly is True, where period is a date, the first day for months, and totals is a dict of status to a not saved
+    PagSegRevenueRollup. totals attribute has the sums of all periods
+    """
+
+    def __init__(self, start, end, monthly=False):
+        super(RevenueReport, self).__init__()
+        self.monthly = monthly
+        self.totals = None
+        self._periods = self._build_periods(start, end)
+        self._futures = None
+
+    def _build_periods(self, start, end):
+        periods = []
+        day = start.replace(day=1) if self.monthly else start
+        while day <= end:
+            if self.monthly:
+                periods.append((day, _month_period(day)))
+                day = (day + timedelta(days=32)).replace(day=1)
+            else:
+                periods.append((day, _day_period(day)))
+                day += timedelta(days=1)
+        return periods
+
+    def set_up(self):
+        keys = [key for _, period in self._periods for _, key in _rollup_shards_keys(period)]
+        self._futures = ndb.get_multi_async(keys)
+
+    def do_business(self):
+        self.result = []
+        self.totals = {status: PagSegRevenueRollup() for status in STATUSES}
+        shards_per_period = len(STATUSES) * REVENUE_ROLLUP_SHARDS
+        for index, (day, period) in enumerate(self._periods):
+            futures = self._futures[index * shards_per_period:(index + 1) * shards_per_period]
+            rollups = _sum_shards(_rollup_shards_keys(period), futures, PagSegRevenueRollup)
+            for status, rollup in rollups.iteritems():
+                total = self.totals[status]
+                total.count += rollup.count
+                total.total += rollup.total
+                total.net_amount += rollup.net_amount
+            self.result.append((day, rollups))
+
+
+class RebuildStatusCounters(Command):
+    """
+    Recomputes status counters and revenue rollups from all payments, one page at a time. All shards are zeroed when
+    no start cursor is given, and each page's values are added to them. At most max_batches pages are read per
+    execution, None meaning all of them. Execute it again with cursor attribute while more attribute is True.
+    Result has the same format of GetStatusCounters, with counters after the execution. A failed execution must be
+    restarted without cursor, since part of its page may have been added. Status changes made while it runs may be
+    lost, so it should be executed when payments are not being updated, e.g. once after installing counters
+    """
+
+    def __init__(self, batch_size=500, start_cursor=None, max_batches=None):
+        super(RebuildStatusCounters, self).__init__()
+        self.batch_size = batch_size
+        self.start_cursor = start_cursor
+        self.max_batches = max_batches
+        self.cursor = start_cursor
+        self.more = True
+
+    def _zero_shards(self):
+        keys = [key for _, key in _all_shards_keys()] + PagSegRevenueRollup.query().fetch(keys_only=True)
+        ndb.put_multi([ndb.Model._lookup_model(key.kind())(key=key) for key in keys])
+
+    def do_business(self):
+        if self.start_cursor is None:
+            self._zero_shards()
+        query = PagSegPayment.query().order(PagSegPayment.key)
+        cursor = Cursor(urlsafe=self.start_cursor) if self.start_cursor else None
+        batches = 0
+        while self.more and (self.max_batches is None or batches < self.max_batches):
+            payments, cursor, more = query.fetch_page(self.batch_size, start_cursor=cursor, use_cache=False,
+                                                      use_memcache=False)
+            deltas = _Deltas()
+            for payment in payments:
+                deltas.add(1, *(payment.counted_values() + (payment.creation,)))
+            _apply_changed_deltas(deltas)
+            self.more = bool(more and cursor)
+            self.cursor = cursor.urlsafe() if cursor else None
+            batches += 1
+            # payments are not kept on context cache, so memory use does not grow with their number
+            ndb.get_context().clear_cache()
+        self.result = GetStatusCounters()()
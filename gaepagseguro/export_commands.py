@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import csv
+from decimal import Decimal
+import json
+from gaebusiness.business import Command
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from gaepagseguro.model import PagSegPayment
+from gaepagseguro.search_commands import PaymentRelationsLoader
+
+EXPORT_FORMAT_CSV = 'csv'
+EXPORT_FORMAT_JSONL = 'jsonl'
+
+_EXPORT_RELATIONS = ['pay_items', 'logs']
+
+_CENTS = Decimal('0.01')
+
+_CSV_HEADER = ['id', 'code', 'status', 'total', 'net_amount', 'creation', 'update', 'items', 'logs']
+
+
+def iter_payment_batches(batch_size=100, start_cursor=None):
+    """
+    Generator of payments pages, ordered by key, with their items and logs loaded in batch.
+    The context cache is cleared after each page, so memory use does not grow with the number of payments
+    @param batch_size: number of payments per page
+    @param start_cursor: urlsafe cursor returned on a previous page, to continue the iteration
+    @return: generator of tuples (payments, urlsafe cursor after the page, more). more is False on last page
+    """
+    query = PagSegPayment.query().order(PagSegPayment.key)
+    cursor = Cursor(urlsafe=start_cursor) if start_cursor else None
+    more = True
+    while more:
+        payments, cursor, more = query.fetch_page(batch_size, start_cursor=cursor, use_cache=False,
+                                                  use_memcache=False)
+        more = bool(more and cursor)
+        if payments:
+            PaymentRelationsLoader(payments, _EXPORT_RELATIONS)()
+        yield payments, cursor.urlsafe() if cursor else None, more
+        ndb.get_context().clear_cache()
+
+
+def _format_datetime(value):
+    return value.isoformat() if value else None
+
+
+def _format_decimal(value):
+    return unicode(value.quantize(_CENTS)) if value is not None else None
+
+
+def payment_to_dict(payment):
+    """
+    @return: dict with payment's data, its items and logs, which must be loaded as payment's attributes
+    """
+    return {'id': payment.key.id(),
+            'code': payment.code,
+            'status': payment.status,
+            'total': _format_decimal(payment.total),
+            'net_amount': _format_decimal(payment.net_amount),
+            'creation': _format_datetime(payment.creation),
+            'update': _format_datetime(payment.update),
+            'items': [{'id': item.key.id() if item.key else None,
+                       'reference': item.reference.urlsafe() if item.reference else None,
+                       'description': item.description,
+                       'price': _format_decimal(item.price),
+                       'quantity': item.quantity} for item in payment.pay_items],
+            'logs': [{'status': log.status, 'creation': _format_datetime(log.creation)} for log in payment.logs]}
+
+
+class JsonLinesPaymentWriter(object):
+    """
+    Writes each payment as a JSON object on its own line
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write_header(self):
+        pass
+
+    def write(self, payments):
+        for payment in payments:
+            self.fileobj.write(json.dumps(payment_to_dict(payment), sort_keys=True) + '\n')
+
+
+class CsvPaymentWriter(object):
+    """
+    Writes each payment as a CSV row, encoded as UTF-8. Items and logs are JSON lists on their own columns
+    """
+
+    def __init__(self, fileobj):
+        self._writer = csv.writer(fileobj)
+
+    def write_header(self):
+        self._writer.writerow(_CSV_HEADER)
+
+    def write(self, payments):
+        for payment in payments:
+            dct = payment_to_dict(payment)
+            dct['items'] = json.dumps(dct['items'], sort_keys=True)
+            dct['logs'] = json.dumps(dct['logs'], sort_keys=True)
+            self._writer.writerow([('' if dct[column] is None else unicode(dct[column])).encode('utf-8')
+                                   for column in _CSV_HEADER])
+
+
+_WRITERS = {EXPORT_FORMAT_CSV: CsvPaymentWriter, EXPORT_FORMAT_JSONL: JsonLinesPaymentWriter}
+
+
+class ExportPayments(Command):
+    """
+    Writes payments, with items and logs, to a file-like object, one page at a time. At most max_batches pages are
+    written per execution, None meaning all of them. Execute it again with cursor attribute, appending to the same
+    file, while more attribute is True. CSV header is written only when no start cursor is given.
+    A page is written only after it is completely read, so a retry from the last saved cursor does not duplicate
+    lines unless the previous execution failed while writing
+    """
+
+    def __init__(self, fileobj, export_format=EXPORT_FORMAT_JSONL, batch_size=100, start_cursor=None,
+                 max_batches=None):
+        super(ExportPayments, self).__init__()
+        self.fileobj = fileobj
+        self.export_format = export_format
+        self.batch_size = batch_size
+        self.start_cursor = start_cursor
+        self.max_batches = max_batches
+        self.cursor = start_cursor
+        self.more = True
+        self.result = 0
+
+    def do_business(self):
+        writer_class = _WRITERS.get(self.export_format)
+        if writer_class is None:
+            self.add_error('export_format', 'Export format must be one of %s' % ', '.join(sorted(_WRITERS)))
+            return
+        writer = writer_class(self.fileobj)
+        if self.start_cursor is None:
+            writer.write_header()
+        batches = iter_payment_batches(self.batch_size, self.start_cursor)
+        for index, (payments, cursor, more) in enumerate(batches):
+            writer.write(payments)
+            self.result += len(payments)
+            self.cursor = cursor
+            self.more = more
+            if self.max_batches is not None and index + 1 >= self.max_batches:
+                break
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+from datetime import datetime, timedelta
 from decimal import Decimal
 from gaeforms.ndb.property import SimpleCurrency, IntegerBounded
 from google.appengine.ext import ndb
@@ -20,16 +21,104 @@ STATUSES = [STATUS_CREATED, STATUS_SENT_TO_PAGSEGURO,
             STATUS_ANALYSIS, STATUS_ACCEPTED, STATUS_AVAILABLE,
             STATUS_DISPUTE, STATUS_RETURNED, STATUS_CANCELLED,STATUS_CHARGEBACK,STATUS_CHARGEBACK_DEBT]
 
+# PagSeguro's checkout codes expire after 2 hours. A margin is kept, so customer has time to finish checkout
+CHECKOUT_CODE_VALIDITY = timedelta(hours=2) - timedelta(minutes=15)
+
+# Opt-in storage mode: when enabled, status changes are appended to PagSegPayment.status_history instead of being
+# saved as PagSegLog nodes connected by PagSegPaymentToLog arcs
+_embedded_status_history = False
+
+
+def set_embedded_status_history(enabled):
+    global _embedded_status_history
+    _embedded_status_history = enabled
+
+
+def is_embedded_status_history():
+    return _embedded_status_history
+
+
+# Opt-in storage mode: when enabled, a snapshot of payment's items is saved on PagSegPayment.item_snapshot, so items
+# are read with the payment instead of walking PagSegPaymentToItem arcs. Arcs and items are still saved
+_item_snapshot = False
+
+
+def set_item_snapshot(enabled):
+    global _item_snapshot
+    _item_snapshot = enabled
+
+
+def is_item_snapshot():
+    return _item_snapshot
+
+
+# Payments saved before PagSegPayment.owner_key existed are found by owner's payments search only after their
+# migration. Until it is marked as done, the search falls back to ToPagSegPayment arcs on its last page
+_payment_owners_migrated = False
+
+
+def set_payment_owners_migrated(migrated):
+    global _payment_owners_migrated
+    _payment_owners_migrated = migrated
+
+
+def is_payment_owners_migrated():
+    return _payment_owners_migrated
+
 
 class PagSegAccessData(Node):
     email = ndb.StringProperty(required=True, indexed=False)
     token = ndb.StringProperty(required=True, indexed=False)
 
 
+class PagSegReconciliation(Node):
+    '''
+    Checkpoint of a reconciliation between PagSeguro's transactions of a date range and local payments.
+    page is the next search page to be processed
+    '''
+    initial_date = ndb.DateTimeProperty(required=True, indexed=False)
+    final_date = ndb.DateTimeProperty(required=True, indexed=False)
+    page = ndb.IntegerProperty(default=1, indexed=False)
+    total_pages = ndb.IntegerProperty(indexed=False)
+    transactions_checked = ndb.IntegerProperty(default=0, indexed=False)
+    payments_updated = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False)
+
+
 class PagSegLog(Node):
     status = ndb.StringProperty(required=True, choices=STATUSES, indexed=False)
 
 
+class PagSegStatusEntry(ndb.Model):
+    '''
+    Status change embedded on PagSegPayment.status_history. It has the same properties of PagSegLog
+    '''
+    status = ndb.StringProperty(required=True, choices=STATUSES, indexed=False)
+    creation = ndb.DateTimeProperty(indexed=False)
+
+
+class PagSegItemSnapshot(ndb.Model):
+    '''
+    Copy of a PagSegItem embedded on PagSegPayment.item_snapshot. Items never change after checkout, so it is kept
+    in sync with item nodes
+    '''
+    item_key = ndb.KeyProperty(indexed=False)
+    reference = ndb.KeyProperty(indexed=False)
+    description = ndb.TextProperty(required=True)
+    price = SimpleCurrency(required=True, indexed=False)
+    quantity = ndb.IntegerProperty(required=True, indexed=False)
+    creation = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def from_item(cls, item):
+        return cls(item_key=item.key, reference=item.reference, description=item.description, price=item.price,
+                   quantity=item.quantity, creation=item.creation)
+
+    def to_item(self):
+        return PagSegItem(key=self.item_key, reference=self.reference, description=self.description,
+                          price=self.price, quantity=self.quantity, creation=self.creation)
+
+
 class PagSegPayment(Node):
     # code returned from Pagseguro after payment generation
     code = ndb.StringProperty()
@@ -37,12 +126,125 @@ class PagSegPayment(Node):
     total = SimpleCurrency()
     net_amount = SimpleCurrency()
     update=ndb.DateTimeProperty(auto_now=True)
+    # last checkout code returned from PagSeguro and when it was issued, so checkout page is reused while valid
+    checkout_code = ndb.StringProperty(indexed=False)
+    checkout_issued = ndb.DateTimeProperty(indexed=False)
+    # origin of ToPagSegPayment arc, copied so owner's payments can be paginated by a query
+    owner_key = ndb.KeyProperty()
+    # append only status history, used instead of logs when embedded status history is enabled
+    status_history = ndb.LocalStructuredProperty(PagSegStatusEntry, repeated=True)
+    # True when status_history has all status changes, because payment was created with embedded status history or
+    # its logs were migrated. Otherwise logs saved before enabling it are searched too
+    status_history_complete = ndb.BooleanProperty(default=False, indexed=False)
+    # copy of payment's items, used instead of arcs search when item snapshot is enabled
+    item_snapshot = ndb.LocalStructuredProperty(PagSegItemSnapshot, repeated=True)
+
+    def append_status_history(self):
+        self.status_history.append(PagSegStatusEntry(status=self.status, creation=datetime.now()))
+
+    def set_item_snapshot(self, items):
+        """
+        Copies items to item_snapshot. Items must have keys, so they can be rebuilt with their ids
+        @param items: list of PagSegItem
+        """
+        self.item_snapshot = [PagSegItemSnapshot.from_item(i) for i in items]
+
+    def snapshot_items(self):
+        return [entry.to_item() for entry in self.item_snapshot]
+
+    def set_checkout_code(self, checkout_code):
+        self.checkout_code = checkout_code
+        self.checkout_issued = datetime.now()
+
+    def valid_checkout_code(self):
+        """
+        @return: checkout code if it was issued less than CHECKOUT_CODE_VALIDITY ago, otherwise None
+        """
+        if self.checkout_code and self.checkout_issued and \
+                        datetime.now() - self.checkout_issued < CHECKOUT_CODE_VALIDITY:
+            return self.checkout_code
+
+    def counted_values(self):
+        """
+        @return: tuple (status, total, net_amount), the values payment is counted with on status counters
+        """
+        return self.status, self.total, self.net_amount
+
+    def track_counters(self, new=False):
+        """
+        Keeps current counted values, before status or net amount are changed, so status counters are updated
+        with the difference after payment is saved. New payments were not counted before.
+        Values are kept only once, until pop_counters_change is called
+        """
+        if not getattr(self, '_counters_tracked', False):
+            self._counters_tracked = True
+            self._previous_counted_values = None if new else self.counted_values()
+
+    def pop_counters_change(self):
+        """
+        @return: tuple (previous counted values, current counted values) or None if payment was not tracked.
+        previous values are None for new payments
+        """
+        if not getattr(self, '_counters_tracked', False):
+            return None
+        self._counters_tracked = False
+        return self._previous_counted_values, self.counted_values()
 
     @classmethod
     def query_by_code(cls, code):
         return cls.query(cls.code == code)
 
 
+class PagSegCodeIndex(ndb.Model):
+    '''
+    Maps a PagSeguro's transaction code, used as key name, to its payment. So payments are found by code with a
+    strongly consistent get, which ndb also caches, instead of a query
+    '''
+    payment = ndb.KeyProperty(PagSegPayment, required=True, indexed=False)
+
+    @classmethod
+    def key_for_code(cls, code):
+        return ndb.Key(cls, code)
+
+    @classmethod
+    def build(cls, payment):
+        return cls(key=cls.key_for_code(payment.code), payment=payment.key)
+
+
+class PagSegStatusCounterShard(ndb.Model):
+    '''
+    Shard of a status counter, with number of payments in a status and sums of their total and net amount.
+    Key name is built from status and shard index. Shards values can be negative, only their sum is meaningful
+    '''
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    total = SimpleCurrency(lower=None, default=0, indexed=False)
+    net_amount = SimpleCurrency(lower=None, default=0, indexed=False)
+
+    @classmethod
+    def key_for_shard(cls, status, index):
+        return ndb.Key(cls, '%s-%s' % (status, index))
+
+
+class PagSegRevenueRollup(ndb.Model):
+    '''
+    Shard of revenue totals of payments created on a period, a day or a month, which are currently in a status.
+    Key name is built from period, status and shard index. Like counters, only the sum of shards is meaningful
+    '''
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    total = SimpleCurrency(lower=None, default=0, indexed=False)
+    net_amount = SimpleCurrency(lower=None, default=0, indexed=False)
+
+    @classmethod
+    def key_for_shard(cls, period, status, index):
+        return ndb.Key(cls, '%s-%s-%s' % (period, status, index))
+
+    def fee(self):
+        """
+        @return: PagSeguro's fee, the difference between gross total and net amount
+        """
+        return self.total - self.net_amount
+
+
 class PagSegPaymentToLog(Arc):
     origin = ndb.KeyProperty(PagSegPayment, required=True)
     destination = ndb.KeyProperty(PagSegLog, required=True)
@@ -3,15 +3,25 @@
 from __future__ import absolute_import, unicode_literals
 from gaegraph.business_base import DestinationsSearch
 
-from gaepagseguro.admin_commands import FindAccessDataCmd, CreateOrUpdateAccessData
+from gaepagseguro.admin_commands import FindAccessDataCmd, CreateOrUpdateAccessData, MigrateLogsToStatusHistory, \
+    MigratePaymentOwners
 from gaepagseguro.search_commands import PaymentsByStatusSearch, AllPaymentsSearch, SearchLogs, SearchOwnerPayments, \
-    SearchItems, GetPayment
-from gaepagseguro.connection_commands import GeneratePayment
+    SearchItems, GetPayment, PaymentsQuerySearch, PaymentRowsSearch
+from gaepagseguro.connection_commands import GeneratePayment, GeneratePayments, GeneratePaymentAsync, CheckoutUrl, \
+    checkout_page_url, DeduplicatedCheckout, checkout_key
 from gaepagseguro.model import STATUSES, ToPagSegPayment, PagSegPaymentToLog, PagSegPaymentToItem, STATUS_CREATED, \
     STATUS_SENT_TO_PAGSEGURO, STATUS_ANALYSIS, STATUS_ACCEPTED, STATUS_AVAILABLE, STATUS_CHARGEBACK_DEBT, \
-    STATUS_CHARGEBACK, STATUS_CANCELLED, STATUS_RETURNED, STATUS_DISPUTE
-from gaepagseguro.update_commands import FetchNotificationAndUpdatePayment, ProcessExternalPaymentCmd
-from gaepagseguro.validation_commands import ValidateAddressCmd, ValidateItemCmd, PaymentForm
+    STATUS_CHARGEBACK, STATUS_CANCELLED, STATUS_RETURNED, STATUS_DISPUTE, set_embedded_status_history, \
+    set_item_snapshot, set_payment_owners_migrated
+from gaepagseguro.update_commands import FetchNotificationAndUpdatePayment, ProcessExternalPaymentCmd, \
+    ProcessNotifications, EnqueueNotification, ProcessNotificationTask, NOTIFICATION_CODE_PARAM
+from gaepagseguro.reconciliation_commands import StartReconciliation, ReconcileTransactions
+from gaepagseguro.circuit_breaker import circuit_metrics
+from gaepagseguro.rate_limiter import set_rate_budget, POLICY_WAIT, POLICY_FAIL_FAST, ENDPOINT_CHECKOUT, \
+    ENDPOINT_NOTIFICATIONS, ENDPOINT_TRANSACTIONS
+from gaepagseguro.counter_commands import GetStatusCounters, RebuildStatusCounters, RevenueReport
+from gaepagseguro.export_commands import ExportPayments, EXPORT_FORMAT_JSONL, EXPORT_FORMAT_CSV
+from gaepagseguro.validation_commands import ValidateAddressCmd, ValidateItemCmd, PaymentForm, ValidateCartCmd
 
 
 PAYMENT_STATUSES = STATUSES
@@ -47,11 +57,96 @@ def create_or_update_access_data_cmd(email, token):
     return CreateOrUpdateAccessData(email, token)
 
 
+def enable_embedded_status_history(enabled=True):
+    """
+    Opt-in storage mode where status changes are appended to payment's status_history property instead of saving a
+    log node and an arc for each one. search_logs and payment_form read from it transparently.
+    Call it on app initialization and run migrate_logs_to_status_history to fold logs of existing payments
+    @param enabled: True to enable the mode, False to go back to logs
+    """
+    set_embedded_status_history(enabled)
+
+
+def enable_item_snapshot(enabled=True):
+    """
+    Opt-in storage mode where a copy of payment's items is saved on the payment itself, so pay_items relation and
+    search_items are served with the payment, without searching arcs and items. Arcs and items are still saved.
+    Payments saved before enabling it fall back to arcs search
+    @param enabled: True to enable the mode, False to go back to arcs search only
+    """
+    set_item_snapshot(enabled)
+
+
+def mark_payment_owners_migrated(migrated=True):
+    """
+    Marks migrate_payment_owners as done, so search_payments stops searching owner's arcs for payments without
+    owner_key on its last page. Call it on app initialization once the migration has run
+    @param migrated: True when all payments have owner_key, False to search arcs again
+    """
+    set_payment_owners_migrated(migrated)
+
+
+def configure_rate_limit(endpoint, rate, capacity, policy=POLICY_WAIT, max_wait=5):
+    """
+    Sets the budget of calls to a PagSeguro's endpoint, shared by all instances through memcache. Call it on app
+    initialization of all instances with the same values. Endpoints calls are not limited until it is called
+    @param endpoint: one of ENDPOINT_CHECKOUT, ENDPOINT_NOTIFICATIONS or ENDPOINT_TRANSACTIONS
+    @param rate: calls per second. None disables endpoint's limit
+    @param capacity: max calls on a burst
+    @param policy: POLICY_WAIT to wait for budget at most max_wait seconds, or POLICY_FAIL_FAST. Calls not made are
+    reported with a rate_limit error
+    """
+    set_rate_budget(endpoint, rate, capacity, policy, max_wait)
+
+
+def circuit_breaker_metrics(endpoint):
+    """
+    Calls to PagSeguro's endpoints are rejected at once while their circuit is open, after consecutive failures
+    @param endpoint: one of ENDPOINT_CHECKOUT, ENDPOINT_NOTIFICATIONS or ENDPOINT_TRANSACTIONS
+    @return: dict with the number of times endpoint's circuit was opened, half opened and closed, and of rejected calls
+    """
+    return circuit_metrics(endpoint)
+
+
+def migrate_logs_to_status_history(page_size=100, start_cursor=None):
+    """
+    Returns a command that copies the logs of a page of payments to their embedded status history
+    @param page_size: number of payments migrated per execution
+    @param start_cursor: cursor from previous execution to continue migration
+    @return: Command. Its cursor and more attributes indicate how to continue migration
+    """
+    return MigrateLogsToStatusHistory(page_size, start_cursor)
+
+
+def migrate_payment_owners(page_size=100, start_cursor=None):
+    """
+    Returns a command that copies the owner of a page of payments to their owner_key property. It must be executed
+    for payments saved before it existed, so search_payments finds them by query instead of searching arcs. After it
+    runs to the end, call mark_payment_owners_migrated
+    @param page_size: number of payments migrated per execution
+    @param start_cursor: cursor from previous execution to continue migration
+    @return: Command. Its cursor and more attributes indicate how to continue migration
+    """
+    return MigratePaymentOwners(page_size, start_cursor)
+
+
 def pagseguro_url(transaction_code):
     """
     Returns the url which the user must be sent after the payment generation
     """
-    return str("https://pagseguro.uol.com.br/v2/checkout/payment.html?code=%s" % transaction_code)
+    return checkout_page_url(transaction_code)
+
+
+def checkout_url(payment, redirect_url):
+    """
+    Returns a command whose result is the url which the user must be sent to pay a payment already generated, e.g.
+    when the customer comes back to pay page. Payment's checkout code is reused while valid, PagSeguro is contacted
+    only when it has expired
+    @param payment: payment or its key or id
+    @param redirect_url: the url where payment status change must be sent, used only if checkout is renewed
+    @return: Command. Its reused attribute is True if PagSeguro was not contacted
+    """
+    return CheckoutUrl(payment, redirect_url)
 
 
 def generate_payment(redirect_url, client_name, client_email, payment_owner, validate_address_cmd, *validate_item_cmds):
@@ -72,6 +167,61 @@ def generate_payment(redirect_url, client_name, client_email, payment_owner, val
                            *validate_item_cmds)
 
 
+def generate_payment_once(idempotency_key, redirect_url, client_name, client_email, payment_owner,
+                          validate_address_cmd, *validate_item_cmds):
+    """
+    Same as generate_payment, but repeated calls for the same checkout within CHECKOUT_DEDUP_SECONDS, e.g. from
+    double clicks on checkout button, return the payment and checkout code generated by the first call, without
+    saving data or contacting PagSeguro again.
+
+    @param idempotency_key: string identifying the checkout. If None, it is derived from payment owner, client's
+    email, address and items, so identical carts are generated once
+    Other parameters are the same from generate_payment function
+    @return: A command that generate the payment when executed. Its deduplicated attribute is True if payment was
+    generated by a previous call
+    """
+    if idempotency_key is None:
+        idempotency_key = checkout_key(payment_owner, client_email, validate_address_cmd, validate_item_cmds)
+    return DeduplicatedCheckout(idempotency_key,
+                                GeneratePayment(redirect_url, client_name, client_email, payment_owner,
+                                                validate_address_cmd, *validate_item_cmds))
+
+
+def generate_payment_async(redirect_url, client_name, client_email, payment_owner, validate_address_cmd,
+                           *validate_item_cmds):
+    """
+    Kept for compatibility, it is the same as generate_payment. Payment is saved with a single write plan after
+    pagseguro's answer, so there are no writes left to overlap with the checkout fetch.
+    Parameters are the same from generate_payment function
+    @return: A command that generate the payment when executed
+    """
+    return GeneratePaymentAsync(redirect_url, client_name, client_email, payment_owner, validate_address_cmd,
+                                *validate_item_cmds)
+
+
+def payment_cart(client_name, client_email, payment_owner, validate_address_cmd, *validate_item_cmds):
+    """
+    Build a cart to be used with generate_payments function
+    Parameters are the same from generate_payment function
+    @return: A command that validates the cart
+    """
+    return ValidateCartCmd(payment_owner, client_name, client_email, validate_address_cmd, *validate_item_cmds)
+
+
+def generate_payments(redirect_url, *carts):
+    """
+    Function used to generate several payments on pagseguro at once.
+    Carts are validated together, saved with batch puts and pagseguro is contacted concurrently for each one.
+
+    @param redirect_url: the url where payment status change must be sent
+    @param carts: list of carts generated with payment_cart function
+    @return: A command that generate the payments when executed. Its result is a list of payments, one for each cart,
+    with None for carts that failed. Payments of carts rejected by pagseguro are saved anyway, with created status.
+    checkout_codes and cart_errors attributes are lists with checkout code and errors for each cart
+    """
+    return GeneratePayments(redirect_url, *carts)
+
+
 def payment_notification(notification_code):
     """
     Used when PagSeguro redirect user after payment
@@ -80,10 +230,133 @@ def payment_notification(notification_code):
     Returns a command that contacts pagseguro site and change payment status and its history according to status code
     (https://pagseguro.uol.com.br/v3/guia-de-integracao/api-de-notificacoes.html)
      The command keep the entire xml string on xml attribute if the user need more details
+     Repeated deliveries of a notification, or of a status the payment already has, are skipped without writes and
+     flagged on duplicated attribute. See update_commands.NOTIFICATION_DEDUP_TTL
     """
     return FetchNotificationAndUpdatePayment(notification_code)
 
 
+def enqueue_notification(notification_code, worker_url, queue_name='default', retry_limit=None):
+    """
+    Used on the handler receiving PagSeguro's notification POST instead of payment_notification, so it answers
+    PagSeguro quickly. The notification code is sent to worker_url by a push queue task, whose handler must call
+    process_notification_task with it.
+    Task rate and concurrency are configured on queue_name definition on app's queue.yaml, e.g.:
+
+        queue:
+        - name: pagseguro
+          rate: 5/s
+          max_concurrent_requests: 10
+
+    @param notification_code: the notification code posted by PagSeguro
+    @param worker_url: url of the handler that processes the notification
+    @param queue_name: name of push queue used
+    @param retry_limit: max number of retries. If None, queue's configuration is used
+    @return: A command that adds the task when executed
+    """
+    return EnqueueNotification(notification_code, worker_url, queue_name, retry_limit)
+
+
+def process_notification_task(notification_code, deadline=10):
+    """
+    Used on worker handler to process a notification enqueued with enqueue_notification. The notification code is on
+    request's NOTIFICATION_CODE_PARAM param. Exceptions raised on transient errors must not be caught, so the task
+    fails and the queue retries it
+    @param notification_code: the notification code
+    @param deadline: seconds to wait for PagSeguro's answer
+    @return: A command that contacts pagseguro site and change payment status like payment_notification
+    """
+    return ProcessNotificationTask(notification_code, deadline)
+
+
+def process_notifications(notification_codes, max_concurrent_fetches=10):
+    """
+    Same as payment_notification, but for several notifications at once, e.g. those queued during a PagSeguro outage.
+    Notifications are fetched concurrently and payments and logs are saved with batch puts
+    @param notification_codes: list of notification codes
+    @param max_concurrent_fetches: max number of notifications fetched at same time
+    @return: A command that process the notifications when executed. Its result is a list with the updated payment
+    of each code, with None for codes that failed. notification_errors attribute is a list with errors of each code
+    """
+    return ProcessNotifications(notification_codes, max_concurrent_fetches)
+
+
+def start_reconciliation(initial_date, final_date):
+    """
+    Creates a reconciliation of PagSeguro's transactions with local payments, used to recover lost notifications.
+    PagSeguro limits the search range to 30 days
+    @param initial_date: datetime of the beginning of transactions date range
+    @param final_date: datetime of the end of transactions date range
+    @return: A command that saves the reconciliation when executed. It must be processed with reconcile_transactions
+    """
+    return StartReconciliation(initial_date, final_date)
+
+
+def reconcile_transactions(reconciliation, max_pages=1, max_page_results=100, deadline=None):
+    """
+    Returns a command that processes pages of PagSeguro's transactions search, updating status of payments which
+    differ from PagSeguro's. Progress is saved on reconciliation, so the command can be executed on sequential
+    requests, like chained tasks, each one respecting the request deadline
+    @param reconciliation: the reconciliation, or its id, created with start_reconciliation
+    @param max_pages: max number of pages processed on a execution
+    @param max_page_results: number of transactions per page
+    @param deadline: seconds to wait for each PagSeguro's search page
+    @return: Command whose result is the reconciliation. Execute it again while its done attribute is False
+    """
+    return ReconcileTransactions(reconciliation, max_pages, max_page_results, deadline)
+
+
+def status_counters():
+    """
+    Returns a command that reads, for each status, the number of payments and sums of their total and net amount.
+    They are read from sharded counters updated on every status change, without searching payments
+    @return: Command whose result is a dict of status to an object with count, total and net_amount attributes
+    """
+    return GetStatusCounters()
+
+
+def revenue_report(start, end, monthly=False):
+    """
+    Returns a command that reads, for each status, gross total, net amount and PagSeguro's fee of payments created on
+    a date range. Only daily or monthly rollups, updated on every status change, are read
+    @param start: first date of the range
+    @param end: last date of the range, inclusive
+    @param monthly: True to group by month, using monthly rollups, False to group by day
+    @return: Command whose result is a list of tuples (period date, dict of status to an object with count, total,
+    net_amount attributes and fee method). Its totals attribute has the same dict for the whole range
+    """
+    return RevenueReport(start, end, monthly)
+
+
+def rebuild_status_counters(batch_size=500, start_cursor=None, max_batches=None):
+    """
+    Returns a command that recomputes status counters and revenue rollups from all payments. It must be executed
+    once for payments saved before counters existed, or to fix counters, while payments are not being updated
+    @param batch_size: number of payments fetched per datastore call
+    @param start_cursor: cursor from previous execution to continue rebuilding. Counters are zeroed when it is None
+    @param max_batches: max number of pages read on each execution. None reads all pages
+    @return: Command whose result has the same format of status_counters. Execute a new one with its cursor
+    attribute while its more attribute is True
+    """
+    return RebuildStatusCounters(batch_size, start_cursor, max_batches)
+
+
+def export_payments(fileobj, export_format=EXPORT_FORMAT_JSONL, batch_size=100, start_cursor=None,
+                    max_batches=None):
+    """
+    Returns a command that writes all payments, with their items and logs, to a file-like object, like a Cloud
+    Storage file opened for writing. Payments are read page by page, so memory use does not depend on their number
+    @param fileobj: object with a write method receiving str
+    @param export_format: EXPORT_FORMAT_JSONL for JSON Lines or EXPORT_FORMAT_CSV for CSV
+    @param batch_size: number of payments per page
+    @param start_cursor: cursor from previous execution to continue the export
+    @param max_batches: max number of pages per execution, e.g. to respect request deadline. None writes all pages
+    @return: Command whose result is the number of exported payments. Execute a new one with its cursor attribute,
+    on the same file, while its more attribute is True
+    """
+    return ExportPayments(fileobj, export_format, batch_size, start_cursor, max_batches)
+
+
 def validate_address_cmd(street, number, quarter, postalcode, town, state, complement="Sem Complemento"):
     """
     Build an address form to be used with payment function
@@ -105,27 +378,38 @@ def validate_item_cmd(description, price, quantity, reference=None):
     return ValidateItemCmd(description=description, price=price, quantity=quantity, reference=reference)
 
 
-def get_payment(payment_id, relations=None):
+def get_payment(payment_id, relations=None, use_cache=True):
     """
-    Search payment on BD given its payment id
+    Search payment on BD given its payment id. Payment and relations are cached on memcache until payment is updated
     @param payment_id: the payment id
     @param relations: list of relations to bring with payment objects. possible values on list: logs, pay_items, owner
+    @param use_cache: False to always read from BD
     :return:
     """
-    return GetPayment(payment_id, relations)
+    return GetPayment(payment_id, relations, use_cache)
 
 
-def search_payments(owner, relations=None):
+def search_payments(owner, relations=None, payment_status=None, page_size=20, start_cursor=None, offset=0,
+                    use_cache=False, cache_begin=True):
     """
-    Returns a command to search owner's payment
+    Returns a command to search a page of owner's payments ordered by update desc. Payments saved before owner_key
+    existed are appended to the last page, searched by owner's arcs, until mark_payment_owners_migrated is called
     @param: the owner of payments
     @param relations: list of relations to bring with payment objects. possible values on list: logs, pay_items, owner
+    @param payment_status: The payment status. If None is going to return results independent from status
+    @param page_size: number of payments per page
+    @param start_cursor: cursor to continue the search
+    @param offset: offset number of payment on search
+    @param use_cache: indicates with should use cache or not for results. Cached pages do not show new payments
+    @param cache_begin: indicates with should use cache on beginning or not for results
+    @return: Command. Its cursor and more attributes indicate how to get next page
     """
-    return SearchOwnerPayments(owner, relations)
+    return SearchOwnerPayments(owner, payment_status, page_size, start_cursor, offset, use_cache, cache_begin,
+                               relations)
 
 
 def search_all_payments(payment_status=None, page_size=20, start_cursor=None, offset=0, use_cache=True,
-                        cache_begin=True, relations=None):
+                        cache_begin=True, relations=None, rows=False):
     """
     Returns a command to search all payments ordered by creation desc
     @param payment_status: The payment status. If None is going to return results independent from status
@@ -135,14 +419,45 @@ def search_all_payments(payment_status=None, page_size=20, start_cursor=None, of
     @param use_cache: indicates with should use cache or not for results
     @param cache_begin: indicates with should use cache on beginning or not for results
     @param relations: list of relations to bring with payment objects. possible values on list: logs, pay_items, owner
+    @param rows: if True, results are PaymentRow objects read by a projection query, with only id, status, total
+    and update. Cache and relations are not used, full payments are loaded with PaymentRow.payment or
+    hydrate_payment_rows
     @return: Returns a command to search all payments ordered by creation desc
     """
+    if rows:
+        return PaymentRowsSearch(payment_status, page_size, start_cursor, offset)
     if payment_status:
         return PaymentsByStatusSearch(payment_status, page_size, start_cursor, offset, use_cache,
                                       cache_begin, relations)
     return AllPaymentsSearch(page_size, start_cursor, offset, use_cache, cache_begin, relations)
 
 
+def query_payments(statuses=None, owner=None, update_start=None, update_end=None, creation_start=None,
+                   creation_end=None, min_total=None, page_size=20, start_cursor=None, offset=0, use_cache=False,
+                   relations=None):
+    """
+    Returns a command to search a page of payments matching all given filters. Date windows include start and
+    exclude end. The most selective range is used on the query and results are sorted desc by its property, or by
+    update desc without ranges. Composite indexes on gaepagseguro/index.yaml must be deployed
+    @param statuses: list of accepted payment status. If None, any status is accepted
+    @param owner: the owner of payments
+    @param update_start: minimum update datetime
+    @param update_end: update datetime limit
+    @param creation_start: minimum creation datetime
+    @param creation_end: creation datetime limit
+    @param min_total: minimum payment's total
+    @param page_size: number of payments fetched per page. Pages can have fewer payments after ranges not used on
+    query are applied
+    @param start_cursor: cursor to continue the search
+    @param offset: offset number of payment on search
+    @param use_cache: indicates with should use cache or not for results. Cached pages do not show new payments
+    @param relations: list of relations to bring with payment objects. possible values on list: logs, pay_items, owner
+    @return: Command. Its cursor and more attributes indicate how to get next page
+    """
+    return PaymentsQuerySearch(statuses, owner, update_start, update_end, creation_start, creation_end, min_total,
+                               page_size, start_cursor, offset, use_cache, relations=relations)
+
+
 def search_items(payment):
     """
     Returns a command that returns the items from a payment
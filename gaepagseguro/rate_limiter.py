@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import time
+from google.appengine.api import memcache
+
+# PagSeguro's endpoints, each one with its own budget
+ENDPOINT_CHECKOUT = 'checkout'
+ENDPOINT_NOTIFICATIONS = 'notifications'
+ENDPOINT_TRANSACTIONS = 'transactions'
+
+# Policies for calls made when there is no token available: wait for it, at most budget's max_wait seconds, or fail
+POLICY_WAIT = 'wait'
+POLICY_FAIL_FAST = 'fail_fast'
+
+# Max compare and set attempts on a bucket updated concurrently by other instances
+_CAS_ATTEMPTS = 5
+
+# Tolerance on tokens sums, so a wait computed for one token is not missed by float rounding
+_TOKENS_EPSILON = 1e-9
+
+
+class RateBudget(object):
+    """
+    Budget of an endpoint: calls are limited to rate per second, allowing bursts of up to capacity calls
+    """
+
+    def __init__(self, rate, capacity, policy=POLICY_WAIT, max_wait=5):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.policy = policy
+        self.max_wait = max_wait
+
+
+# endpoint -> RateBudget. Endpoints without budget are not limited, which is the default for all of them
+_budgets = {}
+
+
+def set_rate_budget(endpoint, rate, capacity, policy=POLICY_WAIT, max_wait=5):
+    """
+    Sets the budget of endpoint's calls on this instance. All instances must be configured with the same budget.
+    If rate is None, endpoint's calls are not limited
+    """
+    _budgets[endpoint] = RateBudget(rate, capacity, policy, max_wait) if rate is not None else None
+
+
+def get_rate_budget(endpoint):
+    return _budgets.get(endpoint)
+
+
+def _bucket_cache_key(endpoint):
+    return 'gaepagseguro_rate_%s' % endpoint
+
+
+class TokenBucket(object):
+    """
+    Token bucket shared by all instances on memcache, as a tuple (tokens, last update time), changed with compare
+    and set. Tokens are refilled from elapsed time on each call, so no background job is needed. If bucket is
+    evicted it starts full again, and if memcache fails calls are not limited
+    """
+
+    def __init__(self, endpoint, budget, clock=time.time, sleep=time.sleep):
+        self.key = _bucket_cache_key(endpoint)
+        self.budget = budget
+        self._clock = clock
+        self._sleep = sleep
+        self._client = memcache.Client()
+
+    def _take(self):
+        """
+        @return: 0 if a token was taken, otherwise the estimated seconds until one is available
+        """
+        budget = self.budget
+        add_failed = False
+        for _ in xrange(_CAS_ATTEMPTS):
+            now = self._clock()
+            state = self._client.gets(self.key)
+            if state is None:
+                if add_failed:
+                    # bucket can be neither read nor added, so memcache is failing and calls are not limited
+                    return 0
+                if self._client.add(self.key, (budget.capacity - 1, now)):
+                    return 0
+                add_failed = True
+                continue
+            add_failed = False
+            tokens, last_update = state
+            tokens = min(budget.capacity, tokens + max(0, now - last_update) * budget.rate)
+            if tokens + _TOKENS_EPSILON < 1:
+                return (1 - tokens) / budget.rate
+            if self._client.cas(self.key, (tokens - 1, now)):
+                return 0
+        # too many concurrent calls, so waiting for the next token
+        return 1 / budget.rate
+
+    def acquire(self):
+        """
+        Takes a token, waiting for it according to budget's policy
+        @return: True if a token was taken, False if call must not be made
+        """
+        waited = 0
+        while True:
+            wait = self._take()
+            if wait == 0:
+                return True
+            if self.budget.policy == POLICY_FAIL_FAST or waited + wait > self.budget.max_wait:
+                return False
+            self._sleep(wait)
+            waited += wait
+
+
+def acquire_call(endpoint):
+    """
+    Must be called before each outbound call to PagSeguro
+    @return: True if call can be made, False if endpoint's budget is exhausted
+    """
+    budget = _budgets.get(endpoint)
+    return budget is None or TokenBucket(endpoint, budget).acquire()
+
+
+def rate_limit_error(endpoint):
+    return 'PagSeguro %s calls rate limit exceeded' % endpoint
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from itertools import izip
+from gaebusiness.business import Command
+from gaebusiness.gaeutil import UrlFetchCommand
+from gaegraph.model import to_node_key
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+from gaepagseguro.admin_commands import FindAccessDataCmd
+from gaepagseguro.model import PagSegReconciliation, PagSegPayment, PagSegCodeIndex
+from gaepagseguro.circuit_breaker import ResilientFetch
+from gaepagseguro.rate_limiter import ENDPOINT_TRANSACTIONS
+from gaepagseguro.save_commands import PaymentWritePlan
+from gaepagseguro.search_commands import IN_FILTER_MAX_VALUES
+from gaepagseguro.transaction_parser import parse_transaction_search
+from gaepagseguro.update_commands import XML_STATUS_TO_MODEL_STATUS, update_payment_data
+
+TRANSACTIONS_SEARCH_URL = 'https://ws.pagseguro.uol.com.br/v2/transactions'
+
+_DATE_FORMAT = '%Y-%m-%dT%H:%M'
+
+
+class StartReconciliation(Command):
+    def __init__(self, initial_date, final_date):
+        super(StartReconciliation, self).__init__()
+        self.result = PagSegReconciliation(initial_date=initial_date, final_date=final_date)
+
+    def do_business(self):
+        if self.result.final_date <= self.result.initial_date:
+            self.add_error('final_date', 'Final date must be after initial date')
+
+    def commit(self):
+        return self.result
+
+
+class ReconcileTransactions(Command):
+    """
+    Processes, at most, max_pages pages of PagSeguro's transactions search for reconciliation's date range.
+    Each transaction is matched to a local payment by reference, which is payment's id, or by code. Only payments
+    whose status differs from PagSeguro's are updated, with a log for the new status, and they are saved in batch
+    for each page. Reconciliation is saved after each page, so next execution continues from the next one.
+    Execute it again, e.g. on chained tasks, until result's done attribute is True. Processing a page twice, after a
+    failure, does not change payments already reconciled
+    """
+
+    def __init__(self, reconciliation, max_pages=1, max_page_results=100, deadline=None):
+        super(ReconcileTransactions, self).__init__()
+        self._reconciliation = reconciliation if isinstance(reconciliation, PagSegReconciliation) else None
+        self._reconciliation_key = to_node_key(reconciliation)
+        self._reconciliation_future = None
+        self._access_data_cmd = FindAccessDataCmd()
+        self.max_pages = max_pages
+        self.max_page_results = max_page_results
+        self.deadline = deadline
+
+    def set_up(self):
+        if self._reconciliation is None:
+            self._reconciliation_future = self._reconciliation_key.get_async()
+        self._access_data_cmd.set_up()
+
+    def do_business(self):
+        if self._reconciliation_future is not None:
+            self._reconciliation = self._reconciliation_future.get_result()
+        reconciliation = self._reconciliation
+        if reconciliation is None:
+            self.add_error('reconciliation', 'Reconciliation not found for %s' % self._reconciliation_key)
+            return
+        self.result = reconciliation
+        self._access_data_cmd.do_business()
+        access_data = self._access_data_cmd.result
+        if access_data is None:
+            self.add_error('access_data', 'PagSeguro access data not found')
+            return
+        for _ in xrange(self.max_pages):
+            if reconciliation.done:
+                break
+            search = self._search_page(access_data, reconciliation)
+            if search is None:
+                break
+            reconciliation.payments_updated += self._reconcile(search.transactions)
+            reconciliation.transactions_checked += len(search.transactions)
+            reconciliation.total_pages = search.total_pages
+            reconciliation.page += 1
+            reconciliation.done = reconciliation.page > search.total_pages
+            reconciliation.put()
+
+    def _search_page(self, access_data, reconciliation):
+        params = {'initialDate': reconciliation.initial_date.strftime(_DATE_FORMAT),
+                  'finalDate': reconciliation.final_date.strftime(_DATE_FORMAT),
+                  'page': reconciliation.page,
+                  'maxPageResults': self.max_page_results,
+                  'email': access_data.email,
+                  'token': access_data.token}
+        # UrlFetchCommand's default deadline is used if none is given
+        fetch_kwargs = {'deadline': self.deadline} if self.deadline else {}
+        fetch_cmd = ResilientFetch(ENDPOINT_TRANSACTIONS,
+                                   lambda: UrlFetchCommand(TRANSACTIONS_SEARCH_URL, params, **fetch_kwargs))
+        try:
+            fetch_cmd.set_up()
+            fetch_cmd.do_business()
+        except urlfetch.Error, e:
+            self.add_error('pagseguro', unicode(e))
+            return None
+        if fetch_cmd.result is None:
+            # rejected by rate limiter or circuit breaker
+            self.update_errors(**fetch_cmd.errors)
+            return None
+        if fetch_cmd.errors or fetch_cmd.result.status_code != 200:
+            self.add_error('pagseguro', fetch_cmd.result.content)
+            return None
+        return parse_transaction_search(fetch_cmd.result.content)
+
+    def _reconcile(self, transactions):
+        """
+        @return: number of updated payments
+        """
+        payments = self._find_payments(transactions)
+        write_plan = PaymentWritePlan(spare_ids_per_payment=0)
+        updated = 0
+        for transaction, payment in izip(transactions, payments):
+            status = XML_STATUS_TO_MODEL_STATUS.get(transaction.status)
+            if payment is not None and status is not None and payment.status != status:
+                if update_payment_data(payment, status, transaction.code, transaction.net_amount):
+                    write_plan.add_entity(PagSegCodeIndex.build(payment))
+                write_plan.add_status_log(payment)
+                updated += 1
+        write_plan.commit()
+        return updated
+
+    def _find_payments(self, transactions):
+        """
+        @return: list with the local payment of each transaction, None for those not found
+        """
+        keys = [_reference_key(t.reference) for t in transactions]
+        unique_keys = list(set(k for k in keys if k))
+        by_key = dict(izip(unique_keys, ndb.get_multi(unique_keys)))
+        payments = []
+        for transaction, key in izip(transactions, keys):
+            payment = by_key.get(key)
+            # reference can be from another system, so code must match when payment already has one
+            if not isinstance(payment, PagSegPayment) or payment.code not in (None, transaction.code):
+                payment = None
+            payments.append(payment)
+        codes = list(set(t.code for t, p in izip(transactions, payments) if p is None and t.code))
+        by_code = self._find_indexed_payments(codes)
+        # payments saved before PagSegCodeIndex existed are found by query
+        codes = [c for c in codes if c not in by_code]
+        futures = [PagSegPayment.query(PagSegPayment.code.IN(codes[i:i + IN_FILTER_MAX_VALUES])).fetch_async()
+                   for i in xrange(0, len(codes), IN_FILTER_MAX_VALUES)]
+        by_code.update((p.code, p) for f in futures for p in f.get_result())
+        return [p or by_code.get(t.code) for t, p in izip(transactions, payments)]
+
+    def _find_indexed_payments(self, codes):
+        """
+        @return: dict of code to payment, for codes present on PagSegCodeIndex
+        """
+        indexes = ndb.get_multi([PagSegCodeIndex.key_for_code(c) for c in codes])
+        payment_keys = [index.payment for index in indexes if index]
+        return {p.code: p for p in ndb.get_multi(payment_keys) if p}
+
+
+def _reference_key(reference):
+    try:
+        return to_node_key(reference) if reference else None
+    except ValueError:
+        return None
@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
-from gaebusiness.business import Command, CommandParallel
+from datetime import datetime, timedelta
+from itertools import count
+from gaebusiness.business import Command, CommandParallel, to_model_list
 from gaegraph.business_base import CreateArc, CreateSingleOriginArc
+from gaegraph.model import Node, to_node_key
+from google.appengine.ext import ndb
 
-from gaepagseguro.model import PagSegPayment, PagSegPaymentToItem, PagSegPaymentToLog, ToPagSegPayment, PagSegLog
+from gaepagseguro.counter_commands import update_status_counters, save_counted_payments, \
+    XG_NEW_PAYMENTS_PER_TRANSACTION
+from gaepagseguro.search_commands import clear_payment_cache
+from gaepagseguro.model import PagSegPayment, PagSegPaymentToItem, PagSegPaymentToLog, ToPagSegPayment, PagSegLog, \
+    is_embedded_status_history, is_item_snapshot
 
 
 class SaveItemCmd(Command):
@@ -35,17 +43,22 @@ class SavePagseguroDataCmd(CommandParallel, _DataMixin):
     def __init__(self):
         super(SavePagseguroDataCmd, self).__init__()
         self._create_attributes()
-        self.result = PagSegPayment()
-
+        self.result = PagSegPayment(status_history_complete=is_embedded_status_history())
 
     def handle_previous(self, command):
         self._set_attributes(command)
         self.result.total = sum(i.total() for i in self.items)
 
     def commit(self):
-        self._to_commit = [self.result] + self.items
+        self._to_commit = self.items
         return super(SavePagseguroDataCmd, self).commit()
 
+    def execute(self):
+        super(SavePagseguroDataCmd, self).execute()
+        # payment is saved on the same transaction of counters
+        save_counted_payments([self.result], new=True)
+        return self
+
 
 class CreatePagToItem(CreateArc):
     arc_class = PagSegPaymentToItem
@@ -76,18 +89,27 @@ class SavePaymentToLog(CommandParallel):
     def handle_previous(self, command):
         payment = command.result
         if isinstance(payment, PagSegPayment):
-            log = PagSegLog(status=payment.status)
-            self.append(CreatePagSegPaymentToLog(payment, SimpleSave(log)))
+            if is_embedded_status_history():
+                payment.append_status_history()
+                self.append(SimpleSave(payment))
+            else:
+                log = PagSegLog(status=payment.status)
+                self.append(CreatePagSegPaymentToLog(payment, SimpleSave(log)))
 
 
 class UpdatePaymentAndSaveLog(CommandParallel):
     def __init__(self, payment=None):
         super(UpdatePaymentAndSaveLog, self).__init__()
         self.__payment = payment
+        # status history the new entry is appended to, when it is read on counters transaction
+        self._saved_history = None
         self._setup_update()
 
     def _setup_update(self):
         if isinstance(self.__payment, PagSegPayment):
+            if is_embedded_status_history():
+                self.append(SimpleSave(self.__payment))
+                return
             log = PagSegLog(status=self.__payment.status)
             create_arc = CreateArc(SimpleSave(self.__payment), SimpleSave(log))
             create_arc.arc_class = PagSegPaymentToLog
@@ -99,7 +121,29 @@ class UpdatePaymentAndSaveLog(CommandParallel):
 
     def do_business(self):
         super(UpdatePaymentAndSaveLog, self).do_business()
-        self.result = self.__payment
+        payment = self.__payment
+        if isinstance(payment, PagSegPayment) and is_embedded_status_history():
+            if self._saved_history is not None:
+                # entries appended concurrently are kept, so history is append only
+                payment.status_history = list(self._saved_history)
+            payment.append_status_history()
+        self.result = payment
+
+    def execute(self):
+        payment = self.__payment
+        if not isinstance(payment, PagSegPayment):
+            return super(UpdatePaymentAndSaveLog, self).execute()
+        history = list(payment.status_history)
+
+        def save(saved_payments):
+            saved = saved_payments[0]
+            self._saved_history = saved.status_history if saved is not None else history
+            super(UpdatePaymentAndSaveLog, self).execute()
+
+        # payment and its log are saved on the same transaction of counters
+        save_counted_payments([payment], save)
+        clear_payment_cache([payment])
+        return self
 
 
 class SaveToPayment(CreateSingleOriginArc):
@@ -110,21 +154,169 @@ class SaveToPayment(CreateSingleOriginArc):
 
 
 class SavePaymentArcsCmd(CommandParallel, _DataMixin):
+    """
+    Saves payment's arcs. Payment is saved again with its owner key
+    """
+
     def __init__(self, payment_owner):
         super(SavePaymentArcsCmd, self).__init__(SaveToPayment(payment_owner),
                                                  SavePaymentToLog(),
                                                  SavePaymentToItemsArcs())
         self._create_attributes()
         self.__payment = None
+        self.__payment_owner = payment_owner
 
     def handle_previous(self, command):
         super(SavePaymentArcsCmd, self).handle_previous(command)
         self._set_attributes(command)
         self.__payment = command.result
+        if self.__payment is not None and self.__payment_owner is not None:
+            self.__payment.owner_key = to_node_key(self.__payment_owner)
 
 
     def do_business(self):
         super(SavePaymentArcsCmd, self).do_business()
         self.result = self.__payment
 
+    def commit(self):
+        models = to_model_list(super(SavePaymentArcsCmd, self).commit())
+        if self.__payment is not None and not any(m is self.__payment for m in models):
+            models.append(self.__payment)
+        return models
+
+
+class PaymentWritePlan(object):
+    """
+    Collects every entity written on payment generation, so all of them are committed with a single put_multi.
+    Node ids are allocated in advance with one RPC, so arcs and PagSeguro's reference can be built before any put.
+    Besides payment, items and first log ids, spare_ids_per_payment ids are reserved for status logs added later
+    """
+
+    def __init__(self, spare_ids_per_payment=1):
+        self._spare_ids_per_payment = spare_ids_per_payment
+        self._nodes = []
+        self._arcs = []
+        self._entities = []
+        self._allocated_keys = set()
+        self._spare_keys = []
+        self._payments_items = []
+        self._payments_number = 0
+        self._last_arc_creation = None
+
+    def add_payment(self, payment, items, payment_owner=None):
+        self._payments_number += 1
+        payment.track_counters(new=True)
+        self._nodes.append(payment)
+        self._nodes.extend(items)
+        self._payments_items.append((payment, items))
+        if payment_owner is not None:
+            payment.owner_key = to_node_key(payment_owner)
+            self._add_arc(ToPagSegPayment, payment_owner, payment)
+        self.add_status_log(payment)
+        for item in items:
+            self._add_arc(PagSegPaymentToItem, payment, item)
+
+    def add_status_log(self, payment):
+        """
+        Adds a log with payment's current status. Payment is not put twice if it was already on plan
+        """
+        if not any(n is payment for n in self._nodes):
+            self._nodes.append(payment)
+        if is_embedded_status_history():
+            payment.append_status_history()
+            return
+        key = self._spare_keys.pop() if self._spare_keys else None
+        log = PagSegLog(status=payment.status, key=key)
+        self._nodes.append(log)
+        self._add_arc(PagSegPaymentToLog, payment, log)
+
+    def add_entity(self, entity):
+        """
+        Adds an entity with complete key, like an index, to be saved with the plan
+        """
+        self._entities.append(entity)
+
+    def _add_arc(self, arc_class, origin, destination):
+        # Arcs are saved on same put, so creation is set here to keep logs order
+        creation = datetime.now()
+        if self._last_arc_creation and creation <= self._last_arc_creation:
+            creation = self._last_arc_creation + timedelta(microseconds=1)
+        self._last_arc_creation = creation
+        self._arcs.append((arc_class, origin, destination, creation))
+
+    def allocate_ids(self):
+        """
+        Sets keys on all nodes of the plan with a single RPC. Nodes which already have keys are kept untouched
+        """
+        spare_ids = 0 if is_embedded_status_history() else self._spare_ids_per_payment * self._payments_number
+        self._allocate_ids(spare_ids - len(self._spare_keys))
+
+    def _allocate_ids(self, spare_ids):
+        keyless_nodes = [n for n in self._nodes if n.key is None]
+        if keyless_nodes:
+            spare_ids = max(spare_ids, 0)
+            first_id, _ = Node.allocate_ids(size=len(keyless_nodes) + spare_ids)
+            ids = count(first_id)
+            for node in keyless_nodes:
+                node.key = ndb.Key(node.__class__, next(ids))
+                self._allocated_keys.add(node.key)
+            spare_keys = [ndb.Key(Node, next(ids)) for _ in xrange(spare_ids)]
+            self._spare_keys.extend(spare_keys)
+            self._allocated_keys.update(spare_keys)
 
+    def commit(self):
+        """
+        Saves new payments with their counters and then all other nodes and arcs of the plan with a single put_multi.
+        Payments are saved first, so items, logs and arcs are never left without their payment if counters
+        transaction fails. Nodes which existed before the plan, like a payment being updated, and added entities are
+        saved on a second concurrent put
+        """
+        self._allocate_ids(0)  # only needed when more logs were added than spare ids reserved
+        if is_item_snapshot():
+            # items keys are known only after allocation
+            for payment, items in self._payments_items:
+                payment.set_item_snapshot(items)
+        arcs = [arc_class(origin, destination, creation=creation)
+                for arc_class, origin, destination, creation in self._arcs]
+        new_nodes = [n for n in self._nodes if n.key in self._allocated_keys]
+        old_nodes = [n for n in self._nodes if n.key not in self._allocated_keys]
+        new_payments = [n for n in new_nodes if isinstance(n, PagSegPayment)]
+        for i in xrange(0, len(new_payments), XG_NEW_PAYMENTS_PER_TRANSACTION):
+            save_counted_payments(new_payments[i:i + XG_NEW_PAYMENTS_PER_TRANSACTION], new=True)
+        # Keys allocated by the plan can not be on ndb's memcache, so its lock is skipped and nodes are put
+        # on the same RPC of arcs, whose keys are incomplete
+        futures = ndb.put_multi_async([n for n in new_nodes if not isinstance(n, PagSegPayment)] + arcs,
+                                      use_memcache=False)
+        futures.extend(ndb.put_multi_async(old_nodes + self._entities))
+        [f.get_result() for f in futures]
+        update_status_counters([n for n in old_nodes if isinstance(n, PagSegPayment)])
+        # new payments can not be cached yet
+        clear_payment_cache([n for n in old_nodes if isinstance(n, PagSegPayment)])
+        self._nodes = []
+        self._arcs = []
+        self._entities = []
+        self._payments_items = []
+
+
+class PlanPaymentWritesCmd(Command, _DataMixin):
+    """
+    Builds the payment from validated data and adds it, with its items and owner, to a PaymentWritePlan.
+    If no plan is given, it creates one and allocates its ids, so the payment has a key without being saved
+    """
+
+    def __init__(self, payment_owner, write_plan=None):
+        super(PlanPaymentWritesCmd, self).__init__()
+        self._create_attributes()
+        self.payment_owner = payment_owner
+        self._allocate_ids = write_plan is None
+        self.write_plan = write_plan or PaymentWritePlan()
+
+    def handle_previous(self, command):
+        self._set_attributes(command)
+
+    def do_business(self):
+        self.result = PagSegPayment(total=sum(i.total() for i in self.items),
+                                    status_history_complete=is_embedded_status_history())
+        self.write_plan.add_payment(self.result, self.items, self.payment_owner)
+        if self._allocate_ids:
+            self.write_plan.allocate_ids()
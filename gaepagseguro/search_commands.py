@@ -1,41 +1,276 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+from datetime import datetime
+from decimal import Decimal
+from itertools import izip, combinations
+from gaebusiness.business import Command
 from gaebusiness.gaeutil import ModelSearchCommand, SingleModelSearchCommand
 from gaegraph.business_base import DestinationsSearch, SingleDestinationSearch, ModelSearchWithRelations, \
-    SingleOriginSearch, NodeSearch
+    SingleOriginSearch, NodeSearch, OriginsSearch
+from gaegraph.model import to_node_key, destinations_cache_key, origins_cache_key
+from google.appengine.api import memcache, datastore
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
-from gaepagseguro.model import PagSegPayment, PagSegPaymentToLog, ToPagSegPayment, PagSegPaymentToItem
+from gaepagseguro.model import PagSegPayment, PagSegPaymentToLog, ToPagSegPayment, PagSegPaymentToItem, \
+    is_embedded_status_history, is_item_snapshot, PagSegCodeIndex, is_payment_owners_migrated
 
 
-class SearchLogs(DestinationsSearch):
+class _EmbeddedOrArcsSearch(DestinationsSearch):
+    """
+    Base for payment relations which can be embedded on the payment. When the embedded mode is enabled and payment
+    has the relation embedded, it is returned and no arc is searched. Payments saved before enabling it fall back to
+    arcs search, whose result is merged with what was embedded on them afterwards. Payment is got by key when only
+    the key is given, which is served by ndb's context cache when the payment was already loaded, as happens on
+    get_payment and listings
+    """
+
+    def __init__(self, origin, relations=None):
+        super(_EmbeddedOrArcsSearch, self).__init__(origin, relations)
+        self._payment = origin if isinstance(origin, PagSegPayment) else None
+        self._payment_future = None
+        self._arcs_search_started = False
+
+    def _is_embedded_enabled(self):
+        raise NotImplementedError()
+
+    def _embedded_result(self, payment):
+        """
+        @return: list with relation's embedded models or an empty list if payment has not them
+        """
+        raise NotImplementedError()
+
+    def _merge_embedded(self, arcs_result):
+        """
+        @return: arcs search result merged with relation's models embedded on payment
+        """
+        return arcs_result
+
+    def set_up(self):
+        if self._payment is None and self._is_embedded_enabled():
+            self._payment_future = to_node_key(self.origin).get_async()
+        elif not self._embedded():
+            self._set_up_arcs_search()
+
+    def _set_up_arcs_search(self):
+        self._arcs_search_started = True
+        super(_EmbeddedOrArcsSearch, self).set_up()
+
+    def do_business(self):
+        if self._payment_future is not None:
+            self._payment = self._payment_future.get_result()
+            self._payment_future = None
+        embedded = self._embedded()
+        if embedded:
+            self.result = embedded
+            return
+        if not self._arcs_search_started:
+            self._set_up_arcs_search()
+        super(_EmbeddedOrArcsSearch, self).do_business()
+        self.result = self._merge_embedded(self.result)
+
+    def _embedded(self):
+        if self._payment is not None and self._is_embedded_enabled():
+            return self._embedded_result(self._payment)
+
+
+class SearchLogs(_EmbeddedOrArcsSearch):
+    """
+    Search payment's logs. Entries of payment's status history are returned when embedded status history is enabled.
+    Logs of payments whose history is not complete are returned before their history entries
+    """
     arc_class = PagSegPaymentToLog
 
+    def _is_embedded_enabled(self):
+        return is_embedded_status_history()
+
+    def _embedded_result(self, payment):
+        return list(payment.status_history) if payment.status_history_complete else []
+
+    def _merge_embedded(self, logs):
+        if self._payment is None or not self._is_embedded_enabled():
+            return logs
+        # status changes saved after enabling embedded status history, before payment's logs were migrated
+        return logs + self._payment.status_history
+
 
 class SearchOwner(SingleOriginSearch):
     arc_class = ToPagSegPayment
 
 
-class SearchItems(DestinationsSearch):
+class SearchItems(_EmbeddedOrArcsSearch):
+    """
+    Search payment's items. Items are rebuilt from payment's item snapshot when item snapshot is enabled
+    """
     arc_class = PagSegPaymentToItem
 
+    def _is_embedded_enabled(self):
+        return is_item_snapshot()
+
+    def _embedded_result(self, payment):
+        return payment.snapshot_items()
+
 
 payment_relations = {'pay_items': SearchItems, 'owner': SearchOwner, 'logs': SearchLogs}
 
+# Max number of values on a IN filter, since each value becomes a subquery
+IN_FILTER_MAX_VALUES = 30
 
-class SearchOwnerPayments(DestinationsSearch):
-    arc_class = ToPagSegPayment
-    _relations = payment_relations
+
+def _relation_arcs(search):
+    """
+    @param search: gaegraph's OriginsSearch or DestinationsSearch of a payment's relation
+    @return: tuple (payment's arc property name, relation's arc property name, memcache key of relation's node keys).
+    The key is the one read and filled by the search and invalidated when its arcs are put
+    """
+    if isinstance(search, OriginsSearch):
+        return 'destination', 'origin', origins_cache_key(search.arc_class, search.destination)
+    return 'origin', 'destination', destinations_cache_key(search.arc_class, search.origin)
+
+
+class PaymentRelationsLoader(Command):
+    """
+    Loads relations of a page of payments with batched RPCs, instead of searching each relation of each payment:
+    one memcache get_multi for the arcs cache of all pairs, one arc query per relation type for cache misses and one
+    get_multi for the nodes of all relations. Relations embedded on payments are served without any RPC.
+    Each relation is set as a payment attribute, the same way relations are filled on GetPayment
+    """
+
+    def __init__(self, payments, relations, relation_factory=payment_relations):
+        super(PaymentRelationsLoader, self).__init__()
+        self.result = [p for p in payments if p]
+        self._searches = [(name, payment, relation_factory[name](payment))
+                          for name in relations for payment in self.result]
+        self._relation_arcs = {search: _relation_arcs(search) for _, _, search in self._searches}
+        self._arcs_futures = {}
+        self._node_keys = {}
+
+    def set_up(self):
+        pending = []
+        for name, payment, search in self._searches:
+            embedded = search._embedded() if isinstance(search, _EmbeddedOrArcsSearch) else None
+            if embedded:
+                setattr(payment, name, embedded)
+            else:
+                pending.append(search)
+        cached = memcache.get_multi([self._relation_arcs[s][2] for s in pending])
+        misses = {}
+        for search in pending:
+            node_keys = cached.get(self._relation_arcs[search][2])
+            if node_keys:
+                self._node_keys[search] = node_keys
+            else:
+                misses.setdefault(search.__class__, []).append(search)
+        for search_class, searches in misses.iteritems():
+            self._arcs_futures[search_class] = (searches, list(self._start_arcs_queries(searches)))
+
+    def _start_arcs_queries(self, searches):
+        arc_class = searches[0].arc_class
+        payment_property = getattr(arc_class, self._relation_arcs[searches[0]][0])
+        payment_keys = [to_node_key(s.origin or s.destination) for s in searches]
+        for i in xrange(0, len(payment_keys), IN_FILTER_MAX_VALUES):
+            query = arc_class.query(payment_property.IN(payment_keys[i:i + IN_FILTER_MAX_VALUES]))
+            yield query.order(arc_class.default_order()).fetch_async()
+
+    def do_business(self):
+        to_cache = {}
+        for searches, futures in self._arcs_futures.itervalues():
+            node_keys_by_payment = {}
+            payment_property, relation_property, _ = self._relation_arcs[searches[0]]
+            for future in futures:
+                for arc in future.get_result():
+                    node_keys_by_payment.setdefault(getattr(arc, payment_property), []).append(
+                        getattr(arc, relation_property))
+            for search in searches:
+                node_keys = node_keys_by_payment.get(to_node_key(search.origin or search.destination), [])
+                self._node_keys[search] = node_keys
+                if node_keys:
+                    to_cache[self._relation_arcs[search][2]] = node_keys
+        if to_cache:
+            memcache.set_multi(to_cache)
+        all_keys = [k for node_keys in self._node_keys.itervalues() for k in node_keys]
+        nodes = dict(izip(all_keys, ndb.get_multi(all_keys)))
+        for name, payment, search in self._searches:
+            if search in self._node_keys:
+                relation = [nodes[k] for k in self._node_keys[search] if nodes[k]]
+                if isinstance(search, (SingleOriginSearch, SingleDestinationSearch)):
+                    relation = relation[0] if relation else None
+                elif isinstance(search, _EmbeddedOrArcsSearch):
+                    relation = search._merge_embedded(relation)
+                setattr(payment, name, relation)
+
+
+# Seconds a payment, with its relations, is kept on GetPayment cache. Writes invalidate it, this expiration only
+# limits how long a value read concurrently with a write can be served
+PAYMENT_CACHE_TTL = 600
+
+
+def _payment_cache_key(payment_key, relations):
+    return 'gaepagseguro_payment:%s:%s' % (payment_key.id(), ','.join(sorted(relations or [])))
+
+
+def clear_payment_cache(payments):
+    """
+    Invalidates GetPayment cache of payments, for all relations sets, with a single memcache call
+    @param payments: list of payments or their keys
+    """
+    names = sorted(payment_relations)
+    relations_sets = [c for size in xrange(len(names) + 1) for c in combinations(names, size)]
+    keys = [_payment_cache_key(to_node_key(p), relations) for p in payments for relations in relations_sets]
+    if keys:
+        memcache.delete_multi(keys)
 
 
 class GetPayment(NodeSearch):
+    """
+    Gets payment and its relations, from a memcache read-through cache keyed by payment id and relations set.
+    Commands which write payments clear it with clear_payment_cache
+    """
     _model_class = PagSegPayment
     _relations = payment_relations
 
+    def __init__(self, node_or_key_or_id, relations=None, use_cache=True):
+        super(GetPayment, self).__init__(node_or_key_or_id, relations)
+        self._relation_names = relations or []
+        self._cache_key = _payment_cache_key(to_node_key(node_or_key_or_id), relations) if use_cache else None
+        self._cached = None
+
+    def set_up(self):
+        if self._cache_key:
+            self._cached = memcache.get(self._cache_key)
+        if self._cached is None:
+            super(GetPayment, self).set_up()
+
+    def do_business(self):
+        if self._cached is not None:
+            payment, relations = self._cached
+            for name, value in relations.iteritems():
+                setattr(payment, name, value)
+            self.result = payment
+            return
+        super(GetPayment, self).do_business()
+        payment = self.result
+        if self._cache_key and payment is not None and not self.errors:
+            relations = {name: getattr(payment, name) for name in self._relation_names}
+            memcache.set(self._cache_key, (payment, relations), PAYMENT_CACHE_TTL)
+
 
 class PaymentSearchBase(ModelSearchWithRelations):
     _relations = payment_relations
 
+    def __init__(self, query, page_size=100, start_cursor=None, offset=0, use_cache=True, cache_begin=True,
+                 relations=None, **kwargs):
+        # relations are loaded in batch, not by ModelSearchWithRelations
+        super(PaymentSearchBase, self).__init__(query, page_size, start_cursor, offset, use_cache, cache_begin,
+                                                **kwargs)
+        self._payment_relations = relations
+
+    def do_business(self, stop_on_error=True):
+        super(PaymentSearchBase, self).do_business(stop_on_error)
+        if self._payment_relations and self.result:
+            PaymentRelationsLoader(self.result, self._payment_relations)()
+
 
 class AllPaymentsSearch(PaymentSearchBase):
     def __init__(self, page_size=20, start_cursor=None, offset=0, use_cache=True, cache_begin=True, relations=None,
@@ -55,14 +290,275 @@ class PaymentsByStatusSearch(PaymentSearchBase):
                                                      **kwargs)
 
 
+class PaymentRow(object):
+    """
+    Lightweight payment listing row, with only id, status, total and update. The full payment, with relations, is
+    loaded only when payment method is called, or for several rows at once with hydrate_payment_rows
+    """
+
+    def __init__(self, key, status, total, update):
+        self.key = key
+        self.status = status
+        self.total = total
+        self.update = update
+        self._payment = None
+
+    @property
+    def id(self):
+        return self.key.id()
+
+    def payment(self, relations=None):
+        """
+        @param relations: list of relations to bring with payment. possible values on list: logs, pay_items, owner
+        @return: the full PagSegPayment, from GetPayment's cache
+        """
+        if self._payment is None or relations:
+            self._payment = GetPayment(self.key, relations)()
+        return self._payment
+
+    def __eq__(self, other):
+        return isinstance(other, PaymentRow) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'PaymentRow(key=%r, status=%r, total=%r, update=%r)' % (self.key, self.status, self.total, self.update)
+
+
+def hydrate_payment_rows(rows, relations=None):
+    """
+    Loads full payments of rows not loaded yet with a single get_multi, and their relations in batch
+    @param rows: list of PaymentRow
+    @param relations: list of relations to bring with payments
+    @return: list of PagSegPayment, in the same order of rows
+    """
+    pending = [row for row in rows if row._payment is None]
+    for row, payment in izip(pending, ndb.get_multi([row.key for row in pending])):
+        row._payment = payment
+    payments = [row._payment for row in rows]
+    if relations:
+        PaymentRelationsLoader(payments, relations)()
+    return payments
+
+
+class PaymentRowsSearch(Command):
+    """
+    Searches a page of PaymentRow ordered by update desc, optionally filtered by status, with a projection query.
+    So only index entries are read, instead of full payments. ndb checks projections against the kind's root model,
+    Node, so the query is run with the low level datastore API and values are converted by PagSegPayment's
+    properties. Rows are not cached, and cursor and more attributes work like on ModelSearchCommand
+    """
+
+    def __init__(self, payment_status=None, page_size=20, start_cursor=None, offset=0):
+        super(PaymentRowsSearch, self).__init__()
+        self.payment_status = payment_status
+        self.page_size = page_size
+        self.offset = offset
+        if isinstance(start_cursor, basestring):
+            start_cursor = Cursor(urlsafe=start_cursor)
+        self.start_cursor = start_cursor
+        self.cursor = None
+        self.more = None
+        self._query = None
+        self._iterator = None
+
+    def set_up(self):
+        filters = {'class =': PagSegPayment._class_name()}
+        # properties on equality filters can not be projected
+        projection = ['total', 'update']
+        if self.payment_status:
+            filters['status ='] = self.payment_status
+        else:
+            projection.append('status')
+        self._query = datastore.Query('Node', filters, projection=projection)
+        self._query.Order(('update', datastore.Query.DESCENDING))
+        self._iterator = self._query.Run(limit=self.page_size, offset=self.offset, start_cursor=self.start_cursor)
+
+    def do_business(self):
+        self.result = []
+        for entity in self._iterator:
+            payment = PagSegPayment._from_pb(entity.ToPb(), set_key=True)
+            self.result.append(PaymentRow(payment.key, self.payment_status or payment.status, payment.total,
+                                          payment.update))
+        self.cursor = self._query.GetCursor()
+        self.more = len(self.result) == self.page_size
+
+
+class SearchOwnerPayments(PaymentSearchBase):
+    """
+    Searches a page of owner's payments ordered by update desc, optionally filtered by status. Payments are found by
+    their owner_key property. Until MigratePaymentOwners is marked as done, payments saved before it existed are
+    searched by owner's arcs and appended to the last page, also ordered by update desc.
+    Cache is disabled by default, since a cached page would not show payments made after it
+    """
+
+    def __init__(self, owner, payment_status=None, page_size=20, start_cursor=None, offset=0, use_cache=False,
+                 cache_begin=True, relations=None, **kwargs):
+        self._owner_key = to_node_key(owner)
+        self._payment_status = payment_status
+        query = PagSegPayment.query(PagSegPayment.owner_key == self._owner_key)
+        if payment_status:
+            query = query.filter(PagSegPayment.status == payment_status)
+        query = query.order(-PagSegPayment.update)
+        super(SearchOwnerPayments, self).__init__(query, page_size, start_cursor, offset, use_cache, cache_begin,
+                                                  relations, **kwargs)
+
+    def do_business(self, stop_on_error=True):
+        super(SearchOwnerPayments, self).do_business(stop_on_error)
+        if not self.more and not is_payment_owners_migrated():
+            not_migrated = self._search_not_migrated()
+            if not_migrated and self._payment_relations:
+                PaymentRelationsLoader(not_migrated, self._payment_relations)()
+            self.result = self.result + not_migrated
+
+    def _search_not_migrated(self):
+        arcs = ToPagSegPayment.find_destinations(self._owner_key).fetch()
+        payments = ndb.get_multi([arc.destination for arc in arcs])
+        payments = [p for p in payments if p is not None and p.owner_key is None and
+                    (not self._payment_status or p.status == self._payment_status)]
+        return sorted(payments, key=lambda p: p.update, reverse=True)
+
+
+def _window_span(start, end, now):
+    """
+    @return: estimated size of a date window, used as its selectivity. Windows not bounded on start are the least
+    selective ones
+    """
+    if start is None:
+        return None
+    return (end or now) - start
+
+
+def _in_window(value, start, end):
+    return value is not None and (start is None or value >= start) and (end is None or value < end)
+
+
+class PaymentsQueryBuilder(object):
+    """
+    Builds a payments query from optional filters: statuses, owner, windows of update and creation dates and a
+    minimum total. Date windows include their start and exclude their end.
+    Datastore supports inequalities on a single property, which must be the first sort order. So the most selective
+    range is used on the query, and results are sorted desc by its property: the shortest window bounded on start,
+    then any date window, and minimum total only without date windows. Other ranges are applied on fetched pages, by
+    matches method. Without ranges, payments are sorted by update desc.
+    Every combination is served by a composite index of gaepagseguro/index.yaml
+    """
+
+    def __init__(self, statuses=None, owner=None, update_start=None, update_end=None, creation_start=None,
+                 creation_end=None, min_total=None):
+        self.statuses = list(statuses or [])
+        self.owner_key = to_node_key(owner) if owner else None
+        self.ranges = []
+        if update_start or update_end:
+            self.ranges.append((PagSegPayment.update, update_start, update_end))
+        if creation_start or creation_end:
+            self.ranges.append((PagSegPayment.creation, creation_start, creation_end))
+        self.min_total = Decimal(min_total) if min_total is not None else None
+        self.query_range = self._most_selective_range()
+
+    def _most_selective_range(self):
+        if not self.ranges:
+            return None
+        now = datetime.now()
+        bounded = [r for r in self.ranges if r[1] is not None]
+        if bounded:
+            return min(bounded, key=lambda r: _window_span(r[1], r[2], now))
+        return self.ranges[0]
+
+    def build(self):
+        """
+        @return: ndb query with equality filters and the chosen range. It is also ordered by key, so cursors work
+        with multiple statuses
+        """
+        query = PagSegPayment.query()
+        if self.owner_key:
+            query = query.filter(PagSegPayment.owner_key == self.owner_key)
+        if len(self.statuses) == 1:
+            query = query.filter(PagSegPayment.status == self.statuses[0])
+        elif self.statuses:
+            query = query.filter(PagSegPayment.status.IN(self.statuses))
+        if self.query_range:
+            prop, start, end = self.query_range
+            if start:
+                query = query.filter(prop >= start)
+            if end:
+                query = query.filter(prop < end)
+            order = prop
+        elif self.min_total is not None:
+            query = query.filter(PagSegPayment.total >= self.min_total)
+            order = PagSegPayment.total
+        else:
+            order = PagSegPayment.update
+        return query.order(-order, PagSegPayment.key)
+
+    def matches(self, payment):
+        """
+        @return: True if payment is inside ranges not used on query
+        """
+        for prop, start, end in self.ranges:
+            if prop is not self.query_range[0] and not _in_window(getattr(payment, prop._code_name), start, end):
+                return False
+        if self.query_range and self.min_total is not None:
+            return payment.total is not None and payment.total >= self.min_total
+        return True
+
+
+class PaymentsQuerySearch(PaymentSearchBase):
+    """
+    Searches a page of payments filtered by PaymentsQueryBuilder. Ranges not used on query are applied after the
+    page is fetched, so a page can have fewer payments than page_size even when there are more to fetch: keep
+    paginating with cursor while more attribute is True. Cache is disabled by default, like on SearchOwnerPayments
+    """
+
+    def __init__(self, statuses=None, owner=None, update_start=None, update_end=None, creation_start=None,
+                 creation_end=None, min_total=None, page_size=20, start_cursor=None, offset=0, use_cache=False,
+                 cache_begin=True, relations=None, **kwargs):
+        self.builder = PaymentsQueryBuilder(statuses, owner, update_start, update_end, creation_start, creation_end,
+                                            min_total)
+        super(PaymentsQuerySearch, self).__init__(self.builder.build(), page_size, start_cursor, offset, use_cache,
+                                                  cache_begin, relations, **kwargs)
+
+    def do_business(self, stop_on_error=True):
+        # relations are loaded only for matching payments
+        relations = self._payment_relations
+        self._payment_relations = None
+        super(PaymentsQuerySearch, self).do_business(stop_on_error)
+        self._payment_relations = relations
+        if self.result:
+            self.result = [p for p in self.result if self.builder.matches(p)]
+            if relations and self.result:
+                PaymentRelationsLoader(self.result, relations)()
+
+
 class PaymentByPagseguroCode(PaymentSearchBase):
+    """
+    Finds payment by PagSeguro's transaction code with a get on PagSegCodeIndex. Payments saved before the index
+    existed are found with a query on code instead, and indexed attribute is False for them
+    """
+
     def __init__(self, transaction_code, relations=None,
                  **kwargs):
         super(PaymentByPagseguroCode, self).__init__(PagSegPayment.query(PagSegPayment.code == transaction_code),
                                                      page_size=1, relations=relations,
                                                      **kwargs)
+        self.transaction_code = transaction_code
+        self.indexed = False
+        self._index_future = None
+
+    def set_up(self):
+        if self.transaction_code:
+            self._index_future = PagSegCodeIndex.key_for_code(self.transaction_code).get_async()
 
     def do_business(self):
+        index = self._index_future and self._index_future.get_result()
+        payment = index and index.payment.get()
+        if payment is not None:
+            self.indexed = True
+            self.result = payment
+            if self._payment_relations:
+                PaymentRelationsLoader([payment], self._payment_relations)()
+            return
+        super(PaymentByPagseguroCode, self).set_up()
         super(PaymentByPagseguroCode, self).do_business()
         self.result = self.result[0] if self.result else None
-
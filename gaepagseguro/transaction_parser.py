@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from xml.parsers import expat
+import xmltodict
+
+_ENCODING = 'ISO-8859-1'
+
+# paths, relative to transaction element, whose text is extracted
+_TRANSACTION_FIELDS = {('code',): 'code',
+                       ('status',): 'status',
+                       ('netAmount',): 'net_amount',
+                       ('grossAmount',): 'gross_amount',
+                       ('reference',): 'reference',
+                       ('sender', 'name'): 'sender_name',
+                       ('sender', 'email'): 'sender_email'}
+
+_ITEM_PATH = ('items', 'item')
+_ITEM_FIELDS = {'id': 'id', 'description': 'description', 'amount': 'amount', 'quantity': 'quantity'}
+
+
+class TransactionItem(object):
+    __slots__ = ('id', 'description', 'amount', 'quantity')
+
+    def __init__(self):
+        self.id = None
+        self.description = None
+        self.amount = None
+        self.quantity = None
+
+
+class TransactionRecord(object):
+    """
+    Fields read from a PagSeguro transaction xml. Values are the xml strings, None for missing ones.
+    status is PagSeguro's status number. The whole document is available through full_dict method
+    """
+    __slots__ = ('code', 'status', 'net_amount', 'gross_amount', 'reference', 'sender_name', 'sender_email',
+                 'items', 'xml', '_full_dict')
+
+    def __init__(self, xml):
+        self.code = None
+        self.status = None
+        self.net_amount = None
+        self.gross_amount = None
+        self.reference = None
+        self.sender_name = None
+        self.sender_email = None
+        self.items = []
+        self.xml = xml
+        self._full_dict = None
+
+    def full_dict(self):
+        """
+        @return: the whole xml parsed with xmltodict, the same way it was done before this parser
+        """
+        if self._full_dict is None:
+            self._full_dict = xmltodict.parse(self.xml, _ENCODING)
+        return self._full_dict
+
+
+class TransactionSearchResult(object):
+    """
+    A page of PagSeguro's transactions search. Its transactions are TransactionRecord with the fields present on
+    search results. Their full_dict method is not available, since they are not whole documents
+    """
+    __slots__ = ('current_page', 'total_pages', 'transactions')
+
+    def __init__(self, current_page, total_pages, transactions):
+        self.current_page = current_page
+        self.total_pages = total_pages
+        self.transactions = transactions
+
+
+class _TransactionHandler(object):
+    """
+    Expat handler building a TransactionRecord for each transaction element at root_depth of the document.
+    Texts of root's direct children are kept on header dict
+    """
+
+    def __init__(self, root_depth, xml=None):
+        self.root_depth = root_depth
+        self.xml = xml
+        self.records = []
+        self.header = {}
+        self.record = None
+        self.item = None
+        self.path = []
+        self.field = None
+        self.target = None
+        self.text = []
+
+    def start(self, name, attrs):
+        path = self.path
+        path.append(name)
+        depth = len(path) - 1
+        self.field = None
+        self.text = []
+        if depth == self.root_depth:
+            if name == 'transaction':
+                self.record = TransactionRecord(self.xml)
+                self.records.append(self.record)
+        elif self.record is None:
+            if depth == 1:
+                self.field = name
+                self.target = self.header
+        else:
+            relative_path = tuple(path[self.root_depth + 1:])
+            if relative_path == _ITEM_PATH:
+                self.item = TransactionItem()
+                self.record.items.append(self.item)
+            elif self.item is not None and len(relative_path) == 3:
+                self.field = _ITEM_FIELDS.get(name)
+                self.target = self.item
+            else:
+                self.field = _TRANSACTION_FIELDS.get(relative_path)
+                self.target = self.record
+
+    def end(self, name):
+        field = self.field
+        if field is not None:
+            value = ''.join(self.text).strip() or None
+            if isinstance(self.target, dict):
+                self.target[field] = value
+            else:
+                setattr(self.target, field, value)
+            self.field = None
+        depth = len(self.path) - 1
+        if depth == self.root_depth:
+            self.record = None
+        elif depth == self.root_depth + 2 and self.item is not None:
+            self.item = None
+        self.path.pop()
+
+    def characters(self, data):
+        if self.field is not None:
+            self.text.append(data)
+
+
+def _parse(xml, handler):
+    parser = expat.ParserCreate(_ENCODING)
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.characters
+    if isinstance(xml, unicode):
+        # request params arrive as unicode, so they are encoded back the same way xmltodict does
+        xml = xml.encode(_ENCODING)
+    parser.Parse(xml, True)
+    return handler
+
+
+def parse_transaction(xml):
+    """
+    Reads only the fields used by this app from a transaction xml, with a streaming parser. It is several times
+    faster than parsing the whole document with xmltodict.
+    @param xml: transaction xml, encoded as ISO-8859-1
+    @return: TransactionRecord. Its full_dict method parses the whole document when other fields are needed
+    """
+    records = _parse(xml, _TransactionHandler(0, xml)).records
+    return records[0] if records else TransactionRecord(xml)
+
+
+def parse_transaction_search(xml):
+    """
+    Reads a page of PagSeguro's transactions search with the same streaming parser of parse_transaction
+    @param xml: transactionSearchResult xml, encoded as ISO-8859-1
+    @return: TransactionSearchResult
+    """
+    # transactions are on transactionSearchResult/transactions/transaction
+    handler = _parse(xml, _TransactionHandler(2))
+    return TransactionSearchResult(int(handler.header.get('currentPage') or 0),
+                                   int(handler.header.get('totalPages') or 0),
+                                   handler.records)
@@ -1,49 +1,110 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+from collections import deque
 from decimal import Decimal
+from itertools import izip
 import logging
+from xml.parsers.expat import ExpatError
 from gaebusiness.business import CommandParallel, Command, CommandSequential, CommandExecutionException
-from gaebusiness.gaeutil import UrlFetchCommand
+from gaebusiness.gaeutil import UrlFetchCommand, TaskQueueCommand
 from gaegraph.business_base import NodeSearch, CreateArc
+from gaegraph.model import to_node_key, Node
+from google.appengine.api import urlfetch, memcache
+from google.appengine.api.taskqueue import TaskRetryOptions
+from google.appengine.ext import ndb
 from gaepermission import facade
 from tekton import router
-import xmltodict
 from gaepagseguro.admin_commands import FindAccessDataCmd
+from gaepagseguro.circuit_breaker import ResilientFetch
+from gaepagseguro.counter_commands import save_counted_payments
 from gaepagseguro.model import STATUS_SENT_TO_PAGSEGURO, STATUS_ANALYSIS, STATUS_ACCEPTED, STATUS_AVAILABLE, \
     STATUS_DISPUTE, STATUS_RETURNED, STATUS_CANCELLED, PagSegPaymentToLog, PagSegLog, STATUS_CHARGEBACK_DEBT, \
-    STATUS_CHARGEBACK, PagSegPayment, PagSegPaymentToItem, PagSegItem
-from gaepagseguro.save_commands import UpdatePaymentAndSaveLog, CreatePagSegPaymentToLog, SaveToPayment
-from gaepagseguro.search_commands import PaymentByPagseguroCode
+    STATUS_CHARGEBACK, PagSegPayment, PagSegPaymentToItem, PagSegItem, is_embedded_status_history, \
+    is_item_snapshot, PagSegCodeIndex
+from gaepagseguro.rate_limiter import ENDPOINT_NOTIFICATIONS
+from gaepagseguro.save_commands import UpdatePaymentAndSaveLog, CreatePagSegPaymentToLog, SaveToPayment, \
+    PaymentWritePlan
+from gaepagseguro.search_commands import PaymentByPagseguroCode, clear_payment_cache
+from gaepagseguro.transaction_parser import parse_transaction
+
+
+# Seconds a processed notification is remembered, so PagSeguro's repeated deliveries are skipped. 0 disables it
+NOTIFICATION_DEDUP_TTL = 3600
+
+
+def _notification_cache_key(notification_code):
+    return 'gaepagseguro_notification_%s' % notification_code
+
+
+def _cached_keys(keys):
+    """
+    @return: set of keys which are on memcache
+    """
+    if NOTIFICATION_DEDUP_TTL <= 0 or not keys:
+        return set()
+    return set(memcache.get_multi(keys))
+
+
+def _cache_processed_notifications(notification_codes):
+    """
+    @param notification_codes: list of notification codes already processed
+    """
+    if NOTIFICATION_DEDUP_TTL <= 0 or not notification_codes:
+        return
+    memcache.set_multi({_notification_cache_key(c): 1 for c in notification_codes}, time=NOTIFICATION_DEDUP_TTL)
+
+
+def _is_payment_up_to_date(payment, transaction_code, status):
+    # a status can be notified again after another one, so repeated statuses are detected on current payment only
+    return payment.status == status and payment.code == transaction_code
 
 
 class FetchNotificationDetail(FindAccessDataCmd):
-    def __init__(self, notification_code):
+    def __init__(self, notification_code, deadline=None):
         super(FetchNotificationDetail, self).__init__()
         self.notification_code = notification_code
+        self.deadline = deadline
         self.code = None
         self.status = None
         self.net_amount = None
         self.xml = None
+        self.duplicated = False
+
+    def set_up(self):
+        self.duplicated = bool(_cached_keys([_notification_cache_key(self.notification_code)]))
+        if not self.duplicated:
+            super(FetchNotificationDetail, self).set_up()
 
     def do_business(self, stop_on_error=True):
+        if self.duplicated:
+            return
         super(FetchNotificationDetail, self).do_business(stop_on_error)
-        access_data = self.result
-        notification_url = router.to_path('https://ws.pagseguro.uol.com.br/v3/transactions/notifications',
-                                          self.notification_code,
-                                          email=access_data.email,
-                                          token=access_data.token)
-        fetch_cmd = UrlFetchCommand(notification_url)
-        fetch_cmd()
-        if fetch_cmd.result and fetch_cmd.result.content:
-            content = fetch_cmd.result.content
-            content_dct = xmltodict.parse(content, 'ISO-8859-1')
-            self.code = content_dct['transaction']['code']
-            self.status = XML_STATUS_TO_MODEL_STATUS[content_dct['transaction']['status']]
-            self.net_amount = content_dct['transaction']['netAmount']
-
-            try:
-                self.result = content_dct['transaction']['reference']
-            except KeyError:
+        # UrlFetchCommand's default deadline is used if none is given
+        fetch_kwargs = {'deadline': self.deadline} if self.deadline else {}
+        url = _notification_url(self.result, self.notification_code)
+        fetch_cmd = ResilientFetch(ENDPOINT_NOTIFICATIONS, lambda: UrlFetchCommand(url, **fetch_kwargs))
+        fetch_cmd.set_up()
+        fetch_cmd.do_business()
+        if fetch_cmd.errors:
+            self.update_errors(**fetch_cmd.errors)
+            return
+        self.read_notification(fetch_cmd.result)
+
+    def read_notification(self, fetch_result):
+        """
+        Extracts notification data from PagSeguro's response. Payment id is set as result
+        @param fetch_result: urlfetch result of notification url
+        """
+        if fetch_result and fetch_result.content:
+            content = fetch_result.content
+            transaction = parse_transaction(content)
+            self.code = transaction.code
+            self.status = XML_STATUS_TO_MODEL_STATUS[transaction.status]
+            self.net_amount = transaction.net_amount
+
+            if transaction.reference is not None:
+                self.result = transaction.reference
+            else:
                 self.xml = content
                 self.add_error('no_reference', content)
 
@@ -51,6 +112,26 @@ class FetchNotificationDetail(FindAccessDataCmd):
             self.add_error('pagseguro', 'Notification not contacted')
 
 
+def _notification_url(access_data, notification_code):
+    return router.to_path('https://ws.pagseguro.uol.com.br/v3/transactions/notifications',
+                          notification_code,
+                          email=access_data.email,
+                          token=access_data.token)
+
+
+def update_payment_data(payment, status, code, net_amount):
+    """
+    Sets data from a PagSeguro transaction on payment. Code and net amount are kept if payment already has them
+    @return: True if code was assigned to payment, so its PagSegCodeIndex must be saved
+    """
+    payment.track_counters()
+    payment.net_amount = payment.net_amount or (Decimal(net_amount) if net_amount else None)
+    payment.status = status
+    code_assigned = not payment.code and bool(code)
+    payment.code = payment.code or code
+    return code_assigned
+
+
 class _SimpleSave(Command):
     def __init__(self, node):
         super(_SimpleSave, self).__init__()
@@ -59,37 +140,81 @@ class _SimpleSave(Command):
 
 
 class UpdatePayment(CommandParallel):
+    """
+    Updates payment with data from previous FetchNotificationDetail. Repeated notifications are skipped and flagged
+    on duplicated attribute. Result is None when they are skipped before payment is got
+    """
+
     def __init__(self):
         super(UpdatePayment, self).__init__()
+        self.payment_key = None
+        self.notification_code = None
         self.code = None
         self.status = None
         self.net_amount = None
+        self.duplicated = False
 
     def handle_previous(self, command):
-        self.append(NodeSearch(command.result))
+        self.notification_code = command.notification_code
         self.code = command.code
         self.status = command.status
         self.net_amount = command.net_amount
+        self.duplicated = command.duplicated
+        if not self.duplicated:
+            self.payment_key = to_node_key(command.result)
+            self.append(NodeSearch(self.payment_key))
 
     def do_business(self):
         super(UpdatePayment, self).do_business()
+        if self.duplicated:
+            return
         payment = self.result
-        if payment is not None:
-            payment.net_amount = payment.net_amount or Decimal(self.net_amount)
-            payment.status = self.status
-            payment.code = payment.code or self.code
-            CreatePagSegPaymentToLog(
-                _SimpleSave(payment),
-                _SimpleSave(PagSegLog(status=self.status)))()
+        if payment is not None and _is_payment_up_to_date(payment, self.code, self.status):
+            self.duplicated = True
+            _cache_processed_notifications([self.notification_code])
+        elif payment is not None:
+            # payment read before transaction only gives counters the values it will be saved with
+            update_payment_data(payment, self.status, self.code, self.net_amount)
+            embedded_status_history = is_embedded_status_history()
+
+            def save(saved_payments):
+                saved = saved_payments[0]
+                if saved is not None and _is_payment_up_to_date(saved, self.code, self.status):
+                    # a concurrent request saved the same notification's data
+                    return None
+                # data is applied on the payment read on transaction, so concurrent changes, like other entries of
+                # status history, are not overwritten
+                saved = saved or payment
+                code_assigned = update_payment_data(saved, self.status, self.code, self.net_amount)
+                futures = [PagSegCodeIndex.build(saved).put_async()] if code_assigned else []
+                if embedded_status_history:
+                    saved.append_status_history()
+                    futures.append(saved.put_async())
+                else:
+                    CreatePagSegPaymentToLog(
+                        _SimpleSave(saved),
+                        _SimpleSave(PagSegLog(status=self.status)))()
+                [f.get_result() for f in futures]
+                return saved
+
+            saved = save_counted_payments([payment], save)
+            self.duplicated = saved is None
+            if saved is not None:
+                # the payment used as result gets the properties set only on the saved one
+                payment.status_history = list(saved.status_history)
+                payment.update = saved.update
+            clear_payment_cache([payment])
+            _cache_processed_notifications([self.notification_code])
         else:
-            self.add_error('payment', 'Payment not found for %s' % self[0].node_key)
+            self.add_error('payment', 'Payment not found for %s' % self.payment_key)
 
 
 class FetchNotificationAndUpdatePayment(CommandSequential):
-    def __init__(self, notification_code):
-        super(FetchNotificationAndUpdatePayment, self).__init__(FetchNotificationDetail(notification_code),
+    def __init__(self, notification_code, deadline=None):
+        super(FetchNotificationAndUpdatePayment, self).__init__(FetchNotificationDetail(notification_code, deadline),
                                                                 UpdatePayment())
         self.xml = None
+        self.duplicated = False
 
     def do_business(self):
         try:
@@ -97,6 +222,143 @@ class FetchNotificationAndUpdatePayment(CommandSequential):
         except CommandExecutionException, e:
             self.xml = self[0].xml
             raise e
+        self.duplicated = self[1].duplicated
+
+
+NOTIFICATION_CODE_PARAM = 'notification_code'
+
+
+class EnqueueNotification(TaskQueueCommand):
+    """
+    Adds a task to process the notification later, so the handler receiving PagSeguro's POST answers as soon as the
+    task is added, without fetching notification inline
+    """
+
+    def __init__(self, notification_code, worker_url, queue_name='default', retry_limit=None):
+        kwargs = {'params': {NOTIFICATION_CODE_PARAM: notification_code}}
+        if retry_limit is not None:
+            kwargs['retry_options'] = TaskRetryOptions(task_retry_limit=retry_limit)
+        super(EnqueueNotification, self).__init__(queue_name, worker_url, **kwargs)
+        self.notification_code = notification_code
+
+
+# errors which are not solved by processing the notification again
+_PERMANENT_NOTIFICATION_ERRORS = ('no_reference', 'payment')
+
+
+class ProcessNotificationTask(FetchNotificationAndUpdatePayment):
+    """
+    Processes a notification enqueued with EnqueueNotification. Transient errors, like PagSeguro being unavailable,
+    raise exceptions, so the task fails and queue retries it. Permanent errors are logged and not raised, avoiding
+    useless retries. They are kept on errors attribute
+    """
+
+    def execute(self):
+        try:
+            return super(ProcessNotificationTask, self).execute()
+        except CommandExecutionException:
+            if any(k not in _PERMANENT_NOTIFICATION_ERRORS for k in self.errors):
+                raise
+            logging.error('Notification %s discarded: %s', self[0].notification_code, self.errors)
+            return self
+
+
+class ProcessNotifications(Command):
+    """
+    Processes several notifications at once, as needed after PagSeguro's outages. Notifications are fetched
+    concurrently, at most max_concurrent_fetches at a time, referenced payments are got with a single get_multi and
+    payments and logs are saved with batch puts. Notifications are applied on given order, so a payment notified more
+    than once ends with the status of its last notification.
+    Result is a list with the updated payment of each code, None for those which failed. Errors of each code are
+    on notification_errors list, so a failed notification does not prevent the others processing.
+    Repeated notifications are skipped, the same way UpdatePayment does, and flagged on duplicated list
+    """
+
+    def __init__(self, notification_codes, max_concurrent_fetches=10):
+        super(ProcessNotifications, self).__init__()
+        self.notification_codes = notification_codes
+        self.max_concurrent_fetches = max_concurrent_fetches
+        self.result = [None] * len(notification_codes)
+        self.notification_errors = [{} for _ in notification_codes]
+        self.duplicated = [False] * len(notification_codes)
+
+    def do_business(self):
+        access_data = FindAccessDataCmd()()
+        if access_data is None:
+            self.add_error('access_data', 'PagSeguro access data not found')
+            return
+        cached = _cached_keys([_notification_cache_key(c) for c in self.notification_codes])
+        for index, notification_code in enumerate(self.notification_codes):
+            self.duplicated[index] = _notification_cache_key(notification_code) in cached
+        details = self._fetch_notifications(access_data)
+        payment_keys = [self._payment_key(index, detail) for index, detail in enumerate(details)]
+        unique_keys = list(set(k for k in payment_keys if k))
+        payments = dict(izip(unique_keys, ndb.get_multi(unique_keys)))
+        write_plan = PaymentWritePlan(spare_ids_per_payment=0)
+        processed = []
+        for index, (detail, payment_key) in enumerate(izip(details, payment_keys)):
+            if payment_key is None:
+                continue
+            payment = payments.get(payment_key)
+            if isinstance(payment, PagSegPayment):
+                if _is_payment_up_to_date(payment, detail.code, detail.status):
+                    self.duplicated[index] = True
+                else:
+                    if update_payment_data(payment, detail.status, detail.code, detail.net_amount):
+                        write_plan.add_entity(PagSegCodeIndex.build(payment))
+                    write_plan.add_status_log(payment)
+                processed.append(detail.notification_code)
+                self.result[index] = payment
+            else:
+                self.notification_errors[index]['payment'] = 'Payment not found for %s' % payment_key
+        write_plan.commit()
+        _cache_processed_notifications(processed)
+
+    def _payment_key(self, index, detail):
+        if detail is None or detail.errors or self.duplicated[index]:
+            return None
+        try:
+            return to_node_key(detail.result)
+        except ValueError:
+            self.notification_errors[index]['payment'] = 'Invalid payment reference %s' % detail.result
+
+    def _fetch_notifications(self, access_data):
+        """
+        @return: list with FetchNotificationDetail of each notification code, None for duplicated ones
+        """
+        details = [None] * len(self.notification_codes)
+        fetches = deque()
+        for index, notification_code in enumerate(self.notification_codes):
+            if self.duplicated[index]:
+                continue
+            if len(fetches) >= self.max_concurrent_fetches:
+                self._read_notification(details, *fetches.popleft())
+            url = _notification_url(access_data, notification_code)
+            fetch_cmd = ResilientFetch(ENDPOINT_NOTIFICATIONS, lambda url=url: UrlFetchCommand(url))
+            fetch_cmd.set_up()
+            fetches.append((index, fetch_cmd))
+        while fetches:
+            self._read_notification(details, *fetches.popleft())
+        return details
+
+    def _read_notification(self, details, index, fetch_cmd):
+        detail = FetchNotificationDetail(self.notification_codes[index])
+        try:
+            fetch_cmd.do_business()
+        except urlfetch.Error, e:
+            detail.add_error('pagseguro', unicode(e))
+        else:
+            if 'http' in fetch_cmd.errors:
+                detail.add_error('pagseguro', 'Notification not contacted')
+            elif fetch_cmd.errors:
+                detail.update_errors(**fetch_cmd.errors)
+            else:
+                try:
+                    detail.read_notification(fetch_cmd.result)
+                except (ExpatError, KeyError), e:
+                    detail.add_error('pagseguro', 'Invalid notification: %s' % e)
+        self.notification_errors[index].update(detail.errors)
+        details[index] = detail
 
 
 class CreatePaymentToItem(CreateArc):
@@ -105,46 +367,80 @@ class CreatePaymentToItem(CreateArc):
 
 class ProcessExternalPaymentCmd(CommandParallel):
     def __init__(self, xml):
-        self.__transaction_dct = xmltodict.parse(xml, 'ISO-8859-1')
-        super(ProcessExternalPaymentCmd, self).__init__(
-            PaymentByPagseguroCode(self.__transaction_dct['transaction']['code']))
+        self.__transaction = parse_transaction(xml)
+        self.__search_cmd = PaymentByPagseguroCode(self.__transaction.code)
+        super(ProcessExternalPaymentCmd, self).__init__(self.__search_cmd)
 
     def do_business(self):
         super(ProcessExternalPaymentCmd, self).do_business()
-        dct = self.__transaction_dct
         if self.result:
-            self.result.status = XML_STATUS_TO_MODEL_STATUS.get(dct['transaction']['status'])
-            cmd = UpdatePaymentAndSaveLog(self.result)
-            cmd.execute()
+            self._update_payment(self.__search_cmd.indexed)
         else:
-            self.result = PagSegPayment(code=dct['transaction']['code'],
-                                        status=XML_STATUS_TO_MODEL_STATUS.get(dct['transaction']['status']),
-                                        total=dct['transaction']['grossAmount'],
-                                        net_amount=dct['transaction']['netAmount'])
-            payment_key = self.result.put()
-
-
-            def create_item_cmd(item):
-                return _SimpleSave(PagSegItem(description=item['description'],
-                                              price=Decimal(item['amount']),
-                                              quantity=int(item['quantity'])))
-
-            items = dct['transaction']['items']['item']
-            if isinstance(items, dict):
-                items = [items]
-            items_cmd = [CreatePaymentToItem(payment_key, create_item_cmd(item)) for item in
-                         items]
-            cmd = CommandParallel(
-                CreatePagSegPaymentToLog(payment_key, _SimpleSave(PagSegLog(status=self.result.status))), *items_cmd)
-
-            sender = dct['transaction'].get('sender')
-            if sender:
-                user = facade.get_user_by_email(sender['email'])()
-                if user is None:
-                    user = facade.save_user_cmd(sender['email'], sender['name'])()
-                cmd.append(SaveToPayment(user,payment_key))
-            cmd.execute()
+            self._create_payment()
+
+    def _update_payment(self, indexed):
+        self.result.track_counters()
+        self.result.status = XML_STATUS_TO_MODEL_STATUS.get(self.__transaction.status)
+        cmd = UpdatePaymentAndSaveLog(self.result)
+        cmd.execute()
+        if not indexed:
+            # payment saved before code index existed
+            PagSegCodeIndex.build(self.result).put()
+
+    def _create_payment(self):
+        transaction = self.__transaction
+        self.result = PagSegPayment(code=transaction.code,
+                                    status=XML_STATUS_TO_MODEL_STATUS.get(transaction.status),
+                                    total=transaction.gross_amount,
+                                    net_amount=transaction.net_amount,
+                                    status_history_complete=is_embedded_status_history())
+        embedded_status_history = is_embedded_status_history()
+        if embedded_status_history:
+            self.result.append_status_history()
+        user = None
+        if transaction.sender_email:
+            user = facade.get_user_by_email(transaction.sender_email)()
+            if user is None:
+                user = facade.save_user_cmd(transaction.sender_email, transaction.sender_name)()
+            self.result.owner_key = user.key
+
+        def create_item(item):
+            return PagSegItem(description=item.description,
+                              price=Decimal(item.amount),
+                              quantity=int(item.quantity))
+
+        items = [create_item(item) for item in transaction.items]
+        # items keys are allocated with payment's one, so its snapshot is saved on its transaction
+        first_id, _ = Node.allocate_ids(size=1 + len(items))
+        payment_key = self.result.key = ndb.Key(PagSegPayment, first_id)
+        for item_id, item in enumerate(items, first_id + 1):
+            item.key = ndb.Key(PagSegItem, item_id)
+        if is_item_snapshot():
+            self.result.set_item_snapshot(items)
+        index = PagSegCodeIndex.build(self.result)
+
+        def save(saved_payments):
+            # code is claimed on payment's transaction, so it is created only once
+            if index.key.get() is not None:
+                raise ndb.Rollback()
+            ndb.put_multi([self.result, index])
+            return True
+
+        if not save_counted_payments([self.result], save, new=True):
+            # a concurrent notification of the same transaction created its payment first
+            self.result = PagSegCodeIndex.key_for_code(transaction.code).get(use_cache=False).payment.get()
+            self._update_payment(True)
+            return
+
+        items_cmd = [CreatePaymentToItem(payment_key, _SimpleSave(item)) for item in
+                     items]
+        cmd = CommandParallel(*items_cmd)
+        if not embedded_status_history:
+            cmd.append(CreatePagSegPaymentToLog(payment_key, _SimpleSave(PagSegLog(status=self.result.status))))
 
+        if user is not None:
+            cmd.append(SaveToPayment(user,payment_key))
+        cmd.execute()
 
 XML_STATUS_TO_MODEL_STATUS = {'1': STATUS_SENT_TO_PAGSEGURO,
                               '2': STATUS_ANALYSIS,
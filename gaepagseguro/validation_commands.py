@@ -6,7 +6,8 @@ from gaebusiness.business import Command, CommandParallel, CommandExecutionExcep
 from gaeforms.base import Form, StringField, CepField, EmailField, DecimalField
 from gaeforms.ndb.form import ModelForm
 from gaepagseguro.admin_commands import FindAccessDataCmd
-from gaepagseguro.model import PagSegItem, PagSegPayment, PagSegLog
+from gaepagseguro.model import PagSegItem, PagSegPayment, PagSegLog, is_embedded_status_history, \
+    is_item_snapshot
 
 # Forms
 
@@ -28,6 +29,7 @@ class ItemForm(ModelForm):
 
 class PaymentForm(ModelForm):
     _model_class = PagSegPayment
+    _exclude = [PagSegPayment.status_history, PagSegPayment.item_snapshot, PagSegPayment.owner_key]
     _log_form = LogForm()
     _item_form = ItemForm()
 
@@ -40,11 +42,13 @@ class PaymentForm(ModelForm):
         try:
             dct['pay_items'] = [self._item_form.fill_with_model(item) for item in model.pay_items]
         except AttributeError:
-            pass
+            if is_item_snapshot() and model.item_snapshot:
+                dct['pay_items'] = [self._item_form.fill_with_model(item) for item in model.snapshot_items()]
         try:
             dct['logs'] = [self._log_form.fill_with_model(item) for item in model.logs]
         except AttributeError:
-            pass
+            if is_embedded_status_history() and model.status_history:
+                dct['logs'] = [self._log_form.fill_with_model(entry) for entry in model.status_history]
 
         return dct
 
@@ -143,3 +147,11 @@ class ValidatePagseguroDataCmd(CommandParallel):
             self.raise_exception_if_errors()
 
 
+class ValidateCartCmd(ValidatePagseguroDataCmd):
+    """
+    Validates a cart used on batch payment generation. It keeps the owner of the payment to be generated
+    """
+
+    def __init__(self, payment_owner, name, email, validate_address_cmd, *validate_item_cmds):
+        super(ValidateCartCmd, self).__init__(name, email, validate_address_cmd, *validate_item_cmds)
+        self.payment_owner = payment_owner
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+import time
 from gaegraph.model import Node
+from google.appengine.api import memcache
+from mock import patch
 from base import GAETestCase
-from gaepagseguro import pagseguro_facade
+from gaepagseguro import pagseguro_facade, admin_commands
 from gaepagseguro.admin_commands import FindAccessDataCmd
 from gaepagseguro.model import PagSegAccessData
 
@@ -37,3 +40,41 @@ class PagSeguroAccessDataTests(GAETestCase):
         self.assertEqual('foo@gmail.com', data.email)
         self.assertEqual('abc', data.token)
 
+
+class AccessDataCacheTests(GAETestCase):
+    def test_read_through_cache(self):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@gmail.com', 'abc').execute()
+        data = FindAccessDataCmd().execute().result
+        data.key.delete()  # removing from db without invalidating cache
+
+        # instance local tier
+        cached = FindAccessDataCmd().execute().result
+        self.assertEqual('foo@gmail.com', cached.email)
+        self.assertEqual('abc', cached.token)
+
+        # memcache tier
+        admin_commands._local_cache.clear()
+        self.assertIsNotNone(memcache.get(admin_commands._ACCESS_DATA_CACHE_KEY))
+        cached = FindAccessDataCmd().execute().result
+        self.assertEqual('foo@gmail.com', cached.email)
+        self.assertIn(admin_commands._ACCESS_DATA_CACHE_KEY, admin_commands._local_cache,
+                      'memcache hit should fill instance local tier')
+
+    def test_create_or_update_invalidates_both_tiers(self):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@gmail.com', 'abc').execute()
+        FindAccessDataCmd().execute()
+        pagseguro_facade.create_or_update_access_data_cmd('bar@gmail.com', 'xpto').execute()
+        self.assertNotIn(admin_commands._ACCESS_DATA_CACHE_KEY, admin_commands._local_cache)
+        self.assertIsNone(memcache.get(admin_commands._ACCESS_DATA_CACHE_KEY))
+        data = FindAccessDataCmd().execute().result
+        self.assertEqual('bar@gmail.com', data.email)
+        self.assertEqual('xpto', data.token)
+
+    def test_local_tier_expiration(self):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@gmail.com', 'abc').execute()
+        FindAccessDataCmd().execute()
+        memcache.flush_all()
+        expired = time.time() + admin_commands.ACCESS_DATA_LOCAL_TTL + 1
+        with patch('gaepagseguro.admin_commands.time.time', return_value=expired):
+            PagSegAccessData.query().get().key.delete()
+            self.assertIsNone(FindAccessDataCmd().execute().result)
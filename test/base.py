@@ -5,7 +5,9 @@ import unittest
 from google.appengine.api import files
 from google.appengine.ext import testbed
 import webapp2
+from google.appengine.api import apiproxy_stub_map
 from webapp2_extras import i18n
+from gaepagseguro.admin_commands import clear_access_data_cache
 
 
 # workaround for i18n. without this test will not run
@@ -34,6 +36,8 @@ class GAETestCase(unittest.TestCase):
         self.testbed.init_memcache_stub()
         self.testbed.init_mail_stub()
         self.testbed.init_taskqueue_stub()
+        # access data is kept on instance memory, so it must not leak between tests
+        clear_access_data_cache()
 
     def tearDown(self):
         self.testbed.deactivate()
@@ -48,6 +52,30 @@ class GAETestCase(unittest.TestCase):
         json.dumps(json_response.context)
 
 
+# datastore calls of a transaction which reads and puts status counters shards, with new payments saved on it
+COUNTERS_CALLS = ['BeginTransaction', 'Get', 'Put', 'Commit']
+
+
+class DatastoreCallsTestCase(GAETestCase):
+    """
+    Records the names of datastore RPCs on datastore_calls, after count_datastore_calls is called
+    """
+
+    def setUp(self):
+        super(DatastoreCallsTestCase, self).setUp()
+        self.datastore_calls = []
+
+    def tearDown(self):
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Clear()
+        super(DatastoreCallsTestCase, self).tearDown()
+
+    def count_datastore_calls(self):
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('datastore_counter', self._count_call, 'datastore_v3')
+
+    def _count_call(self, service, call, request, response):
+        self.datastore_calls.append(call)
+
+
 class BlobstoreTestCase(GAETestCase):
     def setUp(self):
         GAETestCase.setUp(self)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from decimal import Decimal
+from urlparse import parse_qs
+from google.appengine.ext import ndb
+from base import GAETestCase
+from gaepagseguro import pagseguro_facade
+from gaepagseguro.checkout_params import encode_checkout_params, format_amount
+from gaepagseguro.model import PagSegItem
+
+
+def _decode(body):
+    return {k: v.decode('ISO-8859-1') for k, (v,) in parse_qs(body).iteritems()}
+
+
+class EncodeCheckoutParamsTests(GAETestCase):
+    def test_large_cart(self):
+        reference = ItemReference(id=7)
+        items = [PagSegItem(description='Curso de Python nº %s & cia' % i, price=Decimal('%s.05' % i),
+                            quantity=i % 3 + 1, reference=reference.key if i % 2 else None) for i in xrange(250)]
+        address_form = pagseguro_facade.validate_address_cmd('Rua 1', '2', 'meu bairro', '12345678', 'São Paulo',
+                                                             'SP', 'apto 4').form
+        body = encode_checkout_params('foo@bar.com', 'abc123', 'https://store.com/pagseguro?a=1', 'Jhon Doe',
+                                      'jhon@bar.com', 1234, items, address_form, 'BRL')
+        self.assertIsInstance(body, str)
+        params = _decode(body)
+        self.assertEqual(8 + 4 * 250 + 8, len(params))
+        self.assertEqual('https://store.com/pagseguro?a=1', params['redirectURL'])
+        for i, item in enumerate(items, 1):
+            self.assertEqual('7' if item.reference else '9999', params['itemId%s' % i])
+            self.assertEqual(item.description, params['itemDescription%s' % i])
+            self.assertEqual('%.2f' % item.price, params['itemAmount%s' % i])
+            self.assertEqual(unicode(item.quantity), params['itemQuantity%s' % i])
+        self.assertIn(b'&shippingAddressCity=S%E3o+Paulo&', body)
+        self.assertIn(b'&itemDescription250=Curso+de+Python+n%BA+249+%26+cia&itemAmount250=249.05&', body)
+        self.assertTrue(body.startswith(b'email=foo%40bar.com&'))
+
+    def test_renewed_checkout(self):
+        items = [PagSegItem(description='Python Course', price=Decimal('120'), quantity=1)]
+        body = encode_checkout_params('foo@bar.com', 'abc123', None, None, None, 1234, items, None, 'BRL')
+        self.assertDictEqual({'email': 'foo@bar.com', 'token': 'abc123', 'currency': 'BRL', 'reference': '1234',
+                              'shippingType': '3', 'itemId1': '9999', 'itemDescription1': 'Python Course',
+                              'itemAmount1': '120.00', 'itemQuantity1': '1'}, _decode(body))
+
+    def test_format_amount(self):
+        self.assertEqual(b'120.00', format_amount(Decimal('120')))
+        self.assertEqual(b'0.10', format_amount(Decimal('0.1')))
+        self.assertEqual(b'0.01', format_amount(Decimal('0.005')))
+        self.assertEqual(b'9999999.00', format_amount(Decimal('9999999.00')))
+
+
+class ItemReference(ndb.Model):
+    pass
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from google.appengine.api import urlfetch
+from mock import patch, Mock
+from base import GAETestCase
+from gaepagseguro import pagseguro_facade
+from gaepagseguro.circuit_breaker import ResilientFetch, FAILURE_THRESHOLD, OPEN_SECONDS, RETRY_MAX_DELAY, \
+    METRIC_OPENED, METRIC_REJECTED, METRIC_HALF_OPENED, METRIC_CLOSED
+from gaepagseguro.rate_limiter import ENDPOINT_NOTIFICATIONS, ENDPOINT_TRANSACTIONS
+from gaepagseguro.update_commands import FetchNotificationDetail
+
+
+def _fetch_mock(status_code=200, error=None):
+    fetch_mock = Mock()
+    fetch_mock.result.status_code = status_code
+    if error:
+        fetch_mock.do_business.side_effect = error
+    return fetch_mock
+
+
+def _failed_fetch():
+    return _fetch_mock(error=urlfetch.DownloadError('timeout'))
+
+
+class ResilientFetchTests(GAETestCase):
+    def test_retry_with_backoff(self):
+        fetches = [_failed_fetch(), _fetch_mock(503), _fetch_mock(200)]
+        sleep = Mock()
+        cmd = ResilientFetch(ENDPOINT_TRANSACTIONS, lambda: fetches.pop(0), sleep=sleep)
+        cmd.set_up()
+        cmd.do_business()
+        self.assertEqual(200, cmd.result.status_code)
+        self.assertEqual({}, cmd.errors)
+        self.assertEqual(2, sleep.call_count)
+        for (delay,), _ in sleep.call_args_list:
+            self.assertTrue(0 <= delay <= RETRY_MAX_DELAY)
+
+    def test_failure_after_attempts(self):
+        fetches = [_failed_fetch(), _failed_fetch()]
+        cmd = ResilientFetch(ENDPOINT_TRANSACTIONS, lambda: fetches.pop(0), attempts=2, sleep=Mock())
+        cmd.set_up()
+        self.assertRaises(urlfetch.DownloadError, cmd.do_business)
+
+    def test_client_error_not_retried(self):
+        factory = Mock(return_value=_fetch_mock(401))
+        cmd = ResilientFetch(ENDPOINT_TRANSACTIONS, factory, sleep=Mock())
+        cmd.set_up()
+        cmd.do_business()
+        self.assertEqual({'http': 401}, cmd.errors)
+        self.assertEqual(1, factory.call_count)
+
+    def test_circuit_breaker(self):
+        def fail():
+            cmd = ResilientFetch(ENDPOINT_TRANSACTIONS, _failed_fetch, attempts=1)
+            cmd.set_up()
+            self.assertRaises(urlfetch.DownloadError, cmd.do_business)
+
+        for _ in xrange(FAILURE_THRESHOLD):
+            fail()
+        self.assertEqual(1, pagseguro_facade.circuit_breaker_metrics(ENDPOINT_TRANSACTIONS)[METRIC_OPENED])
+
+        # open circuit fails without fetching
+        factory = Mock()
+        cmd = ResilientFetch(ENDPOINT_TRANSACTIONS, factory)
+        cmd.set_up()
+        cmd.do_business()
+        self.assertIn('circuit_open', cmd.errors)
+        self.assertFalse(factory.called)
+
+        with patch('time.time') as time_mock:
+            time_mock.return_value = 1e10
+            # a single half open call probes PagSeguro and opens circuit again if it fails
+            fail()
+            cmd = ResilientFetch(ENDPOINT_TRANSACTIONS, factory)
+            cmd.set_up()
+            self.assertIn('circuit_open', cmd.errors)
+
+            time_mock.return_value += OPEN_SECONDS
+            probe = ResilientFetch(ENDPOINT_TRANSACTIONS, _fetch_mock)
+            probe.set_up()
+            concurrent = ResilientFetch(ENDPOINT_TRANSACTIONS, factory)
+            concurrent.set_up()
+            self.assertIn('circuit_open', concurrent.errors)
+            probe.do_business()
+            self.assertEqual({}, probe.errors)
+
+        cmd = ResilientFetch(ENDPOINT_TRANSACTIONS, _fetch_mock)
+        cmd.set_up()
+        cmd.do_business()
+        self.assertEqual({}, cmd.errors)
+        self.assertDictEqual({METRIC_OPENED: 2, METRIC_REJECTED: 3, METRIC_HALF_OPENED: 2, METRIC_CLOSED: 1},
+                             pagseguro_facade.circuit_breaker_metrics(ENDPOINT_TRANSACTIONS))
+
+    @patch('gaepagseguro.circuit_breaker.time.sleep')
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_notifications_fail_fast(self, UrlFetchClassMock, sleep_mock):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+        UrlFetchClassMock.side_effect = lambda *args, **kwargs: _failed_fetch()
+        for i in xrange(FAILURE_THRESHOLD):
+            cmd = FetchNotificationDetail(unicode(i))
+            cmd.set_up()
+            self.assertRaises(urlfetch.DownloadError, cmd.do_business)
+        calls = UrlFetchClassMock.call_count
+
+        cmd = FetchNotificationDetail('other')
+        cmd.set_up()
+        cmd.do_business()
+        self.assertIn('circuit_open', cmd.errors)
+        self.assertEqual(calls, UrlFetchClassMock.call_count)
+        cmd = pagseguro_facade.process_notifications(['other'])
+        cmd()
+        self.assertIn('circuit_open', cmd.notification_errors[0])
@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 from decimal import Decimal
+from urlparse import parse_qs
 
+from google.appengine.api import datastore_errors, memcache, urlfetch
 from google.appengine.ext import ndb
 
-from gaebusiness.business import CommandSequential
+from gaebusiness.business import CommandSequential, CommandExecutionException
 from gaegraph.model import Node
 from mock import patch, Mock
-from base import GAETestCase
+from base import GAETestCase, DatastoreCallsTestCase, COUNTERS_CALLS
 from gaepagseguro import pagseguro_facade
-from gaepagseguro.connection_commands import _make_params, ContactPagseguro
-from gaepagseguro.model import PagSegItem, PagSegPayment, STATUS_SENT_TO_PAGSEGURO
+from gaepagseguro.checkout_params import encode_checkout_params
+from gaepagseguro.connection_commands import ContactPagseguro, DeduplicatedCheckout, CHECKOUT_DEDUP_WAIT
+from gaepagseguro.model import PagSegItem, PagSegPayment, STATUS_SENT_TO_PAGSEGURO, ToPagSegPayment, STATUS_CREATED, \
+    CHECKOUT_CODE_VALIDITY, STATUS_ANALYSIS
 from gaepagseguro.validation_commands import ValidateClientCmd
 
 
@@ -48,8 +52,7 @@ class ConectToPagseguroTests(GAETestCase):
                          'Should have the code extracted from xml _PAGSEGURO_DETAIL_XML')
         self.assertIsNone(payment.code)
 
-
-    def test_make_params(self):
+    def test_encode_checkout_params(self):
         # creating dataaccess
         email = 'foo@bar.com'
         token = '4567890oiuytfgh'
@@ -69,12 +72,260 @@ class ConectToPagseguroTests(GAETestCase):
 
         redirect_url = 'https://mystore.com/pagseguro'
         payment_reference = '1234'
-        dct = _make_params(email, token, redirect_url, client_name, client_email, payment_reference,
-                           items, validate_address_cmd.form, 'BRL')
+        body = encode_checkout_params(email, token, redirect_url, client_name, client_email, payment_reference,
+                                      items, validate_address_cmd.form, 'BRL')
+        dct = {k: v.decode('ISO-8859-1') for k, (v,) in parse_qs(body).iteritems()}
         self.maxDiff = None
         self.assertDictEqual(_build_success_params(reference0.key.id(), reference1.key.id()), dct)
 
 
+class GeneratePaymentWritesTests(DatastoreCallsTestCase):
+    def setUp(self):
+        super(GeneratePaymentWritesTests, self).setUp()
+        self.count_datastore_calls()
+
+    def _generate_payment(self, fetch_mock):
+        owner = PaymentOwner()
+        owner.put()
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+        pagseguro_facade.search_access_data_cmd()()  # warming access data cache
+        validate_address_cmd = pagseguro_facade.validate_address_cmd('Rua 1', '2', 'meu bairro', '12345678',
+                                                                     'São Paulo', 'SP', 'apto 4')
+        cmd = pagseguro_facade.generate_payment('https://store.com/pagseguro', 'Jhon Doe', 'jhon@bar.com', owner,
+                                                validate_address_cmd,
+                                                pagseguro_facade.validate_item_cmd('Python Course', '120', '1'))
+        with patch('gaepagseguro.connection_commands.UrlFetchCommand', return_value=fetch_mock):
+            del self.datastore_calls[:]
+            try:
+                cmd()
+            except CommandExecutionException:
+                pass
+        return cmd, owner
+
+    def test_single_put(self):
+        cmd, owner = self._generate_payment(_build_mock())
+
+        self.assertListEqual(['AllocateIds'] + COUNTERS_CALLS + ['Put'], self.datastore_calls)
+        payment = pagseguro_facade.search_payments(owner, relations=['pay_items', 'logs'])()[0]
+        self.assertEqual(STATUS_SENT_TO_PAGSEGURO, payment.status)
+        self.assertEqual(Decimal('120'), payment.total)
+        self.assertEqual([STATUS_CREATED, STATUS_SENT_TO_PAGSEGURO], [log.status for log in payment.logs])
+        self.assertEqual(1, len(payment.pay_items))
+        self.assertEqual(_SUCCESS_PAGSEGURO_CODE, cmd.checkout_code)
+
+    def test_single_put_on_pagseguro_error(self):
+        fetch_mock = _build_mock()
+        fetch_mock.result.content = 'Unauthorized'
+        cmd, owner = self._generate_payment(fetch_mock)
+
+        self.assertEqual({'pagseguro': 'Unauthorized'}, cmd.errors)
+        self.assertListEqual(['AllocateIds'] + COUNTERS_CALLS + ['Put'], self.datastore_calls)
+        payment = pagseguro_facade.search_payments(owner, relations=['pay_items', 'logs'])()[0]
+        self.assertEqual(STATUS_CREATED, payment.status)
+        self.assertEqual([STATUS_CREATED], [log.status for log in payment.logs])
+        self.assertEqual(1, len(payment.pay_items))
+
+    def test_plan_committed_on_pagseguro_timeout(self):
+        fetch_mock = _build_mock()
+        fetch_mock.do_business.side_effect = urlfetch.DeadlineExceededError('timed out')
+        cmd, owner = self._generate_payment(fetch_mock)
+
+        self.assertEqual({'pagseguro': 'timed out'}, cmd.errors)
+        payment = pagseguro_facade.search_payments(owner, relations=['pay_items', 'logs'])()[0]
+        self.assertEqual(STATUS_CREATED, payment.status)
+        self.assertEqual([STATUS_CREATED], [log.status for log in payment.logs])
+        self.assertEqual(1, len(payment.pay_items))
+
+
+    def test_nothing_put_when_counters_transaction_fails(self):
+        with patch('gaepagseguro.save_commands.save_counted_payments',
+                   side_effect=datastore_errors.TransactionFailedError()):
+            self.assertRaises(datastore_errors.TransactionFailedError, self._generate_payment, _build_mock())
+        self.assertEqual(0, PagSegItem.query().count())
+        self.assertEqual(0, ToPagSegPayment.query().count())
+
+
+class ItemSnapshotTests(GeneratePaymentWritesTests):
+    def setUp(self):
+        super(ItemSnapshotTests, self).setUp()
+        pagseguro_facade.enable_item_snapshot()
+
+    def tearDown(self):
+        pagseguro_facade.enable_item_snapshot(False)
+        super(ItemSnapshotTests, self).tearDown()
+
+    def test_items_served_without_extra_rpcs(self):
+        cmd, owner = self._generate_payment(_build_mock())
+        item = PagSegItem.query().get()
+        payment_id = cmd.result.key.id()
+        ndb.get_context().clear_cache()
+
+        del self.datastore_calls[:]
+        payment = pagseguro_facade.get_payment(payment_id, relations=['pay_items'])()
+        self.assertListEqual(['Get'], self.datastore_calls)
+        self.assertListEqual([item.key], [i.key for i in payment.pay_items])
+        self.assertEqual('Python Course', payment.pay_items[0].description)
+        self.assertEqual(Decimal('120'), payment.pay_items[0].total())
+
+        ndb.get_context().clear_cache()
+        del self.datastore_calls[:]
+        payments = pagseguro_facade.search_all_payments(use_cache=False, relations=['pay_items'])()
+        self.assertListEqual(['RunQuery'], self.datastore_calls)
+        self.assertListEqual([item.key], [i.key for i in payments[0].pay_items])
+
+        payment_dct = pagseguro_facade.payment_form().fill_with_model(payment)
+        self.assertEqual(item.key.id(), payment_dct['pay_items'][0]['id'])
+
+    def test_payment_without_snapshot_falls_back_to_arcs(self):
+        cmd, owner = self._generate_payment(_build_mock())
+        payment = cmd.result
+        payment.item_snapshot = []
+        payment.put()
+
+        items = pagseguro_facade.search_items(payment.key)()
+        self.assertListEqual([PagSegItem.query().get()], items)
+
+
+
+class CheckoutUrlTests(GAETestCase):
+    def _generate_payment(self, fetch_mock):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+        validate_address_cmd = pagseguro_facade.validate_address_cmd('Rua 1', '2', 'meu bairro', '12345678',
+                                                                     'São Paulo', 'SP', 'apto 4')
+        cmd = pagseguro_facade.generate_payment('https://store.com/pagseguro', 'Jhon Doe', 'jhon@bar.com',
+                                                PaymentOwner(id=1), validate_address_cmd,
+                                                pagseguro_facade.validate_item_cmd('Python Course', '120', '1'))
+        with patch('gaepagseguro.connection_commands.UrlFetchCommand', return_value=fetch_mock):
+            try:
+                cmd()
+            except CommandExecutionException:
+                pass
+        return PagSegPayment.query().get()
+
+    def test_code_reused_while_valid(self):
+        payment = self._generate_payment(_build_mock())
+        self.assertEqual(_SUCCESS_PAGSEGURO_CODE, payment.checkout_code)
+        self.assertIsNotNone(payment.checkout_issued)
+
+        with patch('gaepagseguro.connection_commands.UrlFetchCommand') as UrlFetchClassMock:
+            cmd = pagseguro_facade.checkout_url(payment.key.id(), 'https://store.com/pagseguro')
+            self.assertEqual(pagseguro_facade.pagseguro_url(_SUCCESS_PAGSEGURO_CODE), cmd())
+            self.assertTrue(cmd.reused)
+            self.assertFalse(UrlFetchClassMock.called)
+
+    def test_expired_code_renewed(self):
+        payment = self._generate_payment(_build_mock())
+        payment.checkout_issued -= CHECKOUT_CODE_VALIDITY
+        payment.put()
+
+        fetch_mock = _build_mock()
+        fetch_mock.result.content = _SUCCESS_PAGSEGURO_XML.replace(_SUCCESS_PAGSEGURO_CODE, 'NEWCODE')
+        with patch('gaepagseguro.connection_commands.UrlFetchCommand', return_value=fetch_mock) as UrlFetchClassMock:
+            cmd = pagseguro_facade.checkout_url(payment, 'https://store.com/pagseguro')
+            self.assertEqual(pagseguro_facade.pagseguro_url('NEWCODE'), cmd())
+            self.assertFalse(cmd.reused)
+        params = parse_qs(fetch_mock.params)
+        self.assertEqual([unicode(payment.key.id())], params['reference'])
+        self.assertNotIn('senderEmail', params)
+        payment = payment.key.get()
+        self.assertEqual('NEWCODE', payment.checkout_code)
+        self.assertEqual(payment.checkout_code, payment.valid_checkout_code())
+
+    def test_checkout_after_pagseguro_error(self):
+        fetch_mock = _build_mock()
+        fetch_mock.result.content = 'Unauthorized'
+        payment = self._generate_payment(fetch_mock)
+        self.assertIsNone(payment.checkout_code)
+
+        with patch('gaepagseguro.connection_commands.UrlFetchCommand', return_value=_build_mock()):
+            self.assertEqual(pagseguro_facade.pagseguro_url(_SUCCESS_PAGSEGURO_CODE),
+                             pagseguro_facade.checkout_url(payment, 'https://store.com/pagseguro')())
+        payment = payment.key.get()
+        self.assertEqual(STATUS_SENT_TO_PAGSEGURO, payment.status)
+        self.assertListEqual([STATUS_CREATED, STATUS_SENT_TO_PAGSEGURO],
+                             [log.status for log in pagseguro_facade.search_logs(payment)()])
+
+    def test_processed_payment(self):
+        payment = PagSegPayment(status=STATUS_ANALYSIS)
+        payment.put()
+        cmd = pagseguro_facade.checkout_url(payment, 'https://store.com/pagseguro')
+        self.assertRaises(CommandExecutionException, cmd)
+        self.assertIn('payment', cmd.errors)
+
+
+class DeduplicatedCheckoutTests(GAETestCase):
+    def _generate_payment_once(self, fetch_mock, item_price='120', idempotency_key=None):
+        validate_address_cmd = pagseguro_facade.validate_address_cmd('Rua 1', '2', 'meu bairro', '12345678',
+                                                                     'São Paulo', 'SP', 'apto 4')
+        cmd = pagseguro_facade.generate_payment_once(idempotency_key, 'https://store.com/pagseguro', 'Jhon Doe',
+                                                     'jhon@bar.com', PaymentOwner(id=1), validate_address_cmd,
+                                                     pagseguro_facade.validate_item_cmd('Python Course', item_price,
+                                                                                        '1'))
+        with patch('gaepagseguro.connection_commands.UrlFetchCommand', return_value=fetch_mock) as UrlFetchClassMock:
+            try:
+                cmd()
+            except CommandExecutionException:
+                pass
+        return cmd, UrlFetchClassMock
+
+    def setUp(self):
+        super(DeduplicatedCheckoutTests, self).setUp()
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+
+    def test_identical_carts_generated_once(self):
+        first_cmd, _ = self._generate_payment_once(_build_mock())
+        self.assertFalse(first_cmd.deduplicated)
+        self.assertEqual(_SUCCESS_PAGSEGURO_CODE, first_cmd.checkout_code)
+
+        cmd, UrlFetchClassMock = self._generate_payment_once(_build_mock())
+        self.assertTrue(cmd.deduplicated)
+        self.assertFalse(UrlFetchClassMock.called)
+        self.assertEqual(first_cmd.result.key, cmd.result.key)
+        self.assertEqual(_SUCCESS_PAGSEGURO_CODE, cmd.checkout_code)
+        self.assertEqual(1, PagSegPayment.query().count())
+
+        cmd, UrlFetchClassMock = self._generate_payment_once(_build_mock(), item_price='130')
+        self.assertFalse(cmd.deduplicated)
+        self.assertTrue(UrlFetchClassMock.called)
+        self.assertEqual(2, PagSegPayment.query().count())
+
+    def test_caller_key(self):
+        first_cmd, _ = self._generate_payment_once(_build_mock(), idempotency_key='order-1')
+        cmd, UrlFetchClassMock = self._generate_payment_once(_build_mock(), '130', 'order-1')
+        self.assertTrue(cmd.deduplicated)
+        self.assertEqual(first_cmd.result.key, cmd.result.key)
+
+    def test_failed_generation_released(self):
+        fetch_mock = _build_mock()
+        fetch_mock.result.content = 'Unauthorized'
+        cmd, _ = self._generate_payment_once(fetch_mock)
+        self.assertEqual({'pagseguro': 'Unauthorized'}, cmd.errors)
+
+        cmd, UrlFetchClassMock = self._generate_payment_once(_build_mock())
+        self.assertFalse(cmd.deduplicated)
+        self.assertTrue(UrlFetchClassMock.called)
+        self.assertEqual(_SUCCESS_PAGSEGURO_CODE, cmd.checkout_code)
+
+    def test_generation_in_progress(self):
+        generate_cmd = Mock()
+        first_cmd = DeduplicatedCheckout('order-1', generate_cmd)
+        memcache.add(first_cmd._cache_key, 'pending')
+        sleep = Mock()
+        cmd = DeduplicatedCheckout('order-1', generate_cmd, sleep)
+        self.assertRaises(CommandExecutionException, cmd)
+        self.assertIn('checkout', cmd.errors)
+        self.assertFalse(generate_cmd.called)
+        self.assertAlmostEqual(CHECKOUT_DEDUP_WAIT, sum(c[0][0] for c in sleep.call_args_list))
+
+    def test_memcache_failure(self):
+        with patch('gaepagseguro.connection_commands.memcache') as memcache_mock:
+            memcache_mock.get.return_value = None
+            memcache_mock.add.return_value = False
+            cmd, UrlFetchClassMock = self._generate_payment_once(_build_mock())
+        self.assertFalse(cmd.deduplicated)
+        self.assertTrue(UrlFetchClassMock.called)
+        self.assertEqual(_SUCCESS_PAGSEGURO_CODE, cmd.checkout_code)
+
 def _build_mock():
     fetch_mock = Mock()
     fetch_mock.execute = Mock(return_value=fetch_mock)
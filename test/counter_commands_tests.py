@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime, date
+from decimal import Decimal
+from google.appengine.api import apiproxy_stub_map, memcache
+from google.appengine.ext import ndb
+from mommygae import mommy
+from base import GAETestCase
+from gaepagseguro import pagseguro_facade
+from gaepagseguro.model import PagSegPayment, STATUS_SENT_TO_PAGSEGURO, STATUS_CANCELLED, STATUS_ANALYSIS, \
+    STATUS_CREATED, STATUS_ACCEPTED, STATUS_CHARGEBACK
+from gaepagseguro.save_commands import UpdatePaymentAndSaveLog
+from update_commands_tests import generate_xml
+
+
+class StatusCountersTests(GAETestCase):
+    def assert_counter(self, counters, status, count, total, net_amount):
+        self.assertEqual((count, Decimal(total), Decimal(net_amount)),
+                         (counters[status].count, counters[status].total, counters[status].net_amount))
+
+    def test_status_changes(self):
+        pagseguro_facade.procces_external_payment_cmd(generate_xml('non particular id', '1', '18.99'))()
+        counters = pagseguro_facade.status_counters()()
+        self.assert_counter(counters, STATUS_SENT_TO_PAGSEGURO, 1, '49900', '18.99')
+        self.assert_counter(counters, STATUS_CANCELLED, 0, '0', '0')
+
+        pagseguro_facade.procces_external_payment_cmd(generate_xml('non particular id', '7', '18.99'))()
+        counters = pagseguro_facade.status_counters()()
+        self.assert_counter(counters, STATUS_SENT_TO_PAGSEGURO, 0, '0', '0')
+        self.assert_counter(counters, STATUS_CANCELLED, 1, '49900', '18.99')
+
+        # Counters must be the same computed from scratch
+        rebuilt = pagseguro_facade.rebuild_status_counters()()
+        self.assertDictEqual({s: (c.count, c.total, c.net_amount) for s, c in counters.iteritems()},
+                             {s: (c.count, c.total, c.net_amount) for s, c in rebuilt.iteritems()})
+
+    def test_concurrent_status_changes(self):
+        payment = mommy.save_one(PagSegPayment, status=STATUS_SENT_TO_PAGSEGURO, total='10.00', net_amount=None)
+        pagseguro_facade.rebuild_status_counters()()
+
+        # two requests read the payment before any of them saves it
+        first, second = payment.key.get(use_cache=False), payment.key.get(use_cache=False)
+        for concurrent_payment in (first, second):
+            concurrent_payment.track_counters()
+            concurrent_payment.status = STATUS_ANALYSIS
+            UpdatePaymentAndSaveLog(concurrent_payment)()
+
+        counters = pagseguro_facade.status_counters()()
+        self.assert_counter(counters, STATUS_SENT_TO_PAGSEGURO, 0, '0', '0')
+        self.assert_counter(counters, STATUS_ANALYSIS, 1, '10', '0')
+
+    def test_rebuild(self):
+        mommy.save_one(PagSegPayment, status=STATUS_ANALYSIS, total='10.00', net_amount='9.50')
+        mommy.save_one(PagSegPayment, status=STATUS_ANALYSIS, total='20.00', net_amount=None)
+        mommy.save_one(PagSegPayment, status=STATUS_CREATED, total='5.00', net_amount=None)
+
+        pagseguro_facade.rebuild_status_counters(batch_size=2)()
+        ndb.get_context().clear_cache()
+        memcache.flush_all()
+
+        datastore_calls = []
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'datastore_counter', lambda service, call, request, response: datastore_calls.append(call),
+            'datastore_v3')
+        try:
+            counters = pagseguro_facade.status_counters()()
+        finally:
+            apiproxy_stub_map.apiproxy.GetPreCallHooks().Clear()
+        # shards are read only by concurrent gets, ndb splits them in RPCs of 10 entity groups
+        self.assertSetEqual({'Get'}, set(datastore_calls))
+        self.assert_counter(counters, STATUS_ANALYSIS, 2, '30', '9.50')
+        self.assert_counter(counters, STATUS_CREATED, 1, '5', '0')
+        self.assert_counter(counters, STATUS_CANCELLED, 0, '0', '0')
+
+    def test_rebuild_by_pages(self):
+        mommy.save_one(PagSegPayment, status=STATUS_ANALYSIS, total='10.00', net_amount='9.50')
+        mommy.save_one(PagSegPayment, status=STATUS_ANALYSIS, total='20.00', net_amount=None)
+        mommy.save_one(PagSegPayment, status=STATUS_CREATED, total='5.00', net_amount=None)
+        pagseguro_facade.rebuild_status_counters()()
+
+        cmd = pagseguro_facade.rebuild_status_counters(batch_size=2, max_batches=1)
+        counters = cmd()
+        self.assertTrue(cmd.more)
+        self.assertEqual(2, counters[STATUS_ANALYSIS].count + counters[STATUS_CREATED].count,
+                         'Counters must be zeroed and have only the first page')
+        while cmd.more:
+            cmd = pagseguro_facade.rebuild_status_counters(batch_size=2, start_cursor=cmd.cursor, max_batches=1)
+            counters = cmd()
+        self.assert_counter(counters, STATUS_ANALYSIS, 2, '30', '9.50')
+        self.assert_counter(counters, STATUS_CREATED, 1, '5', '0')
+        self.assertDictEqual({s: (c.count, c.total, c.net_amount) for s, c in counters.iteritems()},
+                             {s: (c.count, c.total, c.net_amount)
+                              for s, c in pagseguro_facade.status_counters()().iteritems()})
+
+
+class RevenueReportTests(GAETestCase):
+    def assert_rollup(self, rollup, count, total, net_amount, fee):
+        self.assertEqual((count, Decimal(total), Decimal(net_amount), Decimal(fee)),
+                         (rollup.count, rollup.total, rollup.net_amount, rollup.fee()))
+
+    def test_report(self):
+        mommy.save_one(PagSegPayment, status=STATUS_ACCEPTED, total='10.00', net_amount='9.50',
+                       creation=datetime(2014, 1, 30, 10))
+        chargeback = mommy.save_one(PagSegPayment, status=STATUS_ACCEPTED, total='20.00', net_amount='19.00',
+                                    creation=datetime(2014, 1, 31, 23))
+        mommy.save_one(PagSegPayment, status=STATUS_ACCEPTED, total='40.00', net_amount='38.00',
+                       creation=datetime(2014, 2, 1, 1))
+        pagseguro_facade.rebuild_status_counters()()
+
+        # Transitions out of a status are subtracted from it
+        chargeback.track_counters()
+        chargeback.status = STATUS_CHARGEBACK
+        UpdatePaymentAndSaveLog(chargeback)()
+
+        cmd = pagseguro_facade.revenue_report(date(2014, 1, 31), date(2014, 2, 1))
+        daily = cmd()
+        self.assertListEqual([date(2014, 1, 31), date(2014, 2, 1)], [day for day, _ in daily])
+        self.assert_rollup(daily[0][1][STATUS_ACCEPTED], 0, '0', '0', '0')
+        self.assert_rollup(daily[0][1][STATUS_CHARGEBACK], 1, '20', '19', '1')
+        self.assert_rollup(daily[1][1][STATUS_ACCEPTED], 1, '40', '38', '2')
+        self.assert_rollup(cmd.totals[STATUS_ACCEPTED], 1, '40', '38', '2')
+
+        cmd = pagseguro_facade.revenue_report(date(2014, 1, 15), date(2014, 2, 15), monthly=True)
+        monthly = cmd()
+        self.assertListEqual([date(2014, 1, 1), date(2014, 2, 1)], [month for month, _ in monthly])
+        self.assert_rollup(monthly[0][1][STATUS_ACCEPTED], 1, '10', '9.5', '0.5')
+        self.assert_rollup(monthly[0][1][STATUS_CHARGEBACK], 1, '20', '19', '1')
+        self.assert_rollup(cmd.totals[STATUS_ACCEPTED], 2, '50', '47.5', '2.5')
+        self.assert_rollup(cmd.totals[STATUS_CANCELLED], 0, '0', '0', '0')
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from StringIO import StringIO
+import csv
+import json
+from gaebusiness.business import CommandExecutionException
+from google.appengine.ext import ndb
+from base import GAETestCase
+from gaepagseguro import pagseguro_facade
+from gaepagseguro.model import PagSegPayment, PagSegItem, PagSegLog, PagSegPaymentToItem, PagSegPaymentToLog, \
+    STATUS_CREATED, STATUS_ANALYSIS
+
+
+class ExportPaymentsTests(GAETestCase):
+    def setUp(self):
+        super(ExportPaymentsTests, self).setUp()
+        self.payments = [PagSegPayment(status=STATUS_ANALYSIS, code='CODE%s' % i, total='10.00', net_amount='9.50')
+                         for i in xrange(5)]
+        items = [PagSegItem(description='Curso de Python %s' % i, price='10.00', quantity=1) for i in xrange(5)]
+        logs = [PagSegLog(status=STATUS_CREATED) for i in xrange(5)]
+        ndb.put_multi(self.payments + items + logs)
+        ndb.put_multi([PagSegPaymentToItem(p, item) for p, item in zip(self.payments, items)] +
+                      [PagSegPaymentToLog(p, log) for p, log in zip(self.payments, logs)])
+
+    def test_jsonl_resumed_export(self):
+        fileobj = StringIO()
+        cmd = pagseguro_facade.export_payments(fileobj, batch_size=2, max_batches=2)
+        self.assertEqual(4, cmd())
+        self.assertTrue(cmd.more)
+
+        # Continuing on next execution, like on a chained task
+        cmd = pagseguro_facade.export_payments(fileobj, batch_size=2, start_cursor=cmd.cursor)
+        self.assertEqual(1, cmd())
+        self.assertFalse(cmd.more)
+
+        lines = [json.loads(line) for line in fileobj.getvalue().splitlines()]
+        self.assertListEqual(sorted(p.key.id() for p in self.payments), [line['id'] for line in lines])
+        first = [line for line in lines if line['code'] == 'CODE0'][0]
+        self.assertEqual('CODE0', first['code'])
+        self.assertEqual('9.50', first['net_amount'])
+        self.assertListEqual(['Curso de Python 0'], [item['description'] for item in first['items']])
+        self.assertListEqual([STATUS_CREATED], [log['status'] for log in first['logs']])
+
+    def test_csv_export(self):
+        fileobj = StringIO()
+        self.assertEqual(5, pagseguro_facade.export_payments(fileobj, pagseguro_facade.EXPORT_FORMAT_CSV)())
+
+        rows = list(csv.DictReader(StringIO(fileobj.getvalue())))
+        self.assertEqual(5, len(rows))
+        row = [row for row in rows if row['code'] == 'CODE0'][0]
+        self.assertEqual(STATUS_ANALYSIS, row['status'])
+        self.assertEqual('10.00', row['total'])
+        self.assertListEqual(['Curso de Python 0'], [item['description'] for item in json.loads(row['items'])])
+
+    def test_invalid_format(self):
+        cmd = pagseguro_facade.export_payments(StringIO(), 'xml')
+        self.assertRaises(CommandExecutionException, cmd)
+        self.assertIn('export_format', cmd.errors)
@@ -94,3 +94,81 @@ class IntegrationTests(GAETestCase):
         # Log Assertions
         self.assertListEqual([STATUS_CREATED, STATUS_SENT_TO_PAGSEGURO], [log['status'] for log in payment_dct['logs']])
 
+
+    @patch('gaepagseguro.connection_commands.UrlFetchCommand')
+    def test_batch_payments(self, UrlFetchCommandMock):
+        error_fetch_mock = _build_mock()
+        error_fetch_mock.result.content = 'Unauthorized'
+        UrlFetchCommandMock.side_effect = [_build_mock(), error_fetch_mock]
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+
+        class UserMock(Node):
+            pass
+
+        owners = [UserMock(), UserMock(), UserMock()]
+        ndb.put_multi(owners)
+
+        def build_cart(owner, client_name='Renzo Nuccitelli'):
+            validate_address_cmd = pagseguro_facade.validate_address_cmd('Av Vicente de Carvalho', '2', 'Jardins',
+                                                                         '12345-678', 'São Paulo', 'SP', 'apto 4')
+            return pagseguro_facade.payment_cart(client_name, 'renzon@gmail.com', owner, validate_address_cmd,
+                                                 pagseguro_facade.validate_item_cmd('Python Birds', '18.99', '1'),
+                                                 pagseguro_facade.validate_item_cmd('App Engine', '45.58', '2'))
+
+        carts = [build_cart(owners[0]), build_cart(owners[1], 'Renzo'), build_cart(owners[2])]
+        cmd = pagseguro_facade.generate_payments('http://somedomain.com/receive', *carts)
+        payments = cmd()
+
+        # First cart success
+        self.assertEqual(_SUCCESS_PAGSEGURO_CODE, cmd.checkout_codes[0])
+        self.assertEqual({}, cmd.cart_errors[0])
+        self.assertEqual(STATUS_SENT_TO_PAGSEGURO, payments[0].status)
+        self.assertEqual(Decimal('110.15'), payments[0].total)
+        payment = pagseguro_facade.search_payments(owners[0], relations=['pay_items', 'logs'])()[0]
+        self.assertEqual(payments[0], payment)
+        self.assertEqual([STATUS_CREATED, STATUS_SENT_TO_PAGSEGURO], [log.status for log in payment.logs])
+        self.assertEqual(2, len(payment.pay_items))
+
+        # Second cart invalid
+        self.assertIsNone(payments[1])
+        self.assertIsNone(cmd.checkout_codes[1])
+        self.assertEqual({'name': 'Nome informado deve ser completo'}, cmd.cart_errors[1])
+        self.assertListEqual([], pagseguro_facade.search_payments(owners[1])())
+
+        # Third cart saved but not accepted by pagseguro
+        self.assertIsNone(payments[2])
+        self.assertIsNone(cmd.checkout_codes[2])
+        self.assertEqual({'pagseguro': 'Unauthorized'}, cmd.cart_errors[2])
+        payment = pagseguro_facade.search_payments(owners[2], relations=['logs'])()[0]
+        self.assertEqual(STATUS_CREATED, payment.status)
+        self.assertEqual([STATUS_CREATED], [log.status for log in payment.logs])
+
+        self.assertEqual(2, UrlFetchCommandMock.call_count)
+
+    @patch('gaepagseguro.connection_commands.UrlFetchCommand')
+    def test_async_payment(self, UrlFetchCommandMock):
+        UrlFetchCommandMock.return_value = _build_mock()
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+
+        class UserMock(Node):
+            pass
+
+        owner = UserMock()
+        owner.put()
+        validate_address_cmd = pagseguro_facade.validate_address_cmd('Av Vicente de Carvalho', '2', 'Jardins',
+                                                                     '12345-678', 'São Paulo', 'SP', 'apto 4')
+        payment_cmd = pagseguro_facade.generate_payment_async('http://somedomain.com/receive', 'Renzo Nuccitelli',
+                                                              'renzon@gmail.com', owner, validate_address_cmd,
+                                                              pagseguro_facade.validate_item_cmd('Python Birds',
+                                                                                                 '18.99', '1'))
+        payment = payment_cmd()
+
+        self.assertEqual(_SUCCESS_PAGSEGURO_CODE, payment_cmd.checkout_code)
+        self.assertEqual(STATUS_SENT_TO_PAGSEGURO, payment.key.get().status)
+        payment = pagseguro_facade.search_payments(owner, relations=['pay_items', 'logs'])()[0]
+        self.assertEqual([STATUS_CREATED, STATUS_SENT_TO_PAGSEGURO], [log.status for log in payment.logs])
+        self.assertEqual(1, len(payment.pay_items))
+        counters = pagseguro_facade.status_counters()()
+        self.assertEqual(0, counters[STATUS_CREATED].count)
+        self.assertEqual(1, counters[STATUS_SENT_TO_PAGSEGURO].count)
+
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from mock import patch, Mock
+from base import GAETestCase
+from gaepagseguro import pagseguro_facade
+from gaepagseguro.rate_limiter import TokenBucket, RateBudget, POLICY_FAIL_FAST, POLICY_WAIT, set_rate_budget, \
+    ENDPOINT_NOTIFICATIONS, ENDPOINT_CHECKOUT, ENDPOINT_TRANSACTIONS, get_rate_budget, acquire_call
+from gaepagseguro.update_commands import FetchNotificationDetail
+
+
+class FakeClock(object):
+    """
+    Stand-in for time, so waiting for tokens advances it instead of sleeping
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TokenBucketTests(GAETestCase):
+    def test_throughput_under_limit(self):
+        clock = FakeClock()
+        budget = RateBudget(rate=5, capacity=10, policy=POLICY_WAIT, max_wait=60)
+        # buckets of several instances share the same memcache entry
+        instances = [TokenBucket('checkout', budget, clock, clock.sleep) for _ in xrange(3)]
+        start = clock.now
+        grants = []
+        for i in xrange(100):
+            self.assertTrue(instances[i % 3].acquire())
+            grants.append(clock.now)
+        for count, granted_at in enumerate(grants, 1):
+            self.assertLessEqual(count, budget.capacity + budget.rate * (granted_at - start) + 1e-6)
+        # burst is served at once, remaining calls at rate
+        self.assertEqual(start, grants[budget.capacity - 1])
+        self.assertAlmostEqual((100 - budget.capacity) / budget.rate, clock.now - start)
+
+    def test_fail_fast(self):
+        clock = FakeClock()
+        budget = RateBudget(rate=2, capacity=2, policy=POLICY_FAIL_FAST)
+        bucket = TokenBucket('notifications', budget, clock, clock.sleep)
+        self.assertTrue(bucket.acquire())
+        self.assertTrue(bucket.acquire())
+        self.assertFalse(bucket.acquire())
+        self.assertEqual(1000.0, clock.now)
+        clock.now += 0.5
+        self.assertTrue(bucket.acquire())
+        self.assertFalse(bucket.acquire())
+
+    def test_max_wait(self):
+        clock = FakeClock()
+        budget = RateBudget(rate=1, capacity=1, policy=POLICY_WAIT, max_wait=0.5)
+        bucket = TokenBucket('transactions', budget, clock, clock.sleep)
+        self.assertTrue(bucket.acquire())
+        self.assertFalse(bucket.acquire())
+        self.assertEqual(1000.0, clock.now)
+
+    def test_memcache_failure(self):
+        clock = FakeClock()
+        budget = RateBudget(rate=1, capacity=1, policy=POLICY_FAIL_FAST)
+        with patch('gaepagseguro.rate_limiter.memcache.Client') as ClientMock:
+            # memcache client returns None and False when the service fails
+            ClientMock.return_value.gets.return_value = None
+            ClientMock.return_value.add.return_value = False
+            bucket = TokenBucket('transactions', budget, clock, clock.sleep)
+            self.assertTrue(bucket.acquire())
+            self.assertTrue(bucket.acquire())
+
+
+class DefaultBudgetsTests(GAETestCase):
+    def test_not_limited_by_default(self):
+        for endpoint in (ENDPOINT_CHECKOUT, ENDPOINT_NOTIFICATIONS, ENDPOINT_TRANSACTIONS):
+            self.assertIsNone(get_rate_budget(endpoint))
+            self.assertTrue(all(acquire_call(endpoint) for _ in xrange(100)))
+
+
+class RateLimitedCallsTests(GAETestCase):
+    def setUp(self):
+        super(RateLimitedCallsTests, self).setUp()
+        pagseguro_facade.configure_rate_limit(ENDPOINT_NOTIFICATIONS, 1, 1, POLICY_FAIL_FAST)
+
+    def tearDown(self):
+        set_rate_budget(ENDPOINT_NOTIFICATIONS, None, None)
+        super(RateLimitedCallsTests, self).tearDown()
+
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_notifications_over_budget(self, UrlFetchClassMock):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+        fetch_cmd_obj = Mock()
+        fetch_cmd_obj.result.content = None
+        UrlFetchClassMock.return_value = fetch_cmd_obj
+
+        cmd = FetchNotificationDetail('1')
+        cmd.set_up()
+        cmd.do_business()
+        self.assertNotIn('rate_limit', cmd.errors)
+        cmd = FetchNotificationDetail('2')
+        cmd.set_up()
+        cmd.do_business()
+        self.assertIn('rate_limit', cmd.errors)
+
+        cmd = pagseguro_facade.process_notifications(['3', '4'])
+        cmd()
+        self.assertListEqual(['rate_limit', 'rate_limit'], [e.keys()[0] for e in cmd.notification_errors])
+        self.assertEqual(1, UrlFetchClassMock.call_count)
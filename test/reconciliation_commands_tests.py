@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import urlparse
+from gaebusiness.business import CommandExecutionException
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api.urlfetch_stub import URLFetchServiceStub
+from google.appengine.ext import ndb
+from base import GAETestCase
+from gaepagseguro import pagseguro_facade
+from gaepagseguro.model import PagSegPayment, STATUS_SENT_TO_PAGSEGURO, STATUS_ACCEPTED, STATUS_ANALYSIS, \
+    STATUS_AVAILABLE, PagSegReconciliation, PagSegCodeIndex
+from gaepagseguro.reconciliation_commands import TRANSACTIONS_SEARCH_URL
+
+
+class FakePagSeguroStub(URLFetchServiceStub):
+    """
+    Stand-in for PagSeguro's transactions search API, answering urlfetch calls made on tests
+    """
+
+    def __init__(self, transactions):
+        super(FakePagSeguroStub, self).__init__()
+        self.transactions = transactions
+        self.requests = []
+
+    def _Dynamic_Fetch(self, request, response):
+        url, query = request.url().split('?')
+        params = dict(urlparse.parse_qsl(query))
+        self.requests.append(params)
+        response.set_finalurl(request.url())
+        if url != TRANSACTIONS_SEARCH_URL or params['token'] != 'abc123':
+            response.set_statuscode(401)
+            response.set_content(b'Unauthorized')
+            return
+        page = int(params['page'])
+        page_size = int(params['maxPageResults'])
+        total_pages = (len(self.transactions) + page_size - 1) // page_size
+        page_transactions = self.transactions[(page - 1) * page_size:page * page_size]
+        response.set_statuscode(200)
+        response.set_content(build_search_xml(page, total_pages, page_transactions))
+
+
+class ReconciliationTests(GAETestCase):
+    def setUp(self):
+        super(ReconciliationTests, self).setUp()
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+
+    def install_fake_pagseguro(self, transactions):
+        fake = FakePagSeguroStub(transactions)
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', fake)
+        return fake
+
+    def test_reconciliation(self):
+        by_reference = PagSegPayment(status=STATUS_SENT_TO_PAGSEGURO)
+        by_code = PagSegPayment(status=STATUS_ANALYSIS, code='CODE2')
+        up_to_date = PagSegPayment(status=STATUS_AVAILABLE, code='CODE3')
+        ndb.put_multi([by_reference, by_code, up_to_date])
+        fake = self.install_fake_pagseguro([(by_reference.key.id(), 'CODE1', '3'),
+                                            (None, 'CODE2', '3'),
+                                            (up_to_date.key.id(), 'CODE3', '4'),
+                                            (9999, 'UNKNOWN', '3')])
+
+        reconciliation = pagseguro_facade.start_reconciliation(datetime(2014, 1, 1), datetime(2014, 1, 31))()
+
+        # First execution processes only first page
+        result = pagseguro_facade.reconcile_transactions(reconciliation.key.id(), max_page_results=2)()
+        self.assertFalse(result.done)
+        self.assertEqual(2, result.page)
+        self.assertEqual(2, result.total_pages)
+        self.assertEqual('2014-01-01T00:00', fake.requests[0]['initialDate'])
+        self.assertEqual('2014-01-31T00:00', fake.requests[0]['finalDate'])
+        by_reference = by_reference.key.get()
+        self.assertEqual(STATUS_ACCEPTED, by_reference.status)
+        self.assertEqual('CODE1', by_reference.code)
+        self.assertEqual(by_reference.key, PagSegCodeIndex.key_for_code('CODE1').get().payment)
+        self.assertEqual(STATUS_ACCEPTED, by_code.key.get().status)
+
+        # Second execution continues from saved page
+        result = pagseguro_facade.reconcile_transactions(reconciliation.key.id(), max_page_results=2)()
+        self.assertTrue(result.done)
+        self.assertEqual('2', fake.requests[1]['page'])
+        self.assertEqual(4, result.transactions_checked)
+        self.assertEqual(2, result.payments_updated)
+        self.assertEqual(result, PagSegReconciliation.query().get())
+
+        self.assertListEqual([STATUS_ACCEPTED], [log.status for log in pagseguro_facade.search_logs(by_code)()])
+        self.assertListEqual([], pagseguro_facade.search_logs(up_to_date)())
+
+        # Done reconciliation does not contact PagSeguro
+        pagseguro_facade.reconcile_transactions(reconciliation.key.id(), max_page_results=2)()
+        self.assertEqual(2, len(fake.requests))
+
+    def test_pagseguro_error_keeps_checkpoint(self):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'wrong')()
+        self.install_fake_pagseguro([])
+        reconciliation = pagseguro_facade.start_reconciliation(datetime(2014, 1, 1), datetime(2014, 1, 31))()
+
+        cmd = pagseguro_facade.reconcile_transactions(reconciliation)
+        self.assertRaises(CommandExecutionException, cmd)
+        self.assertEqual({'pagseguro': 'Unauthorized'}, cmd.errors)
+        self.assertEqual(1, reconciliation.key.get().page)
+
+
+def build_search_xml(page, total_pages, transactions):
+    transactions_xml = ''.join('''
+        <transaction>
+            <date>2014-01-10T17:39:14.000-03:00</date>
+            %s
+            <code>%s</code>
+            <type>1</type>
+            <status>%s</status>
+            <paymentMethod>
+                <type>1</type>
+            </paymentMethod>
+            <grossAmount>10.00</grossAmount>
+            <discountAmount>0.00</discountAmount>
+            <feeAmount>0.50</feeAmount>
+            <netAmount>9.50</netAmount>
+            <extraAmount>0.00</extraAmount>
+            <lastEventDate>2014-01-11T17:39:14.000-03:00</lastEventDate>
+        </transaction>''' % ('<reference>%s</reference>' % reference if reference else '', code, status)
+                               for reference, code, status in transactions)
+    return ('''<?xml version="1.0" encoding="ISO-8859-1" standalone="yes"?>
+<transactionSearchResult>
+    <date>2014-02-01T10:00:00.000-02:00</date>
+    <currentPage>%s</currentPage>
+    <resultsInThisPage>%s</resultsInThisPage>
+    <totalPages>%s</totalPages>
+    <transactions>%s
+    </transactions>
+</transactionSearchResult>''' % (page, len(transactions), total_pages, transactions_xml)).encode('ISO-8859-1')
@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+from decimal import Decimal
+import os
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.ext import ndb
-from base import GAETestCase
+from gaegraph.model import Node
+import gaepagseguro
+from base import GAETestCase, DatastoreCallsTestCase
 from gaepagseguro import pagseguro_facade
-from gaepagseguro.model import PagSegPayment, STATUS_CREATED, STATUS_SENT_TO_PAGSEGURO
-from gaepagseguro.search_commands import GetPayment
+from gaepagseguro.model import PagSegPayment, STATUS_CREATED, STATUS_SENT_TO_PAGSEGURO, PagSegItem, PagSegLog, \
+    ToPagSegPayment, PagSegPaymentToItem, PagSegPaymentToLog, PagSegCodeIndex, STATUS_ANALYSIS, STATUS_CANCELLED
+from gaepagseguro.save_commands import UpdatePaymentAndSaveLog
+from gaepagseguro.search_commands import GetPayment, PaymentByPagseguroCode, hydrate_payment_rows
 
 
 class PaymentSearchTests(GAETestCase):
@@ -31,6 +39,25 @@ class PaymentSearchTests(GAETestCase):
         cmd = pagseguro_facade.search_all_payments(STATUS_CREATED, page_size=4).execute()
         self.assertListEqual(created_payments, cmd.result)
 
+    def test_owner_payments_search(self):
+        owner = Node()
+        owner.put()
+        payments = [PagSegPayment(status=STATUS_CREATED if i % 2 else STATUS_SENT_TO_PAGSEGURO, owner_key=owner.key)
+                    for i in xrange(5)]
+        for p in payments:
+            p.put()  # one by one, so update property defines order
+        PagSegPayment(status=STATUS_CREATED, owner_key=Node(id=999).key).put()
+        payments.reverse()
+
+        cmd = pagseguro_facade.search_payments(owner, page_size=3)
+        self.assertListEqual(payments[:3], cmd())
+        self.assertTrue(cmd.more)
+        cmd = pagseguro_facade.search_payments(owner, page_size=3, start_cursor=cmd.cursor)
+        self.assertListEqual(payments[3:], cmd())
+
+        created = pagseguro_facade.search_payments(owner, payment_status=STATUS_CREATED)()
+        self.assertListEqual([p for p in payments if p.status == STATUS_CREATED], created)
+
     def test_get_payment_search(self):
         created_payment = PagSegPayment(status=STATUS_CREATED)
         created_payment.put()
@@ -39,3 +66,250 @@ class PaymentSearchTests(GAETestCase):
         self.assertEqual(created_payment, payment)
 
 
+class GetPaymentCacheTests(DatastoreCallsTestCase):
+    def setUp(self):
+        super(GetPaymentCacheTests, self).setUp()
+        self.count_datastore_calls()
+
+    def test_cache(self):
+        payment = PagSegPayment(status=STATUS_CREATED)
+        payment.put()
+        log = PagSegLog(status=STATUS_CREATED)
+        log.put()
+        PagSegPaymentToLog(payment, log).put()
+        pagseguro_facade.get_payment(payment.key.id(), ['logs'])()
+
+        ndb.get_context().clear_cache()
+        self.datastore_calls = []
+        cached = pagseguro_facade.get_payment(payment.key.id(), ['logs'])()
+        self.assertListEqual([], self.datastore_calls)
+        self.assertEqual(payment, cached)
+        self.assertListEqual([STATUS_CREATED], [l.status for l in cached.logs])
+
+        # Writes invalidate every relations set
+        payment.status = STATUS_SENT_TO_PAGSEGURO
+        UpdatePaymentAndSaveLog(payment)()
+        updated = pagseguro_facade.get_payment(payment.key.id(), ['logs'])()
+        self.assertEqual(STATUS_SENT_TO_PAGSEGURO, updated.status)
+        self.assertListEqual([STATUS_CREATED, STATUS_SENT_TO_PAGSEGURO], [l.status for l in updated.logs])
+        self.assertEqual(STATUS_SENT_TO_PAGSEGURO, pagseguro_facade.get_payment(payment.key.id())().status)
+
+    def test_migrations_invalidate_cache(self):
+        payment = PagSegPayment(status=STATUS_CREATED)
+        payment.put()
+        owner = Node()
+        owner.put()
+        ToPagSegPayment(owner, payment).put()
+        log = PagSegLog(status=STATUS_CREATED)
+        log.put()
+        PagSegPaymentToLog(payment, log).put()
+        self.assertIsNone(pagseguro_facade.get_payment(payment.key.id(), ['logs'])().owner_key)
+
+        pagseguro_facade.migrate_payment_owners()()
+        self.assertEqual(owner.key, pagseguro_facade.get_payment(payment.key.id(), ['logs'])().owner_key)
+
+        pagseguro_facade.migrate_logs_to_status_history()()
+        cached = pagseguro_facade.get_payment(payment.key.id(), ['logs'])()
+        self.assertListEqual([STATUS_CREATED], [e.status for e in cached.status_history])
+
+    def test_missing_payment_is_not_cached(self):
+        self.assertIsNone(pagseguro_facade.get_payment(123)())
+        payment = PagSegPayment(status=STATUS_CREATED, id=123)
+        payment.put()
+        self.assertEqual(payment, pagseguro_facade.get_payment(123)())
+
+
+class PaymentByCodeTests(DatastoreCallsTestCase):
+    def setUp(self):
+        super(PaymentByCodeTests, self).setUp()
+        self.count_datastore_calls()
+
+    def test_indexed_payment(self):
+        payment = PagSegPayment(status=STATUS_CREATED, code='CODE')
+        payment.put()
+        PagSegCodeIndex.build(payment).put()
+        ndb.get_context().clear_cache()
+        self.datastore_calls = []
+
+        cmd = PaymentByPagseguroCode('CODE')
+        self.assertEqual(payment, cmd())
+        self.assertTrue(cmd.indexed)
+        self.assertNotIn('RunQuery', self.datastore_calls)
+
+    def test_payment_without_index(self):
+        payment = PagSegPayment(status=STATUS_CREATED, code='CODE')
+        payment.put()
+
+        cmd = PaymentByPagseguroCode('CODE')
+        self.assertEqual(payment, cmd())
+        self.assertFalse(cmd.indexed)
+        self.assertIsNone(PaymentByPagseguroCode('OTHER')())
+
+
+class OwnerMock(Node):
+    pass
+
+
+class BatchRelationsTests(DatastoreCallsTestCase):
+    def setUp(self):
+        super(BatchRelationsTests, self).setUp()
+        self.count_datastore_calls()
+
+    def _save_payments(self, owner):
+        payments = [PagSegPayment(status=STATUS_CREATED) for i in xrange(3)]
+        ndb.put_multi(payments + [owner])
+        items = [[PagSegItem(description='Item %s %s' % (i, j), price='1.00', quantity=1) for j in xrange(i + 1)]
+                 for i in xrange(3)]
+        logs = [PagSegLog(status=STATUS_CREATED) for p in payments]
+        ndb.put_multi(logs + [item for payment_items in items for item in payment_items])
+        arcs = [ToPagSegPayment(owner, payments[0]), ToPagSegPayment(owner, payments[2])]
+        arcs.extend(PagSegPaymentToLog(p, log) for p, log in zip(payments, logs))
+        for p, payment_items in zip(payments, items):
+            arcs.extend(PagSegPaymentToItem(p, item) for item in payment_items)
+        ndb.put_multi(arcs)
+        return payments, items, logs
+
+    def test_search_all_payments(self):
+        owner = OwnerMock()
+        payments, items, logs = self._save_payments(owner)
+        ndb.get_context().clear_cache()
+
+        del self.datastore_calls[:]
+        result = pagseguro_facade.search_all_payments(use_cache=False, relations=['owner', 'pay_items', 'logs'])()
+        # page query and get, concurrent arc subqueries of the IN filters and a single get for relation nodes
+        self.assertListEqual(['RunQuery', 'Get'] + ['RunQuery'] * 9 + ['Get'], self.datastore_calls)
+        result.reverse()
+        self.assertListEqual(payments, result)
+        self.assertListEqual([owner, None, owner], [p.owner for p in result])
+        self.assertListEqual(items, [p.pay_items for p in result])
+        self.assertListEqual([[log] for log in logs], [p.logs for p in result])
+
+        # Second search gets arcs from cache and nodes from ndb's memcache. Only the payment without owner is searched
+        # again, since empty relations are not cached
+        ndb.get_context().clear_cache()
+        del self.datastore_calls[:]
+        result = pagseguro_facade.search_all_payments(use_cache=False, relations=['owner', 'pay_items', 'logs'])()
+        self.assertListEqual(['RunQuery', 'RunQuery'], self.datastore_calls)
+        self.assertListEqual(items, [p.pay_items for p in reversed(result)])
+
+    def test_search_owner_payments(self):
+        owner = OwnerMock()
+        payments, items, logs = self._save_payments(owner)
+        # arcs were saved without payments' owner_key, so they are found by arcs until migration is marked as done
+        result = pagseguro_facade.search_payments(owner, relations=['pay_items'])()
+        self.assertListEqual([payments[2], payments[0]], result)
+        self.assertListEqual([items[2], items[0]], [p.pay_items for p in result])
+        self.assertListEqual([], pagseguro_facade.search_payments(owner, payment_status=STATUS_SENT_TO_PAGSEGURO)())
+        pagseguro_facade.mark_payment_owners_migrated()
+        try:
+            self.assertListEqual([], pagseguro_facade.search_payments(owner)())
+        finally:
+            pagseguro_facade.mark_payment_owners_migrated(False)
+        self.assertEqual(2, len(pagseguro_facade.migrate_payment_owners()()))
+
+        result = pagseguro_facade.search_payments(owner, relations=['pay_items', 'logs'])()
+        result = sorted(result, key=lambda p: payments.index(p))
+        self.assertListEqual([payments[0], payments[2]], result)
+        self.assertListEqual([items[0], items[2]], [p.pay_items for p in result])
+        self.assertListEqual([[logs[0]], [logs[2]]], [p.logs for p in result])
+
+
+class PaymentsQueryTests(GAETestCase):
+    def setUp(self):
+        super(PaymentsQueryTests, self).setUp()
+        # queries fail unless served by an index of the shipped index.yaml
+        self.testbed.deactivate()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(require_indexes=True,
+                                            root_path=os.path.dirname(gaepagseguro.__file__))
+        self.testbed.init_memcache_stub()
+
+    def save_payment(self, status, total, creation, update, owner=None):
+        payment = PagSegPayment(status=status, total=total, creation=creation, owner_key=owner)
+        payment.put()
+        # update is auto_now, so it is overwritten without hooks
+        payment.update = update
+        PagSegPayment.update._auto_now = False
+        try:
+            payment.put()
+        finally:
+            PagSegPayment.update._auto_now = True
+        return payment
+
+    def test_filters_and_pagination(self):
+        owner = Node()
+        owner.put()
+        old = self.save_payment(STATUS_CREATED, '10.00', datetime(2014, 1, 1), datetime(2014, 1, 2), owner.key)
+        jan = self.save_payment(STATUS_SENT_TO_PAGSEGURO, '30.00', datetime(2014, 1, 10), datetime(2014, 1, 20),
+                                owner.key)
+        feb = self.save_payment(STATUS_ANALYSIS, '20.00', datetime(2014, 2, 1), datetime(2014, 2, 10), owner.key)
+        other_owner = self.save_payment(STATUS_CREATED, '50.00', datetime(2014, 1, 15), datetime(2014, 2, 5))
+        cancelled = self.save_payment(STATUS_CANCELLED, '40.00', datetime(2014, 1, 5), datetime(2014, 3, 1))
+
+        # without filters payments are ordered by update desc
+        cmd = pagseguro_facade.query_payments(page_size=3)
+        self.assertListEqual([cancelled, feb, other_owner], cmd())
+        self.assertTrue(cmd.more)
+        self.assertListEqual([jan, old], pagseguro_facade.query_payments(page_size=3, start_cursor=cmd.cursor)())
+
+        # multiple statuses paginate by cursor
+        statuses = [STATUS_CREATED, STATUS_SENT_TO_PAGSEGURO, STATUS_ANALYSIS]
+        cmd = pagseguro_facade.query_payments(statuses, page_size=2)
+        self.assertListEqual([feb, other_owner], cmd())
+        self.assertListEqual([jan, old], pagseguro_facade.query_payments(statuses, page_size=2,
+                                                                         start_cursor=cmd.cursor)())
+
+        self.assertListEqual([feb, jan, old], pagseguro_facade.query_payments(owner=owner)())
+        self.assertListEqual([jan, old], pagseguro_facade.query_payments(statuses, owner,
+                                                                         update_end=datetime(2014, 2, 1))())
+
+        # shortest window is used on query, so payments are ordered by creation
+        cmd = pagseguro_facade.query_payments(update_start=datetime(2014, 1, 1), creation_start=datetime(2014, 1, 5),
+                                              creation_end=datetime(2014, 1, 20))
+        self.assertListEqual([other_owner, jan, cancelled], cmd())
+        self.assertIs(PagSegPayment.creation, cmd.builder.query_range[0])
+        self.assertListEqual([other_owner, cancelled],
+                             pagseguro_facade.query_payments(update_start=datetime(2014, 2, 1),
+                                                             creation_start=datetime(2014, 1, 5),
+                                                             creation_end=datetime(2014, 1, 20))())
+
+        # minimum total is on query only without date windows
+        self.assertListEqual([other_owner, cancelled, jan], pagseguro_facade.query_payments(min_total='30')())
+        self.assertListEqual([jan], pagseguro_facade.query_payments([STATUS_SENT_TO_PAGSEGURO, STATUS_ANALYSIS],
+                                                                    owner, min_total='25')())
+        self.assertListEqual([cancelled, other_owner],
+                             pagseguro_facade.query_payments(update_start=datetime(2014, 2, 1), min_total='30')())
+
+    def test_rows_listing(self):
+        created = self.save_payment(STATUS_CREATED, '10.00', datetime(2014, 1, 1), datetime(2014, 1, 2))
+        sent = self.save_payment(STATUS_SENT_TO_PAGSEGURO, '30.50', datetime(2014, 1, 10), datetime(2014, 1, 20))
+        analysis = self.save_payment(STATUS_ANALYSIS, '20.00', datetime(2014, 2, 1), datetime(2014, 2, 10))
+        ndb.get_context().clear_cache()
+
+        cmd = pagseguro_facade.search_all_payments(page_size=2, rows=True)
+        rows = cmd()
+        self.assertListEqual([analysis.key, sent.key], [row.key for row in rows])
+        self.assertEqual((sent.key.id(), STATUS_SENT_TO_PAGSEGURO, Decimal('30.50'), datetime(2014, 1, 20)),
+                         (rows[1].id, rows[1].status, rows[1].total, rows[1].update))
+        self.assertTrue(cmd.more)
+        self.assertListEqual([created.key], [row.key for row in
+                                             pagseguro_facade.search_all_payments(page_size=2, start_cursor=cmd.cursor,
+                                                                                  rows=True)()])
+
+        rows = pagseguro_facade.search_all_payments(STATUS_SENT_TO_PAGSEGURO, rows=True)()
+        self.assertListEqual([(sent.key, STATUS_SENT_TO_PAGSEGURO)], [(row.key, row.status) for row in rows])
+
+        # payments are loaded only for touched rows
+        rows = pagseguro_facade.search_all_payments(rows=True)()
+        self.assertEqual(sent, rows[1].payment())
+        self.assertIsNone(rows[0]._payment)
+        datastore_calls = []
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'datastore_counter', lambda service, call, request, response: datastore_calls.append(call),
+            'datastore_v3')
+        try:
+            payments = hydrate_payment_rows(rows)
+        finally:
+            apiproxy_stub_map.apiproxy.GetPreCallHooks().Clear()
+        self.assertListEqual([analysis, sent, created], payments)
+        self.assertListEqual(['Get'], datastore_calls)
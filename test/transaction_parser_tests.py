@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from xml.parsers.expat import ExpatError
+import xmltodict
+from base import GAETestCase
+from gaepagseguro.transaction_parser import parse_transaction
+
+
+class ParseTransactionTests(GAETestCase):
+    def assert_same_as_xmltodict(self, xml):
+        transaction = parse_transaction(xml)
+        dct = xmltodict.parse(xml, 'ISO-8859-1')['transaction']
+        self.assertEqual(dct['code'], transaction.code)
+        self.assertEqual(dct['status'], transaction.status)
+        self.assertEqual(dct['netAmount'], transaction.net_amount)
+        self.assertEqual(dct['grossAmount'], transaction.gross_amount)
+        self.assertEqual(dct.get('reference'), transaction.reference)
+        self.assertEqual(dct['sender']['name'], transaction.sender_name)
+        self.assertEqual(dct['sender']['email'], transaction.sender_email)
+        items = dct['items']['item']
+        if isinstance(items, dict):
+            items = [items]
+        self.assertListEqual([(i['id'], i['description'], i['amount'], i['quantity']) for i in items],
+                             [(i.id, i.description, i.amount, i.quantity) for i in transaction.items])
+        return transaction
+
+    def test_multiple_items(self):
+        transaction = self.assert_same_as_xmltodict(build_transaction_xml(3))
+        self.assertEqual('Curso de Python nº 2', transaction.items[2].description)
+        self.assertEqual('1234', transaction.reference)
+        self.assertEqual('3', transaction.status)
+
+    def test_single_item(self):
+        transaction = self.assert_same_as_xmltodict(build_transaction_xml(1))
+        self.assertEqual(1, len(transaction.items))
+
+    def test_no_reference(self):
+        transaction = self.assert_same_as_xmltodict(build_transaction_xml(1, reference=''))
+        self.assertIsNone(transaction.reference)
+
+    def test_full_dict(self):
+        xml = build_transaction_xml(2)
+        transaction = parse_transaction(xml)
+        self.assertEqual(xmltodict.parse(xml, 'ISO-8859-1'), transaction.full_dict())
+        address = transaction.full_dict()['transaction']['shipping']['address']
+        self.assertEqual('Av. Brig. Faria Lima', address['street'])
+
+    def test_unicode_xml(self):
+        transaction = self.assert_same_as_xmltodict(build_transaction_xml(2).decode('ISO-8859-1'))
+        self.assertEqual(u'Curso de Python n\xba 1', transaction.items[1].description)
+
+    def test_invalid_xml(self):
+        self.assertRaises(ExpatError, parse_transaction, b'<transaction><code>')
+
+
+def build_transaction_xml(items_number, reference='1234'):
+    items = ''.join('''
+          <item>
+              <id>%s</id>
+              <description>Curso de Python nº %s</description>
+              <quantity>%s</quantity>
+              <amount>%s.00</amount>
+          </item>''' % (i, i, i + 1, i + 10) for i in xrange(items_number))
+    reference = '<reference>%s</reference>' % reference if reference else ''
+    return ('''<?xml version="1.0" encoding="ISO-8859-1" standalone="yes"?>
+  <transaction>
+      <date>2011-02-05T15:46:12.000-02:00</date>
+      <lastEventDate>2011-02-15T17:39:14.000-03:00</lastEventDate>
+      <code>9E884542-81B3-4419-9A75-BCC6FB495EF1</code>
+      %s
+      <type>1</type>
+      <status>3</status>
+      <paymentMethod>
+          <type>1</type>
+          <code>101</code>
+      </paymentMethod>
+      <grossAmount>49900.00</grossAmount>
+      <discountAmount>0.00</discountAmount>
+      <feeAmount>0.00</feeAmount>
+      <netAmount>49900.50</netAmount>
+      <extraAmount>0.00</extraAmount>
+      <installmentCount>1</installmentCount>
+      <itemCount>%s</itemCount>
+      <items>%s
+      </items>
+      <sender>
+          <name>José Comprador</name>
+          <email>comprador@uol.com.br</email>
+          <phone>
+              <areaCode>11</areaCode>
+              <number>56273440</number>
+          </phone>
+      </sender>
+      <shipping>
+          <address>
+              <street>Av. Brig. Faria Lima</street>
+              <number>1384</number>
+              <complement>5o andar</complement>
+              <district>Jardim Paulistano</district>
+              <postalCode>01452002</postalCode>
+              <city>Sao Paulo</city>
+              <state>SP</state>
+              <country>BRA</country>
+          </address>
+          <type>1</type>
+          <cost>21.50</cost>
+      </shipping>
+  </transaction>''' % (reference, items_number, items)).encode('ISO-8859-1')
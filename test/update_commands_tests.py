@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 from decimal import Decimal
+from gaebusiness.business import CommandExecutionException, Command
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
 from gaepermission.model import MainUser
 from mock import patch, Mock
 from mommygae import mommy
-from base import GAETestCase
+from base import GAETestCase, DatastoreCallsTestCase, COUNTERS_CALLS
 from gaepagseguro import pagseguro_facade
 from gaepagseguro.model import PagSegPayment, STATUS_SENT_TO_PAGSEGURO, STATUS_ANALYSIS, STATUS_ACCEPTED, \
     STATUS_CHARGEBACK, STATUS_CHARGEBACK_DEBT, STATUS_CANCELLED, STATUS_RETURNED, STATUS_DISPUTE, STATUS_CREATED, \
-    STATUS_AVAILABLE
+    STATUS_AVAILABLE, PagSegLog, PagSegPaymentToLog, PagSegCodeIndex, PagSegStatusEntry, PagSegItem
+from gaepagseguro.counter_commands import save_counted_payments
+from gaepagseguro.save_commands import UpdatePaymentAndSaveLog
 from gaepagseguro.update_commands import FetchNotificationDetail
 
 
@@ -41,8 +46,9 @@ class FetchNotificationTests(GAETestCase):
 
 
 class IntegrationTests(GAETestCase):
-    def assert_payment_notification_saved(self, cmd, expected_statuses, payment):
-        cmd()
+    def assert_payment_notification_saved(self, expected_statuses, payment):
+        # PagSeguro sends a new notification code for each status change
+        pagseguro_facade.payment_notification('12345-%s' % len(expected_statuses))()
         payment = payment.key.get()  # Searching from db to see updates
         self.assertEqual(payment.status, expected_statuses[-1])
         logs = pagseguro_facade.search_logs(payment)()
@@ -75,6 +81,7 @@ class IntegrationTests(GAETestCase):
         self.assertEqual(payment.code, CODE)
         self.assertEqual(payment.net_amount, Decimal('18.99'))
         self.assertEqual(payment.status, STATUS_ANALYSIS)  # status respective to number 2 coming from xml
+        self.assertEqual(payment.key, PagSegCodeIndex.key_for_code(CODE).get().payment)
 
         logs = pagseguro_facade.search_logs(payment)()
 
@@ -85,44 +92,228 @@ class IntegrationTests(GAETestCase):
 
         fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '3', '18.99')
         expected_statuses = [STATUS_ANALYSIS, STATUS_ACCEPTED]
-        self.assert_payment_notification_saved(cmd, expected_statuses, payment)
+        self.assert_payment_notification_saved(expected_statuses, payment)
 
         # Emulating contesting status
         fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '9', '18.99')
         expected_statuses = [STATUS_ANALYSIS, STATUS_ACCEPTED, STATUS_CHARGEBACK]
-        self.assert_payment_notification_saved(cmd, expected_statuses, payment)
+        self.assert_payment_notification_saved(expected_statuses, payment)
 
 
         # Emulating chargeback debt status
         fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '8', '18.99')
         expected_statuses = [STATUS_ANALYSIS, STATUS_ACCEPTED, STATUS_CHARGEBACK, STATUS_CHARGEBACK_DEBT]
-        self.assert_payment_notification_saved(cmd, expected_statuses, payment)
+        self.assert_payment_notification_saved(expected_statuses, payment)
 
 
         # Emulating canceled status
         fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '7', '18.99')
         expected_statuses.append(STATUS_CANCELLED)
-        self.assert_payment_notification_saved(cmd, expected_statuses, payment)
+        self.assert_payment_notification_saved(expected_statuses, payment)
 
         # Emulating Returned
         fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '6', '18.99')
         expected_statuses.append(STATUS_RETURNED)
-        self.assert_payment_notification_saved(cmd, expected_statuses, payment)
+        self.assert_payment_notification_saved(expected_statuses, payment)
 
         # Emulating dispute status
         fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '5', '18.99')
         expected_statuses.append(STATUS_DISPUTE)
-        self.assert_payment_notification_saved(cmd, expected_statuses, payment)
+        self.assert_payment_notification_saved(expected_statuses, payment)
 
         # Emulating created status
         fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '1', '18.99')
         expected_statuses.append(STATUS_SENT_TO_PAGSEGURO)
-        self.assert_payment_notification_saved(cmd, expected_statuses, payment)
+        self.assert_payment_notification_saved(expected_statuses, payment)
 
         # Emulating available status
         fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '4', '18.99')
         expected_statuses.append(STATUS_AVAILABLE)
-        self.assert_payment_notification_saved(cmd, expected_statuses, payment)
+        self.assert_payment_notification_saved(expected_statuses, payment)
+
+
+class ProcessNotificationsTests(DatastoreCallsTestCase):
+    def setUp(self):
+        super(ProcessNotificationsTests, self).setUp()
+        self.fetches_in_flight = 0
+        self.max_fetches_in_flight = 0
+
+    def _build_fetch_mock(self, url, contents):
+        notification_code = url.split('?')[0].split('/')[-1]
+        fetch_cmd_obj = Mock()
+        fetch_cmd_obj.errors = {}
+        fetch_cmd_obj.result.content = contents[notification_code]
+        if contents[notification_code] is None:
+            fetch_cmd_obj.errors = {'http': 404}
+            fetch_cmd_obj.result.status_code = 404
+
+        def set_up():
+            self.fetches_in_flight += 1
+            self.max_fetches_in_flight = max(self.max_fetches_in_flight, self.fetches_in_flight)
+
+        def do_business():
+            self.fetches_in_flight -= 1
+
+        fetch_cmd_obj.set_up.side_effect = set_up
+        fetch_cmd_obj.do_business.side_effect = do_business
+        return fetch_cmd_obj
+
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_batch(self, UrlFetchClassMock):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+        pagseguro_facade.search_access_data_cmd()()  # warming access data cache
+        payments = [mommy.save_one(PagSegPayment, code=None, net_amount=None, status=STATUS_SENT_TO_PAGSEGURO)
+                    for i in xrange(2)]
+        contents = {'a': generate_xml(payments[0].key.id(), '2', '18.99'),
+                    'b': generate_xml(payments[1].key.id(), '3', '20.99'),
+                    'c': generate_xml(payments[0].key.id(), '3', '18.99'),
+                    'd': generate_xml(payments[1].key.id() + 100, '3', '18.99'),
+                    'e': None}
+        UrlFetchClassMock.side_effect = lambda url: self._build_fetch_mock(url, contents)
+        self.count_datastore_calls()
+
+        cmd = pagseguro_facade.process_notifications(['a', 'b', 'c', 'd', 'e'], max_concurrent_fetches=2)
+        cmd()
+
+        self.assertEqual(2, self.max_fetches_in_flight)
+        # counters of updated payments are changed on their own transaction, after payments are saved
+        self.assertListEqual(['Get', 'AllocateIds', 'Put', 'Put'] + COUNTERS_CALLS, self.datastore_calls)
+        self.assertListEqual([payments[0].key, payments[1].key, payments[0].key, None, None],
+                             [p and p.key for p in cmd.result])
+        self.assertListEqual([{}, {}, {}], cmd.notification_errors[:3])
+        self.assertIn('payment', cmd.notification_errors[3])
+        self.assertIn('pagseguro', cmd.notification_errors[4])
+
+        first_payment, second_payment = [p.key.get() for p in payments]
+        self.assertEqual(STATUS_ACCEPTED, first_payment.status)
+        self.assertEqual(Decimal('18.99'), first_payment.net_amount)
+        self.assertEqual(CODE, first_payment.code)
+        self.assertEqual(STATUS_ACCEPTED, second_payment.status)
+        self.assertListEqual([STATUS_ANALYSIS, STATUS_ACCEPTED],
+                             [log.status for log in pagseguro_facade.search_logs(first_payment)()])
+        self.assertListEqual([STATUS_ACCEPTED],
+                             [log.status for log in pagseguro_facade.search_logs(second_payment)()])
+
+
+class NotificationTaskTests(GAETestCase):
+    def test_enqueue(self):
+        pagseguro_facade.enqueue_notification('12345', '/pagseguro/task')()
+        taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = taskqueue_stub.get_filtered_tasks(queue_names='default')
+        self.assertEqual(1, len(tasks))
+        self.assertEqual('/pagseguro/task', tasks[0].url)
+        self.assertEqual({pagseguro_facade.NOTIFICATION_CODE_PARAM: '12345'}, tasks[0].extract_params())
+
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_process_task(self, UrlFetchClassMock):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+        payment = mommy.save_one(PagSegPayment, code=None, net_amount=None, status=STATUS_SENT_TO_PAGSEGURO)
+        fetch_cmd_obj = Mock()
+        fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '2', '18.99')
+        UrlFetchClassMock.return_value = fetch_cmd_obj
+
+        pagseguro_facade.process_notification_task('12345', deadline=5)()
+
+        UrlFetchClassMock.assert_called_once_with(
+            'https://ws.pagseguro.uol.com.br/v3/transactions/notifications/12345?token=abc123&email=foo%40bar.com',
+            deadline=5)
+        self.assertEqual(STATUS_ANALYSIS, payment.key.get().status)
+
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_permanent_error_not_raised(self, UrlFetchClassMock):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+        fetch_cmd_obj = Mock()
+        fetch_cmd_obj.result.content = generate_xml(123, '2', '18.99')  # payment not found
+        UrlFetchClassMock.return_value = fetch_cmd_obj
+
+        cmd = pagseguro_facade.process_notification_task('12345')
+        cmd()
+        self.assertIn('payment', cmd.errors)
+
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_transient_error_raised_for_retry(self, UrlFetchClassMock):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+        fetch_cmd_obj = Mock()
+        fetch_cmd_obj.result.content = ''
+        UrlFetchClassMock.return_value = fetch_cmd_obj
+
+        self.assertRaises(CommandExecutionException, pagseguro_facade.process_notification_task('12345'))
+
+
+class NotificationDedupTests(GAETestCase):
+    def setUp(self):
+        super(NotificationDedupTests, self).setUp()
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+        self.payment = mommy.save_one(PagSegPayment, code=None, net_amount=None, status=STATUS_SENT_TO_PAGSEGURO)
+        self.fetch_cmd_obj = Mock()
+        self.fetch_cmd_obj.errors = {}
+        self.fetch_cmd_obj.result.content = generate_xml(self.payment.key.id(), '2', '18.99')
+
+    def _assert_logs(self, expected_statuses):
+        logs = pagseguro_facade.search_logs(self.payment)()
+        self.assertListEqual(expected_statuses, [log.status for log in logs])
+
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_repeated_notification_code(self, UrlFetchClassMock):
+        UrlFetchClassMock.return_value = self.fetch_cmd_obj
+        pagseguro_facade.payment_notification('12345')()
+
+        cmd = pagseguro_facade.payment_notification('12345')
+        cmd()
+        self.assertTrue(cmd.duplicated)
+        self.assertEqual(1, UrlFetchClassMock.call_count, 'Repeated notification should not be fetched')
+        self._assert_logs([STATUS_ANALYSIS])
+
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_repeated_status(self, UrlFetchClassMock):
+        UrlFetchClassMock.return_value = self.fetch_cmd_obj
+        pagseguro_facade.payment_notification('12345')()
+
+        cmd = pagseguro_facade.payment_notification('12346')
+        cmd()
+        self.assertTrue(cmd.duplicated)
+        self._assert_logs([STATUS_ANALYSIS])
+
+        # Without memcache, payment status is used to detect repetition
+        memcache.flush_all()
+        cmd = pagseguro_facade.payment_notification('12347')
+        cmd()
+        self.assertTrue(cmd.duplicated)
+        self.assertEqual(self.payment, cmd.result)
+        self._assert_logs([STATUS_ANALYSIS])
+
+        self.fetch_cmd_obj.result.content = generate_xml(self.payment.key.id(), '3', '18.99')
+        cmd = pagseguro_facade.payment_notification('12348')
+        cmd()
+        self.assertFalse(cmd.duplicated)
+        self._assert_logs([STATUS_ANALYSIS, STATUS_ACCEPTED])
+
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_status_returned(self, UrlFetchClassMock):
+        UrlFetchClassMock.return_value = self.fetch_cmd_obj
+        for notification_code, status_number in (('12345', '3'), ('12346', '5'), ('12347', '3')):
+            self.fetch_cmd_obj.result.content = generate_xml(self.payment.key.id(), status_number, '18.99')
+            cmd = pagseguro_facade.payment_notification(notification_code)
+            cmd()
+            self.assertFalse(cmd.duplicated)
+        self._assert_logs([STATUS_ACCEPTED, STATUS_DISPUTE, STATUS_ACCEPTED])
+
+        self.fetch_cmd_obj.result.content = generate_xml(self.payment.key.id(), '5', '18.99')
+        cmd = pagseguro_facade.process_notifications(['12348'])
+        cmd()
+        self.assertListEqual([False], cmd.duplicated)
+        self._assert_logs([STATUS_ACCEPTED, STATUS_DISPUTE, STATUS_ACCEPTED, STATUS_DISPUTE])
+
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_batch(self, UrlFetchClassMock):
+        UrlFetchClassMock.return_value = self.fetch_cmd_obj
+        pagseguro_facade.payment_notification('12345')()
+
+        cmd = pagseguro_facade.process_notifications(['12345', '12346'])
+        cmd()
+        self.assertListEqual([True, True], cmd.duplicated)
+        self.assertEqual(2, UrlFetchClassMock.call_count, 'Only second notification should be fetched')
+        self._assert_logs([STATUS_ANALYSIS])
 
 
 def generate_xml(reference_id, status_number, net_amount):
@@ -228,6 +419,24 @@ def create_credit_card_xml(status=4):
 
 
 class ProcessExternalPaymentCommand(GAETestCase):
+    def test_item_snapshot_saved_on_payment_transaction(self):
+        snapshots = []
+
+        def save_counted(payments, *args, **kwargs):
+            snapshots.extend(list(p.item_snapshot) for p in payments)
+            return save_counted_payments(payments, *args, **kwargs)
+
+        pagseguro_facade.enable_item_snapshot()
+        try:
+            with patch('gaepagseguro.update_commands.save_counted_payments', save_counted):
+                pagseguro_facade.procces_external_payment_cmd(create_credit_card_xml())()
+        finally:
+            pagseguro_facade.enable_item_snapshot(False)
+        item = PagSegItem.query().get()
+        self.assertListEqual([[item.key]], [[s.item_key for s in snapshot] for snapshot in snapshots])
+        payment = PagSegPayment.query().get()
+        self.assertListEqual([item.key], [s.item_key for s in payment.item_snapshot])
+
     def test_credit_card_reader_payment(self):
         # Payment creation
         cmd = pagseguro_facade.procces_external_payment_cmd(create_credit_card_xml())
@@ -267,6 +476,34 @@ class ProcessExternalPaymentCommand(GAETestCase):
         self.assertEqual(1, item.quantity)
         self.assertEqual('Venda pelo celular com leitor de chip e senha', item.description)
 
+    def test_code_index(self):
+        pagseguro_facade.procces_external_payment_cmd(generate_xml('non particular id', '1', '18.99'))()
+        payment = PagSegPayment.query().get()
+        index_key = PagSegCodeIndex.key_for_code(CODE)
+        self.assertEqual(payment.key, index_key.get().payment)
+
+        # Payments saved before index existed are found by query and indexed on update
+        index_key.delete()
+        pagseguro_facade.procces_external_payment_cmd(generate_xml('non particular id', '7', '18.99'))()
+        self.assertEqual(1, PagSegPayment.query().count())
+        self.assertEqual(STATUS_CANCELLED, payment.key.get().status)
+        self.assertEqual(payment.key, index_key.get().payment)
+
+    def test_concurrent_creation(self):
+        pagseguro_facade.procces_external_payment_cmd(create_credit_card_xml())()
+        # Concurrent notification did not find the payment, which was created before it claimed the code
+        with patch('gaepagseguro.update_commands.PaymentByPagseguroCode', return_value=Command()):
+            cmd = pagseguro_facade.procces_external_payment_cmd(create_credit_card_xml(7))
+        cmd()
+        payments = PagSegPayment.query().fetch()
+        self.assertEqual(1, len(payments))
+        self.assertEqual(payments[0].key, cmd.result.key)
+        self.assertEqual(STATUS_CANCELLED, payments[0].status)
+        self.assertEqual(1, len(pagseguro_facade.search_items(payments[0])()))
+        counters = pagseguro_facade.status_counters()()
+        self.assertEqual(0, counters[STATUS_AVAILABLE].count)
+        self.assertEqual(1, counters[STATUS_CANCELLED].count)
+
     def test_user_creation(self):
         # Payment creation
         cmd = pagseguro_facade.procces_external_payment_cmd(generate_xml('non particular id', '1', '18.99'))
@@ -277,6 +514,14 @@ class ProcessExternalPaymentCommand(GAETestCase):
         self.assertEqual('comprador@uol.com.br', payments[0].owner.email)
         self.assertEqual('José Comprador', payments[0].owner.name)
 
+    def test_unicode_xml(self):
+        # xml received as request param
+        xml = generate_xml('non particular id', '1', '18.99').decode('ISO-8859-1')
+        pagseguro_facade.procces_external_payment_cmd(xml)()
+        payments = pagseguro_facade.search_all_payments(relations=['owner'])()
+        self.assertEqual(1, len(payments))
+        self.assertEqual('José Comprador', payments[0].owner.name)
+
     def test_user_arc_creation(self):
         # Payment creation
         user = mommy.save_one(MainUser, email='comprador@uol.com.br')
@@ -325,3 +570,134 @@ class ProcessExternalPaymentCommand(GAETestCase):
         self.assertEqual(1, item.quantity)
         self.assertEqual('Notebook Prata', item.description)
 
+
+
+def _append_entry_before(save_counted):
+    '''
+    Wraps save_counted_payments so a history entry is saved by a concurrent request before its transaction
+    '''
+
+    def wrapper(payments, *args, **kwargs):
+        for payment in payments:
+            stored = payment.key.get(use_cache=False, use_memcache=False)
+            stored.status_history.append(PagSegStatusEntry(status=STATUS_SENT_TO_PAGSEGURO))
+            stored.put(use_cache=False, use_memcache=False)
+        return save_counted(payments, *args, **kwargs)
+
+    return wrapper
+
+
+class EmbeddedStatusHistoryTests(GAETestCase):
+    def setUp(self):
+        super(EmbeddedStatusHistoryTests, self).setUp()
+        pagseguro_facade.enable_embedded_status_history()
+
+    def tearDown(self):
+        pagseguro_facade.enable_embedded_status_history(False)
+        super(EmbeddedStatusHistoryTests, self).tearDown()
+
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_notification(self, UrlFetchClassMock):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+        payment = mommy.save_one(PagSegPayment, code=None, net_amount=None, status=STATUS_SENT_TO_PAGSEGURO,
+                                 status_history=[])
+        fetch_cmd_obj = Mock()
+        UrlFetchClassMock.return_value = fetch_cmd_obj
+
+        fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '2', '18.99')
+        pagseguro_facade.payment_notification('12345')()
+        fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '3', '18.99')
+        pagseguro_facade.payment_notification('12346')()
+
+        self.assertEqual(0, PagSegLog.query().count(), 'No log should be saved as a node')
+        self.assertEqual(0, PagSegPaymentToLog.query().count(), 'No log arc should be saved')
+        payment = payment.key.get()
+        self.assertEqual(STATUS_ACCEPTED, payment.status)
+        logs = pagseguro_facade.search_logs(payment)()
+        self.assertListEqual([STATUS_ANALYSIS, STATUS_ACCEPTED], [log.status for log in logs])
+        logs = pagseguro_facade.search_logs(payment.key)()
+        self.assertListEqual([STATUS_ANALYSIS, STATUS_ACCEPTED], [log.status for log in logs])
+        payment_dct = pagseguro_facade.payment_form().fill_with_model(payment)
+        self.assertListEqual([STATUS_ANALYSIS, STATUS_ACCEPTED], [log['status'] for log in payment_dct['logs']])
+
+    @patch('gaepagseguro.update_commands.UrlFetchCommand')
+    def test_concurrent_history_entry_kept(self, UrlFetchClassMock):
+        pagseguro_facade.create_or_update_access_data_cmd('foo@bar.com', 'abc123')()
+        payment = mommy.save_one(PagSegPayment, code=None, net_amount=None, status=STATUS_SENT_TO_PAGSEGURO,
+                                 status_history=[])
+        fetch_cmd_obj = Mock()
+        fetch_cmd_obj.result.content = generate_xml(payment.key.id(), '2', '18.99')
+        UrlFetchClassMock.return_value = fetch_cmd_obj
+
+        with patch('gaepagseguro.update_commands.save_counted_payments',
+                   _append_entry_before(save_counted_payments)):
+            pagseguro_facade.payment_notification('12345')()
+
+        payment = payment.key.get()
+        self.assertListEqual([STATUS_SENT_TO_PAGSEGURO, STATUS_ANALYSIS], [e.status for e in payment.status_history])
+
+    def test_update_and_save_log_concurrent_history_entry_kept(self):
+        payment = mommy.save_one(PagSegPayment, status=STATUS_SENT_TO_PAGSEGURO, status_history=[])
+        payment.status = STATUS_ANALYSIS
+        cmd = UpdatePaymentAndSaveLog(payment)
+        self.assertListEqual([], payment.status_history, 'Building command must not change payment')
+
+        with patch('gaepagseguro.save_commands.save_counted_payments', _append_entry_before(save_counted_payments)):
+            cmd()
+
+        payment = payment.key.get()
+        self.assertListEqual([STATUS_SENT_TO_PAGSEGURO, STATUS_ANALYSIS], [e.status for e in payment.status_history])
+
+    def test_external_payment(self):
+        pagseguro_facade.procces_external_payment_cmd(create_credit_card_xml())()
+        pagseguro_facade.procces_external_payment_cmd(create_credit_card_xml(7))()
+        self.assertEqual(0, PagSegLog.query().count(), 'No log should be saved as a node')
+        payment = PagSegPayment.query().get()
+        logs = pagseguro_facade.search_logs(payment)()
+        self.assertListEqual([STATUS_AVAILABLE, STATUS_CANCELLED], [log.status for log in logs])
+
+    def test_migration(self):
+        pagseguro_facade.enable_embedded_status_history(False)
+        pagseguro_facade.procces_external_payment_cmd(create_credit_card_xml())()
+        pagseguro_facade.procces_external_payment_cmd(create_credit_card_xml(7))()
+        payment = PagSegPayment.query().get()
+        payment.status_history = []
+        payment.put()
+
+        pagseguro_facade.enable_embedded_status_history()
+        # Not migrated payments fall back to logs
+        logs = pagseguro_facade.search_logs(payment.key)()
+        self.assertListEqual([STATUS_AVAILABLE, STATUS_CANCELLED], [log.status for log in logs])
+
+        cmd = pagseguro_facade.migrate_logs_to_status_history(page_size=10)
+        cmd()
+        self.assertFalse(cmd.more)
+        pagseguro_facade.migrate_logs_to_status_history(page_size=10)()  # Migration must be idempotent
+        payment = payment.key.get()
+        self.assertListEqual([STATUS_AVAILABLE, STATUS_CANCELLED], [e.status for e in payment.status_history])
+
+        # New status after migration goes to history only
+        pagseguro_facade.procces_external_payment_cmd(create_credit_card_xml(5))()
+        self.assertEqual(2, PagSegLog.query().count())
+        logs = pagseguro_facade.search_logs(payment.key)()
+        self.assertListEqual([STATUS_AVAILABLE, STATUS_CANCELLED, STATUS_DISPUTE], [log.status for log in logs])
+
+    def test_status_change_before_migration(self):
+        pagseguro_facade.enable_embedded_status_history(False)
+        pagseguro_facade.procces_external_payment_cmd(create_credit_card_xml())()
+        pagseguro_facade.enable_embedded_status_history()
+        pagseguro_facade.procces_external_payment_cmd(create_credit_card_xml(7))()
+        payment = PagSegPayment.query().get()
+        self.assertFalse(payment.status_history_complete)
+
+        # Logs saved before enabling embedded status history are not hidden by the entries saved after it
+        expected = [STATUS_AVAILABLE, STATUS_CANCELLED]
+        self.assertListEqual(expected, [log.status for log in pagseguro_facade.search_logs(payment)()])
+        self.assertListEqual(expected, [log.status for log in pagseguro_facade.search_logs(payment.key)()])
+        payment = pagseguro_facade.get_payment(payment.key.id(), ['logs'])()
+        self.assertListEqual(expected, [log.status for log in payment.logs])
+
+        pagseguro_facade.migrate_logs_to_status_history(page_size=10)()
+        payment = payment.key.get()
+        self.assertTrue(payment.status_history_complete)
+        self.assertListEqual(expected, [log.status for log in pagseguro_facade.search_logs(payment)()])